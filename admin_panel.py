@@ -1,31 +1,44 @@
 import streamlit as st
-import sqlite3
 import os
+import sys
 import signal
 import psutil
 import pandas as pd
 import subprocess
 import time
+from datetime import datetime, timedelta
 
 # ==========================================
 # КОНФИГУРАЦИЯ И ПУТИ
 # ==========================================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SRC_DIR = os.path.join(BASE_DIR, "src")
-DB_PATH = os.path.join(BASE_DIR, "users.db")
 LOG_PATH = os.path.join(BASE_DIR, "bot_error.log")
 
+# Админка работает с той же БД и тем же пулом соединений, что и бот
+sys.path.insert(0, SRC_DIR)
+from database import get_users_page, update_users, set_admin_flag, delete_users, get_metrics, get_daily_signups
+from config import config
+from monitoring import read_heartbeat
+from supervisor import SUPERVISOR_PID_FILE
+from log_tail import LEVELS, LogFollower, tail_lines, filter_lines, rotate_file
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
 st.set_page_config(page_title="RedWeb Admin Panel", layout="wide")
 
-# Проверка статуса бота
+# Статус бота по PID-файлу и heartbeat, без обхода списка процессов
+def read_pid(path):
+    try:
+        with open(path) as f:
+            pid = int(f.read().strip())
+        return pid if psutil.pid_exists(pid) else None
+    except (OSError, ValueError):
+        return None
+
 def get_bot_status():
-    for proc in psutil.process_iter(['pid', 'cmdline']):
-        try:
-            cmd = proc.info.get('cmdline')
-            if cmd and any('src/app.py' in s for s in cmd):
-                return proc.info['pid']
-        except: continue
-    return None
+    pid = read_pid(config.PID_FILE)
+    return pid, read_heartbeat() if pid else None
 
 # --- SIDEBAR ---
 with st.sidebar:
@@ -33,51 +46,156 @@ with st.sidebar:
     menu = st.radio("Навигация:", ["📊 Мониторинг", "👥 Пользователи", "📝 Редактор кода", "📋 Логи бота"])
     
     st.divider()
-    bot_pid = get_bot_status()
+    bot_pid, heartbeat = get_bot_status()
+    supervisor_pid = read_pid(SUPERVISOR_PID_FILE)
     if bot_pid:
-        st.success(f"Бот Онлайн (PID: {bot_pid})")
+        age = time.time() - heartbeat["ts"] if heartbeat and heartbeat.get("pid") == bot_pid else None
+        if age is not None and age <= config.HEARTBEAT_STALE_AFTER:
+            st.success(f"Бот Онлайн (PID: {bot_pid})")
+            st.caption(
+                f"Версия {heartbeat.get('version')} · heartbeat {age:.0f} с назад · "
+                f"лаг {heartbeat.get('loop_lag_ms', 0):.0f} мс · очереди {heartbeat.get('queues', {})}"
+            )
+        else:
+            st.warning(f"Бот не отвечает (PID: {bot_pid}), heartbeat устарел")
+    elif supervisor_pid:
+        st.warning("Бот перезапускается супервизором")
+    else:
+        st.error("Бот Оффлайн")
+    
+    if bot_pid or supervisor_pid:
         if st.button("⏹ Остановить бота", use_container_width=True):
-            os.kill(bot_pid, signal.SIGTERM)
+            # Останавливаем супервизор, иначе он перезапустит бота
+            os.kill(supervisor_pid or bot_pid, signal.SIGTERM)
             st.rerun()
     else:
-        st.error("Бот Оффлайн")
         if st.button("▶️ Запустить бота", use_container_width=True):
-            subprocess.Popen(["python3", os.path.join(SRC_DIR, "app.py")], 
+            rotate_file(LOG_PATH, LOG_MAX_BYTES)
+            subprocess.Popen(["python3", os.path.join(SRC_DIR, "supervisor.py")], 
                              stdout=open(LOG_PATH, "a"), stderr=open(LOG_PATH, "a"), start_new_session=True)
             time.sleep(2)
             st.rerun()
 
+# Запросы к БД кэшируются между перерисовками Streamlit и сбрасываются после правок
+@st.cache_data(ttl=60, show_spinner=False)
+def load_users_page(search, status, admins_only, sort, descending, page_size, page):
+    rows, total = get_users_page(search, status, admins_only, sort, descending, page_size, page * page_size)
+    return pd.DataFrame(rows), total
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_metrics(window_hours):
+    since = datetime.utcnow() - timedelta(hours=window_hours)
+    columns = [
+        "created_at", "total_users", "active_users", "expired_users", "expiring_24h", "expiring_7d",
+        "online_users", "panel_latency_ms", "loop_lag_ms", "cpu_percent", "rss_mb"
+    ]
+    metrics = pd.DataFrame(
+        [[getattr(m, c) for c in columns] for m in get_metrics(since)], columns=columns
+    ).set_index("created_at")
+    signups = pd.DataFrame(
+        get_daily_signups(since.date() - timedelta(days=1)), columns=["day", "signups"]
+    ).set_index("day")
+    return metrics, signups
+
+# --- МЕНЮ: МОНИТОРИНГ ---
+if menu == "📊 Мониторинг":
+    st.header("📊 Мониторинг")
+    windows = {"1 час": 1, "24 часа": 24, "7 дней": 24 * 7, "30 дней": 24 * 30}
+    window = st.selectbox("Окно", list(windows), index=1)
+    metrics, signups = load_metrics(windows[window])
+    
+    if metrics.empty:
+        st.info("Нет данных: бот записывает снимок метрик раз в METRICS_INTERVAL секунд после запуска")
+    else:
+        last = metrics.iloc[-1]
+        st.caption(f"Последний снимок: {metrics.index[-1]:%Y-%m-%d %H:%M:%S} UTC")
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Активные", int(last.active_users), f"из {int(last.total_users)}")
+        c2.metric("Истекшие", int(last.expired_users))
+        c3.metric("Истекают за 24ч / 7д", f"{int(last.expiring_24h)} / {int(last.expiring_7d)}")
+        c4.metric("Онлайн", int(last.online_users))
+        c5, c6, c7, c8 = st.columns(4)
+        c5.metric("Задержка панели", f"{last.panel_latency_ms:.0f} мс")
+        c6.metric("Лаг event loop", f"{last.loop_lag_ms:.0f} мс")
+        c7.metric("CPU бота", f"{last.cpu_percent:.1f}%")
+        c8.metric("RSS бота", f"{last.rss_mb:.0f} МБ")
+        
+        st.subheader("Пользователи")
+        st.line_chart(metrics[["active_users", "expired_users", "online_users"]])
+        st.subheader("Регистрации по дням")
+        st.bar_chart(signups)
+        st.subheader("Панель и процесс бота")
+        st.line_chart(metrics[["panel_latency_ms", "loop_lag_ms"]])
+        st.line_chart(metrics[["cpu_percent", "rss_mb"]])
+
 # --- МЕНЮ: ПОЛЬЗОВАТЕЛИ ---
-if menu == "👥 Пользователи":
+elif menu == "👥 Пользователи":
     st.header("👥 База данных пользователей")
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        users = conn.execute("SELECT * FROM users").fetchall()
-        for row in users:
-            with st.expander(f"👤 {row['full_name']} (ID: {row['telegram_id']})"):
-                with st.form(key=f"edit_form_{row['id']}"):
-                    f_name = st.text_input("Имя", value=row['full_name'])
-                    u_name = st.text_input("Username", value=row['username'] or "")
-                    s_end = st.text_input("Подписка до", value=str(row['subscription_end'] or ""))
-                    is_adm = st.checkbox("Права администратора", value=bool(row['is_admin']))
-                    
-                    if st.form_submit_button("💾 Сохранить"):
-                        conn.execute("UPDATE users SET full_name=?, username=?, is_admin=?, subscription_end=? WHERE id=?", 
-                                     (f_name, u_name, 1 if is_adm else 0, s_end, row['id']))
-                        conn.commit()
-                        st.success("Данные обновлены")
-                        st.rerun()
-                
-                # Кнопка удаления пользователя
-                if st.button(f"🗑 Удалить {row['telegram_id']}", key=f"del_{row['id']}"):
-                    conn.execute("DELETE FROM users WHERE id=?", (row['id'],))
-                    conn.commit()
-                    st.warning("Пользователь удален")
-                    time.sleep(1)
-                    st.rerun()
-    finally:
-        conn.close()
+    
+    c1, c2, c3, c4, c5 = st.columns([3, 2, 2, 2, 1])
+    search = c1.text_input("🔍 Поиск (ID, имя, username, email)")
+    status = c2.selectbox("Подписка", ["all", "active", "expired"],
+                          format_func={"all": "Все", "active": "Активна", "expired": "Истекла"}.get)
+    sort = c3.selectbox("Сортировка", ["registration_date", "subscription_end", "telegram_id", "full_name"])
+    page_size = c4.selectbox("На странице", [25, 50, 100, 250], index=1)
+    descending = c5.checkbox("↓", value=True)
+    admins_only = st.checkbox("Только администраторы")
+    
+    _, total = load_users_page(search, status, admins_only, sort, descending, page_size, 0)
+    pages = max(1, -(-total // page_size))
+    page = st.number_input(f"Страница (всего {pages}, пользователей {total})", 1, pages, 1) - 1
+    df, _ = load_users_page(search, status, admins_only, sort, descending, page_size, page)
+    
+    if df.empty:
+        st.info("Пользователи не найдены")
+    else:
+        df.insert(0, "selected", False)
+        edited = st.data_editor(
+            df,
+            key=f"users_editor_{page}",
+            hide_index=True,
+            use_container_width=True,
+            disabled=["id", "telegram_id", "registration_date", "email"],
+            column_config={
+                "selected": st.column_config.CheckboxColumn("✔"),
+                "id": None,
+                "full_name": "Имя",
+                "subscription_end": st.column_config.DatetimeColumn("Подписка до", format="YYYY-MM-DD HH:mm"),
+                "is_admin": st.column_config.CheckboxColumn("Админ"),
+                "registration_date": st.column_config.DatetimeColumn("Регистрация", format="YYYY-MM-DD HH:mm"),
+            },
+        )
+        
+        # Правки ячеек: только измененные строки и колонки
+        edited_rows = st.session_state[f"users_editor_{page}"]["edited_rows"]
+        changes = {}
+        for index, values in edited_rows.items():
+            values = {k: v for k, v in values.items() if k != "selected"}
+            if "subscription_end" in values and values["subscription_end"]:
+                values["subscription_end"] = pd.to_datetime(values["subscription_end"]).to_pydatetime().replace(tzinfo=None)
+            if values:
+                changes[int(df.iloc[int(index)]["id"])] = values
+        selected_ids = [int(i) for i in edited.loc[edited["selected"], "id"]]
+        
+        b1, b2, b3, b4 = st.columns(4)
+        if b1.button(f"💾 Сохранить изменения ({len(changes)})", disabled=not changes, use_container_width=True):
+            update_users(changes)
+            load_users_page.clear()
+            st.success("Данные обновлены")
+            st.rerun()
+        if b2.button(f"👑 Сделать админами ({len(selected_ids)})", disabled=not selected_ids, use_container_width=True):
+            set_admin_flag(selected_ids, True)
+            load_users_page.clear()
+            st.rerun()
+        if b3.button(f"➖ Снять админа ({len(selected_ids)})", disabled=not selected_ids, use_container_width=True):
+            set_admin_flag(selected_ids, False)
+            load_users_page.clear()
+            st.rerun()
+        if b4.button(f"🗑 Удалить ({len(selected_ids)})", disabled=not selected_ids, use_container_width=True):
+            delete_users(selected_ids)
+            load_users_page.clear()
+            st.warning("Пользователи удалены")
+            st.rerun()
 
 # --- МЕНЮ: РЕДАКТОР ---
 elif menu == "📝 Редактор кода":
@@ -94,6 +212,31 @@ elif menu == "📝 Редактор кода":
 # --- МЕНЮ: ЛОГИ ---
 elif menu == "📋 Логи бота":
     st.header("📋 Журнал событий")
-    if os.path.exists(LOG_PATH):
-        with open(LOG_PATH, "r") as f:
-            st.code(f.read()[-5000:], language="text")
\ No newline at end of file
+    rotate_file(LOG_PATH, LOG_MAX_BYTES)
+    
+    # JSON-лог ротирует сам бот, вывод процесса (stderr) — админ-панель
+    sources = {"Журнал бота (JSON)": config.LOG_FILE, "Вывод процесса": LOG_PATH}
+    log_path = sources[st.radio("Источник", list(sources), horizontal=True)]
+    
+    c1, c2, c3, c4 = st.columns([1, 2, 2, 1])
+    count = c1.number_input("Строк", 50, 5000, 300, step=50)
+    levels = c2.multiselect("Уровни", LEVELS, default=["INFO", "WARNING", "ERROR", "CRITICAL"])
+    keyword = c3.text_input("Поиск")
+    follow = c4.toggle("Следить", value=False)
+    
+    if not os.path.exists(log_path):
+        st.info("Лог пока пуст")
+    elif follow:
+        # Между обновлениями читаются только дописанные байты
+        follower = st.session_state.get("log_follower")
+        if follower is None or follower.lines.maxlen != count or follower.path != log_path:
+            follower = st.session_state["log_follower"] = LogFollower(log_path, count)
+        
+        @st.fragment(run_every=2)
+        def live_log():
+            st.code("\n".join(filter_lines(follower.poll(), levels, keyword)), language="text")
+        live_log()
+    else:
+        st.session_state.pop("log_follower", None)
+        lines, _ = tail_lines(log_path, count)
+        st.code("\n".join(filter_lines(lines, levels, keyword)), language="text")
@@ -1,74 +1,78 @@
-import json
 import asyncio
 import logging
 import warnings
-import coloredlogs
 from config import config
+from logging_setup import setup_logging, log_queue_depth, dropped_records
 from aiogram import Bot, Dispatcher
 from aiogram.types import PreCheckoutQuery
 from handlers import setup_handlers
+from middlewares import in_flight
+from functions import XUIAPI
+from lifecycle import (
+    start_task, sleep_or_shutdown, initial_delay, mark_run, register_state,
+    load_warm_state, graceful_shutdown
+)
 from datetime import datetime, timedelta
-from functions import delete_client_by_email
-from database import Session, User, init_db, get_all_users, delete_user_profile
+from panel_sync import outbox_loop, request_panel_sync
+from quota import quota_loop
+from subscription import start_subscription_server
+from maintenance import maintenance_loop
+from outgoing import governor, send_priority, PRIORITY_NOTIFY
+from monitoring import metrics_loop, heartbeat_loop, loop_lag, write_pid_file, register_queue
+from database import (
+    Session, User, init_db, upsert, restore_archived_users, expire_profile,
+    get_users_to_notify, mark_notified, get_expired_profiles
+)
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-# Настройка логирования
-coloredlogs.install(level='info')
+# Настройка логирования: запись в консоль и файл выполняет отдельный поток
+setup_logging()
 logger = logging.getLogger(__name__)
 
 async def check_subscriptions(bot: Bot):
-    """Проверка статуса подписок"""
+    """Сверка подписок: срок клиента в панели обеспечивает сама 3X-UI,
+    здесь остаются уведомления и удаление клиентов с истекшей подпиской"""
+    # После теплого перезапуска продолжаем часовое расписание, а не сканируем сразу
+    if await sleep_or_shutdown(initial_delay("check_subscriptions", 3600)):
+        return
     while True:
+        mark_run("check_subscriptions")
         try:
-            now = datetime.utcnow()
-            users = await get_all_users()
-            
-            for user in users:
-                # Проверка за 1 день до окончания
-                if user.subscription_end:
-                    time_diff = user.subscription_end - now
-                    
-                    # Уведомление за 24 часа
-                    if timedelta(days=0) < time_diff < timedelta(days=1) and not user.notified:
-                        try:
+            # Уведомление за 24 часа
+            for telegram_id in await get_users_to_notify():
+                try:
+                    with send_priority(PRIORITY_NOTIFY):
+                        await bot.send_message(
+                            telegram_id,
+                            "⚠️ Ваша подписка истекает через 24 часа! Продлите подписку, чтобы сохранить доступ."
+                        )
+                    # Помечаем как уведомленного
+                    await mark_notified(telegram_id)
+                except Exception as e:
+                    logger.error(f"Не удалось отправить уведомление пользователю {telegram_id}: {e}")
+
+            # Отключение при истечении срока
+            for telegram_id in await get_expired_profiles():
+                try:
+                    # Профиль очищается в БД, удаление клиента из 3X-UI выполнит outbox
+                    if await expire_profile(telegram_id):
+                        request_panel_sync()
+                        with send_priority(PRIORITY_NOTIFY):
                             await bot.send_message(
-                                user.telegram_id,
-                                "⚠️ Ваша подписка истекает через 24 часа! Продлите подписку, чтобы сохранить доступ."
+                                telegram_id, 
+                                "❌ Ваша подписка истекла. Доступ к VPN отключен."
                             )
-                            # Помечаем как уведомленного
-                            with Session() as session:
-                                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                                if db_user:
-                                    db_user.notified = True
-                                    session.commit()
-                        except Exception as e:
-                            logger.error(f"Не удалось отправить уведомление пользователю {user.telegram_id}: {e}")
-
-                    # Отключение при истечении срока
-                    if time_diff <= timedelta(seconds=0):
-                        try:
-                            if user.vless_profile_data:
-                                profile = json.loads(user.vless_profile_data)
-                                email = profile.get("email")
-                                if email:
-                                    # Удаляем клиента из 3X-UI через API
-                                    if await delete_client_by_email(email):
-                                        # Очищаем данные профиля в БД бота
-                                        await delete_user_profile(user.telegram_id)
-                                        await bot.send_message(
-                                            user.telegram_id, 
-                                            "❌ Ваша подписка истекла. Доступ к VPN отключен."
-                                        )
-                                        logger.info(f"Подписка пользователя {user.telegram_id} истекла, профиль удален.")
-                        except Exception as e:
-                            logger.error(f"Ошибка при удалении профиля {user.telegram_id}: {e}")
+                        logger.info(f"Подписка пользователя {telegram_id} истекла, профиль удален.")
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении профиля {telegram_id}: {e}")
                             
         except Exception as e:
             logger.error(f"Ошибка в цикле проверки подписок: {e}")
             
         # Проверка каждый час
-        await asyncio.sleep(3600)
+        if await sleep_or_shutdown(3600):
+            break
 
 async def update_admins_status():
     """Обновляет статус администраторов в БД на основе конфигурации"""
@@ -76,26 +80,34 @@ async def update_admins_status():
         # Сбрасываем текущих админов (кроме тех, кто в конфиге)
         session.query(User).update({User.is_admin: False})
         
-        for admin_id in config.ADMINS:
-            user = session.query(User).filter_by(telegram_id=admin_id).first()
-            if user:
-                user.is_admin = True
-            else:
-                # Если админа нет в БД, создаем запись
-                new_admin = User(
-                    telegram_id=admin_id,
-                    full_name="Admin",
-                    is_admin=True,
-                    subscription_end=datetime.utcnow() + timedelta(days=365)
-                )
-                session.add(new_admin)
+        # Одним upsert: существующим выставляем флаг, отсутствующих создаем
+        # (архивных сначала возвращаем, чтобы не плодить двойников)
+        restore_archived_users(session, config.ADMINS)
+        upsert(session, User, [
+            {
+                "telegram_id": admin_id,
+                "full_name": "Admin",
+                "is_admin": True,
+                "subscription_end": datetime.utcnow() + timedelta(days=365)
+            }
+            for admin_id in config.ADMINS
+        ], index_elements=["telegram_id"], update_columns=["is_admin"])
         
         session.commit()
     logger.info("✅ Admin status updated in database")
 
+def _load_panel_state(state: dict):
+    XUIAPI.api_prefix = state.get("api_prefix")
+
+# Найденный путь API панели: без повторного перебора префиксов после рестарта
+register_state("panel", lambda: {"api_prefix": XUIAPI.api_prefix}, _load_panel_state)
+
 async def main():
     bot = Bot(token=config.BOT_TOKEN)
+    # Все исходящие сообщения идут через общий планировщик с лимитами Telegram
+    bot.session.middleware(governor)
     dp = Dispatcher()
+    warm = load_warm_state()
     
     try:
         # Инициализация БД (создание таблиц)
@@ -121,16 +133,51 @@ async def main():
     async def process_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
         await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
     
+    # По SIGTERM aiogram останавливает polling, затем дожидаемся работы и сохраняем состояние
+    subscription_runner = None
+    
+    @dp.shutdown()
+    async def on_shutdown():
+        # Порт подписок закрывается первым: новые запросы не должны застать остановку
+        if subscription_runner is not None:
+            await subscription_runner.cleanup()
+        await graceful_shutdown(in_flight, wakeups=[request_panel_sync])
+    
     # Запускаем фоновую задачу проверки подписок
     try:
-        asyncio.create_task(check_subscriptions(bot))
+        start_task(check_subscriptions(bot), "check_subscriptions", drain=True)
     except Exception as e:
         logger.error(f"❌ Subscription check task failed to start: {e}")
     
+    # Запускаем воркер outbox изменений в панели
+    start_task(outbox_loop(), "outbox", drain=True)
+    
+    # Запускаем контроль лимитов трафика
+    start_task(quota_loop(bot), "quota", drain=True)
+    
+    # Запускаем HTTP-сервер ссылок-подписок
+    try:
+        subscription_runner = await start_subscription_server()
+    except Exception as e:
+        logger.error(f"❌ Subscription server failed to start: {e}")
+    
+    # Запускаем запись метрик для мониторинга и heartbeat
+    write_pid_file()
+    register_queue("log", log_queue_depth)
+    register_queue("log_dropped", dropped_records)
+    register_queue("outgoing", governor.depth)
+    start_task(loop_lag.run(), "loop_lag")
+    start_task(heartbeat_loop(), "heartbeat")
+    start_task(metrics_loop(), "metrics")
+    
+    # Запускаем плановое обслуживание БД (бэкапы, checkpoint, ANALYZE)
+    start_task(maintenance_loop(), "maintenance", drain=True)
+    
     logger.info("ℹ️  Starting bot...")
     try:
-        # Удаляем вебхук перед запуском polling
-        await bot.delete_webhook(drop_pending_updates=True)
+        # Удаляем вебхук перед запуском polling; при теплом перезапуске
+        # апдейты, пришедшие за время рестарта, обрабатываются, а не отбрасываются
+        await bot.delete_webhook(drop_pending_updates=not warm)
         await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"❌ Bot start error: {e}")
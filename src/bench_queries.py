@@ -0,0 +1,120 @@
+"""Замер памяти и времени массовых выборок пользователей.
+
+Создает временную SQLite БД с заданным числом пользователей и для каждого
+массового сценария (цикл истечения, цели рассылки, списки пользователей)
+сравнивает прежнюю загрузку ORM-объектов с выборкой нужных колонок.
+
+Пример:
+    python3 src/bench_queries.py --users 100000
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import insert, or_
+
+def measure(func):
+    """(результат, секунды, пиковая память в МБ)"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def populate(database, users: int):
+    now = datetime.utcnow()
+    rows = []
+    for i in range(users):
+        client_id = str(uuid.uuid4())
+        rows.append({
+            "telegram_id": 10 ** 9 + i,
+            "full_name": f"User {i}",
+            "username": f"user{i}",
+            # Половина активна, часть истекает в ближайшие сутки, остальные истекли
+            "subscription_end": now + timedelta(hours=(i % 96) - 24 if i % 2 else -(i % 90) - 1),
+            "client_id": client_id,
+            "email": f"user_{i}",
+            "port": 443,
+            "inbound_id": 1,
+            "remark": "vpn",
+            "vless_profile_data": json.dumps({
+                "client_id": client_id, "email": f"user_{i}", "port": 443,
+                "security": "reality", "remark": "vpn", "padding": "x" * 200
+            }),
+        })
+    with database.Session() as session:
+        for start in range(0, len(rows), 10000):
+            session.execute(insert(database.User), rows[start:start + 10000])
+        session.commit()
+
+def run(users: int):
+    # database читает DATABASE_URL при импорте, поэтому импортируется после его подмены
+    import asyncio
+    import database
+    from database import Session, User
+
+    def orm_users(*filters):
+        with Session() as session:
+            return session.query(User).filter(*filters).all()
+
+    def legacy_notify():
+        now = datetime.utcnow()
+        return [user.telegram_id for user in orm_users(
+            User.subscription_end > now, User.subscription_end < now + timedelta(days=1),
+            or_(User.notified.is_(None), User.notified == False)
+        )]
+
+    def legacy_expired():
+        return [user.telegram_id for user in orm_users(
+            User.subscription_end <= datetime.utcnow(), User.email.isnot(None)
+        )]
+
+    def format_rows(rows) -> int:
+        # Как в обработчике списка: строка на пользователя, в памяти не копятся
+        count = 0
+        for row in rows:
+            f"{row.full_name} {row.username} {row.telegram_id} {row.subscription_end:%d.%m.%Y %H:%M}"
+            count += 1
+        return count
+
+    def legacy_list():
+        return format_rows(orm_users(User.subscription_end > datetime.utcnow()))
+
+    def projected_list():
+        return format_rows(database.iter_user_rows(True))
+
+    cases = [
+        ("24h notify", legacy_notify, lambda: asyncio.run(database.get_users_to_notify())),
+        ("expired profiles", legacy_expired, lambda: asyncio.run(database.get_expired_profiles())),
+        ("broadcast targets", lambda: [user.telegram_id for user in orm_users()],
+         lambda: asyncio.run(database.get_user_ids())),
+        ("active user list", legacy_list, projected_list),
+    ]
+
+    asyncio.run(database.init_db())
+    started = time.perf_counter()
+    populate(database, users)
+    print(f"Populated {users} users in {time.perf_counter() - started:.1f} s\n")
+    print(f"{'case':<20}{'rows':>8}{'ORM s':>9}{'ORM MB':>9}{'proj s':>9}{'proj MB':>9}")
+    for name, before, after in cases:
+        old_result, old_time, old_peak = measure(before)
+        new_result, new_time, new_peak = measure(after)
+        rows = new_result if isinstance(new_result, int) else len(new_result)
+        assert (old_result if isinstance(old_result, int) else len(old_result)) == rows, name
+        print(f"{name:<20}{rows:>8}{old_time:>9.2f}{old_peak:>9.1f}{new_time:>9.2f}{new_peak:>9.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк массовых выборок пользователей")
+    parser.add_argument("--users", type=int, default=100000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        run(args.users)
@@ -22,6 +22,89 @@ class Config(BaseModel):
     PAYMENT_TOKEN: str = os.getenv("PAYMENT_TOKEN", "")
     INBOUND_ID: int = Field(default=os.getenv("INBOUND_ID", "1"))
 
+    # Настройки базы данных (SQLite по умолчанию, либо серверная БД по URL SQLAlchemy)
+    DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///users.db")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    # Сколько секунд SQLite ждет освобождения блокировки записи
+    DB_BUSY_TIMEOUT: float = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+    # Таймауты запросов к панели 3X-UI и circuit breaker
+    PANEL_READ_TIMEOUT: float = float(os.getenv("PANEL_READ_TIMEOUT", "5"))
+    PANEL_WRITE_TIMEOUT: float = float(os.getenv("PANEL_WRITE_TIMEOUT", "15"))
+    PANEL_READ_RETRIES: int = int(os.getenv("PANEL_READ_RETRIES", "3"))
+    PANEL_BREAKER_FAILURES: int = int(os.getenv("PANEL_BREAKER_FAILURES", "5"))
+    PANEL_BREAKER_RESET: int = int(os.getenv("PANEL_BREAKER_RESET", "30"))
+
+    # Outbox изменений в панели (создание/удаление клиентов, expiryTime)
+    OUTBOX_POLL_INTERVAL: int = int(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+    OUTBOX_BATCH: int = int(os.getenv("OUTBOX_BATCH", "500"))
+    OUTBOX_MAX_ATTEMPTS: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+
+    # Снимки метрик для мониторинга в админ-панели
+    METRICS_INTERVAL: int = int(os.getenv("METRICS_INTERVAL", "60"))
+    METRICS_RETENTION_DAYS: int = int(os.getenv("METRICS_RETENTION_DAYS", "30"))
+
+    # Обслуживание SQLite: онлайн-бэкапы, WAL checkpoint, ANALYZE (часы — UTC)
+    BACKUP_DIR: str = os.getenv("BACKUP_DIR", "backups")
+    BACKUP_INTERVAL_HOURS: int = int(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+    BACKUP_KEEP: int = int(os.getenv("BACKUP_KEEP", "8"))
+    BACKUP_PAGES_PER_STEP: int = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+    BACKUP_STEP_SLEEP: float = float(os.getenv("BACKUP_STEP_SLEEP", "0.005"))
+    CHECKPOINT_INTERVAL_MINUTES: int = int(os.getenv("CHECKPOINT_INTERVAL_MINUTES", "15"))
+    MAINTENANCE_HOUR: int = int(os.getenv("MAINTENANCE_HOUR", "4"))
+
+    # Архивация давно истекших пользователей (выполняется в окно MAINTENANCE_HOUR)
+    ARCHIVE_AFTER_DAYS: int = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+    ARCHIVE_BATCH: int = int(os.getenv("ARCHIVE_BATCH", "1000"))
+
+    # Максимальный размер .txt со списком Telegram ID для массового изменения времени (байт)
+    BULK_IDS_MAX_FILE_SIZE: int = int(os.getenv("BULK_IDS_MAX_FILE_SIZE", str(512 * 1024)))
+
+    # Квоты трафика: проверка расхода и пороги предупреждений в процентах от лимита тарифа
+    QUOTA_CHECK_INTERVAL: int = int(os.getenv("QUOTA_CHECK_INTERVAL", "300"))
+    QUOTA_WARN_PERCENTS: List[int] = [80, 95]
+
+    # Кэш PNG с QR-кодами ссылок подключения (по одному файлу на хэш ссылки)
+    QR_CACHE_DIR: str = os.getenv("QR_CACHE_DIR", "qr_cache")
+    QR_CACHE_MAX_FILES: int = int(os.getenv("QR_CACHE_MAX_FILES", "2000"))
+
+    # HTTP-сервер ссылок-подписок (SUBSCRIPTION_PORT=0 — выключен)
+    SUBSCRIPTION_HOST: str = os.getenv("SUBSCRIPTION_HOST", "0.0.0.0")
+    SUBSCRIPTION_PORT: int = int(os.getenv("SUBSCRIPTION_PORT", "0"))
+    SUBSCRIPTION_URL: str = os.getenv("SUBSCRIPTION_URL", "")
+    SUBSCRIPTION_CACHE_TTL: int = int(os.getenv("SUBSCRIPTION_CACHE_TTL", "60"))
+    SUBSCRIPTION_CACHE_SIZE: int = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+    SUBSCRIPTION_UPDATE_HOURS: int = int(os.getenv("SUBSCRIPTION_UPDATE_HOURS", "6"))
+
+    # Корректная остановка и теплый перезапуск
+    SHUTDOWN_TIMEOUT: int = int(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+    WARM_STATE_FILE: str = os.getenv("WARM_STATE_FILE", "bot_state.json")
+    WARM_STATE_MAX_AGE: int = int(os.getenv("WARM_STATE_MAX_AGE", str(24 * 3600)))
+
+    # Исходящие сообщения: общий лимит Telegram и лимит на один чат (сообщений в секунду)
+    SEND_RATE_GLOBAL: float = float(os.getenv("SEND_RATE_GLOBAL", "25"))
+    SEND_RATE_PER_CHAT: float = float(os.getenv("SEND_RATE_PER_CHAT", "1"))
+    SEND_CHAT_BURST: int = int(os.getenv("SEND_CHAT_BURST", "3"))
+    SEND_MAX_RETRIES: int = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+    # Логирование: JSON-файл с ротацией по размеру и времени
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_FILE: str = os.getenv("LOG_FILE", "logs/bot.jsonl")
+    LOG_MAX_BYTES: int = int(os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+    LOG_BACKUP_COUNT: int = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+    LOG_ROTATE_HOURS: int = int(os.getenv("LOG_ROTATE_HOURS", "24"))
+    LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+    # PID-файл и heartbeat бота (читаются админ-панелью и супервизором)
+    BOT_VERSION: str = os.getenv("BOT_VERSION", "dev")
+    PID_FILE: str = os.getenv("PID_FILE", "bot.pid")
+    HEARTBEAT_FILE: str = os.getenv("HEARTBEAT_FILE", "bot_heartbeat.json")
+    HEARTBEAT_INTERVAL: int = int(os.getenv("HEARTBEAT_INTERVAL", "10"))
+    HEARTBEAT_STALE_AFTER: int = int(os.getenv("HEARTBEAT_STALE_AFTER", "60"))
+
     # Настройки REALITY
     REALITY_PUBLIC_KEY: str = os.getenv("REALITY_PUBLIC_KEY", "YOUR_PUBLIC_KEY")
     REALITY_FINGERPRINT: str = os.getenv("REALITY_FINGERPRINT", "chrome")
@@ -30,11 +113,12 @@ class Config(BaseModel):
     REALITY_SPIDER_X: str = os.getenv("REALITY_SPIDER_X", "/")
 
     # Настройки цен и скидок
+    # traffic_gb — лимит трафика на оплаченный период (0 — без лимита)
     PRICES: Dict[int, Dict[str, int]] = {
-        1: {"base_price": 200, "discount_percent": 0},
-        3: {"base_price": 600, "discount_percent": 18},
-        6: {"base_price": 1200, "discount_percent": 28},
-        12: {"base_price": 2400, "discount_percent": 34}
+        1: {"base_price": 200, "discount_percent": 0, "traffic_gb": 0},
+        3: {"base_price": 600, "discount_percent": 18, "traffic_gb": 0},
+        6: {"base_price": 1200, "discount_percent": 28, "traffic_gb": 0},
+        12: {"base_price": 2400, "discount_percent": 34, "traffic_gb": 0}
     }
 
     @field_validator('ADMINS', mode='before')
@@ -45,6 +129,12 @@ class Config(BaseModel):
             return [value]
         return value or []
     
+    @field_validator('QUOTA_WARN_PERCENTS', mode='before')
+    def parse_quota_percents(cls, value):
+        if isinstance(value, str):
+            value = [int(percent) for percent in value.split(",") if percent.strip()]
+        return sorted(percent for percent in value if 0 < percent < 100)
+    
     @field_validator('INBOUND_ID', mode='before')
     def parse_inbound_id(cls, value):
         if isinstance(value, str) and value.isdigit():
@@ -62,9 +152,14 @@ class Config(BaseModel):
         
         discount_amount = (base_price * discount_percent) // 100
         return base_price - discount_amount
+    
+    def traffic_quota(self, months: int) -> int:
+        """Лимит трафика тарифа в байтах (0 — без лимита)"""
+        return self.PRICES.get(months, {}).get("traffic_gb", 0) * 1024 ** 3
 
 # Инициализация конфига с приоритетом данных из окружения (.env)
 config = Config(
     ADMINS=os.getenv("ADMINS", ""),
-    INBOUND_ID=os.getenv("INBOUND_ID", "1")
+    INBOUND_ID=os.getenv("INBOUND_ID", "1"),
+    QUOTA_WARN_PERCENTS=os.getenv("QUOTA_WARN_PERCENTS", "80,95")
 )
\ No newline at end of file
@@ -1,6 +1,12 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, func
+from sqlalchemy import create_engine, event, insert, inspect, select, text, update, delete, literal, cast, case, or_, Column, Integer, BigInteger, String, Text, DateTime, Date, Float, Boolean, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime, timedelta
+from config import config
+import json
+import uuid
+import random
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,33 +16,659 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True)
-    full_name = Column(String)
-    username = Column(String)
-    registration_date = Column(DateTime, default=datetime.utcnow)
-    subscription_end = Column(DateTime)
-    vless_profile_id = Column(String)
-    vless_profile_data = Column(String)
+    telegram_id = Column(BigInteger, unique=True)
+    full_name = Column(String(255))
+    username = Column(String(64))
+    registration_date = Column(DateTime, default=datetime.utcnow, index=True)
+    subscription_end = Column(DateTime, index=True)
+    vless_profile_id = Column(String(64))
+    # Устаревшее JSON-представление профиля, переносится в колонки ниже при init_db
+    vless_profile_data = Column(Text)
+    client_id = Column(String(64), index=True)
+    email = Column(String(255), unique=True, index=True)
+    port = Column(Integer)
+    inbound_id = Column(Integer)
+    remark = Column(String(255))
+    # Постоянный id ссылки-подписки: переживает пересоздание профиля
+    sub_id = Column(String(64), unique=True, index=True)
+    # file_id загруженного в Telegram QR-кода ссылки профиля и хэш ссылки, которую он кодирует
+    qr_file_id = Column(String(255))
+    qr_key = Column(String(64))
     is_admin = Column(Boolean, default=False)
     notified = Column(Boolean, default=False)
+    # Лимит трафика в байтах (0 — без лимита) и последний пройденный порог в процентах
+    traffic_quota = Column(BigInteger, default=0)
+    quota_level = Column(Integer, default=0)
+
+    @property
+    def profile(self):
+        """Данные VLESS-профиля в формате generate_vless_url (None, если профиля нет)"""
+        if not self.client_id:
+            return None
+        return {
+            "client_id": self.client_id,
+            "email": self.email,
+            "port": self.port,
+            "inbound_id": self.inbound_id,
+            "security": "reality",
+            "remark": self.remark
+        }
 
 class StaticProfile(Base):
     __tablename__ = 'static_profiles'
     id = Column(Integer, primary_key=True)
-    name = Column(String)
-    vless_url = Column(String)
+    # Имя совпадает с email клиента в панели
+    name = Column(String(255), index=True)
+    vless_url = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ArchivedUser(Base):
+    """Давно истекшие пользователи без профиля, вынесенные из горячей таблицы users"""
+    __tablename__ = 'archived_users'
+    id = Column(Integer, primary_key=True)
+    telegram_id = Column(BigInteger, unique=True)
+    full_name = Column(String(255))
+    username = Column(String(64))
+    registration_date = Column(DateTime)
+    subscription_end = Column(DateTime)
+    is_admin = Column(Boolean, default=False)
+    notified = Column(Boolean, default=False)
+    # Ссылка-подписка и лимит тарифа возвращаются вместе с пользователем
+    sub_id = Column(String(64))
+    traffic_quota = Column(BigInteger, default=0)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+ARCHIVE_COLUMNS = (
+    "telegram_id", "full_name", "username", "registration_date", "subscription_end", "is_admin", "notified",
+    "sub_id", "traffic_quota"
+)
+
+class PanelOutbox(Base):
+    """Изменения в панели 3X-UI, записанные в одной транзакции с изменением пользователя"""
+    __tablename__ = 'panel_outbox'
+    id = Column(Integer, primary_key=True)
+    operation = Column(String(32))  # create_client | delete_client | update_expiry | set_quota | disable_client | set_sub_id
+    telegram_id = Column(BigInteger, index=True)
+    payload = Column(Text)
+    # Ключ ожидающей работы (expiry:<telegram_id> и т.п.): повторный запрос той же работы
+    # не добавляет строку, а отмечается в requested_at. Снимается при завершении операции
+    idempotency_key = Column(String(255), unique=True)
+    requested_at = Column(DateTime)
+    status = Column(String(16), default="pending", index=True)  # pending | done | failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime)
 
-engine = create_engine('sqlite:///users.db', echo=False)
+def _create_engine(url: str):
+    """Создает движок БД с настройками пула из конфига"""
+    url = make_url(url)
+    kwargs = {"echo": False, "pool_pre_ping": config.DB_POOL_PRE_PING}
+    if url.get_backend_name() == "sqlite":
+        # Соединения используются из разных потоков (бот, админ-панель, to_thread)
+        # timeout драйвера выставляет busy_timeout соединения, отдельная PRAGMA не нужна
+        kwargs["connect_args"] = {"check_same_thread": False, "timeout": config.DB_BUSY_TIMEOUT}
+    if url.database not in (None, "", ":memory:"):
+        kwargs.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_recycle=config.DB_POOL_RECYCLE
+        )
+    return create_engine(url, **kwargs)
+
+engine = _create_engine(config.DATABASE_URL)
 Session = sessionmaker(bind=engine)
 
+IS_SQLITE = engine.dialect.name == "sqlite"
+SUPPORTS_RETURNING = engine.dialect.insert_returning
+
+if IS_SQLITE:
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL позволяет читать во время записи
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+class MetricsSnapshot(Base):
+    """Периодический снимок метрик бота для страницы мониторинга админ-панели"""
+    __tablename__ = 'metrics_snapshots'
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    total_users = Column(Integer)
+    active_users = Column(Integer)
+    expired_users = Column(Integer)
+    expiring_24h = Column(Integer)
+    expiring_7d = Column(Integer)
+    online_users = Column(Integer)
+    panel_latency_ms = Column(Float)
+    loop_lag_ms = Column(Float)
+    cpu_percent = Column(Float)
+    rss_mb = Column(Float)
+
+class DailyStats(Base):
+    """Агрегаты по дням (регистрации), обновляются фоновой задачей"""
+    __tablename__ = 'daily_stats'
+    day = Column(Date, primary_key=True)
+    signups = Column(Integer, default=0)
+
+class Payment(Base):
+    """Успешные платежи; уникальный charge id делает зачисление идемпотентным"""
+    __tablename__ = 'payments'
+    id = Column(Integer, primary_key=True)
+    charge_id = Column(String(255), unique=True, nullable=False)
+    provider_charge_id = Column(String(255))
+    telegram_id = Column(BigInteger, index=True)
+    months = Column(Integer)
+    amount = Column(Integer)  # в минимальных единицах валюты (копейки)
+    currency = Column(String(8))
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class RevenueRollup(Base):
+    """Выручка по дням и месяцам, пополняется в транзакции платежа"""
+    __tablename__ = 'revenue_rollups'
+    period = Column(String(8), primary_key=True)  # day | month
+    period_start = Column(Date, primary_key=True)
+    currency = Column(String(8), primary_key=True)
+    payments = Column(Integer, default=0)
+    amount = Column(Integer, default=0)
+
+@event.listens_for(Session, "before_flush")
+def _enqueue_expiry_updates(session, flush_context, instances):
+    # Любое изменение срока через ORM попадает в outbox в той же транзакции
+    for obj in list(session.dirty):
+        if isinstance(obj, User) and obj.client_id and inspect(obj).attrs.subscription_end.history.has_changes():
+            _enqueue(session, "update_expiry", obj.telegram_id, f"expiry:{obj.telegram_id}")
+
+def _dialect_insert(model):
+    """Возвращает INSERT с поддержкой upsert для текущего диалекта (или None)"""
+    name = engine.dialect.name
+    if name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert(model)
+
+def upsert(session, model, rows: list, index_elements: list, update_columns: list, increment_columns: list = ()):
+    """Пакетная вставка/обновление строк одним запросом (ON CONFLICT / ON DUPLICATE KEY).
+    increment_columns при конфликте прибавляются к текущим значениям"""
+    if not rows:
+        return
+    stmt = _dialect_insert(model)
+    if stmt is None:
+        # Диалект без upsert: построчный merge через ORM
+        for row in rows:
+            existing = session.get(model, tuple(row[col] for col in index_elements)) if increment_columns else None
+            if existing is not None:
+                row = {**row, **{col: (getattr(existing, col) or 0) + row[col] for col in increment_columns}}
+            session.merge(model(**row))
+        return
+    table = model.__table__
+    if engine.dialect.name in ("mysql", "mariadb"):
+        if update_columns or increment_columns:
+            stmt = stmt.on_duplicate_key_update({
+                **{col: stmt.inserted[col] for col in update_columns},
+                **{col: table.c[col] + stmt.inserted[col] for col in increment_columns}
+            })
+        else:
+            stmt = stmt.prefix_with("IGNORE")
+    elif update_columns or increment_columns:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={
+                **{col: stmt.excluded[col] for col in update_columns},
+                **{col: table.c[col] + stmt.excluded[col] for col in increment_columns}
+            }
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+    session.execute(stmt, rows)
+
+def _outbox_merge(stmt):
+    """INSERT в outbox, который при совпадении ключа с ожидающей операцией
+    только обновляет requested_at (upsert поверх INSERT ... SELECT тоже)"""
+    if engine.dialect.name in ("mysql", "mariadb"):
+        return stmt.on_duplicate_key_update(requested_at=stmt.inserted.requested_at)
+    return stmt.on_conflict_do_update(
+        index_elements=["idempotency_key"], set_={"requested_at": stmt.excluded.requested_at}
+    )
+
+def _enqueue(session, operation: str, telegram_id, key: str, payload: dict = None):
+    """Ставит операцию в outbox с детерминированным ключом ожидающей работы.
+    Если такая работа уже ждет (или выполняется), новая строка не добавляется:
+    отметка requested_at не дает воркеру закрыть операцию, начатую до запроса"""
+    stmt = _dialect_insert(PanelOutbox)
+    row = {
+        "operation": operation, "telegram_id": telegram_id, "idempotency_key": key,
+        "payload": json.dumps(payload) if payload is not None else None, "requested_at": datetime.utcnow()
+    }
+    if stmt is None:
+        if not session.scalar(select(PanelOutbox.id).where(PanelOutbox.idempotency_key == key)):
+            session.add(PanelOutbox(**row))
+        return
+    session.execute(_outbox_merge(stmt), row)
+
+def insert_returning_ids(session, model, rows: list) -> list:
+    """Вставляет строки и возвращает их первичные ключи (RETURNING, если диалект умеет)"""
+    if not rows:
+        return []
+    if SUPPORTS_RETURNING:
+        result = session.execute(insert(model).returning(model.id, sort_by_parameter_order=True), rows)
+        return list(result.scalars())
+    return [session.execute(insert(model), row).inserted_primary_key[0] for row in rows]
+
+PROFILE_COLUMNS = ("client_id", "email", "port", "inbound_id", "remark", "qr_file_id", "qr_key")
+
 async def init_db():
     Base.metadata.create_all(engine)
+    _migrate_schema()
+    _backfill_sub_ids()
     logger.info("✅ Database tables created")
 
+def _backfill_sub_ids():
+    """Выдает sub_id клиентам, созданным до появления подписок, и ставит в outbox
+    сверку subId в панели: без нее ссылки-подписки этих клиентов не работают"""
+    with Session() as session:
+        missing = session.scalars(
+            select(User.id).where(User.client_id.isnot(None), User.sub_id.is_(None))
+        ).all()
+        if missing:
+            session.execute(update(User), [{"id": user_id, "sub_id": new_sub_id()} for user_id in missing])
+            logger.info(f"✅ Assigned sub_id to {len(missing)} existing clients")
+        # Сверка идемпотентна и стоит одного запроса к панели, поэтому ставится при каждом старте
+        _enqueue(session, "set_sub_id", None, "sub_id:all")
+        session.commit()
+
+# Колонки, оставшиеся от прежних версий схемы: expiry_synced заменен outbox изменений панели
+OBSOLETE_COLUMNS = {"users": ("expiry_synced",)}
+
+def _drop_obsolete_columns(inspector):
+    for table_name, columns in OBSOLETE_COLUMNS.items():
+        existing = {column["name"] for column in inspector.get_columns(table_name)}
+        for column in columns:
+            if column not in existing:
+                continue
+            try:
+                with engine.begin() as conn:
+                    # Индекс по колонке мешает DROP COLUMN в SQLite
+                    for index in inspector.get_indexes(table_name):
+                        if column in index["column_names"]:
+                            on_table = f" ON {table_name}" if engine.dialect.name in ("mysql", "mariadb") else ""
+                            conn.execute(text(f"DROP INDEX {index['name']}{on_table}"))
+                    conn.execute(text(f"ALTER TABLE {table_name} DROP COLUMN {column}"))
+                logger.info(f"✅ Dropped obsolete column {table_name}.{column}")
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to drop obsolete column {table_name}.{column}: {e}")
+
+def _widen_integer_columns(inspector):
+    """INTEGER -> BIGINT для колонок, ставших BigInteger (telegram_id уже больше 2^31).
+    В SQLite INTEGER и так 64-битный, менять нечего"""
+    if IS_SQLITE:
+        return
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        current = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            stored = current.get(column.name)
+            if not isinstance(column.type, BigInteger) or stored is None or isinstance(stored, BigInteger):
+                continue
+            if not isinstance(stored, Integer):
+                continue
+            if engine.dialect.name in ("mysql", "mariadb"):
+                statement = f"ALTER TABLE {table.name} MODIFY {column.name} BIGINT"
+            else:
+                statement = f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT"
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(statement))
+                logger.info(f"✅ Widened {table.name}.{column.name} to BIGINT")
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to widen {table.name}.{column.name} to BIGINT: {e}")
+
+def _migrate_schema():
+    """Доводит существующие таблицы до текущих моделей: create_all не добавляет колонки и индексы"""
+    inspector = inspect(engine)
+    _drop_obsolete_columns(inspector)
+    _widen_integer_columns(inspector)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"✅ Added column {table.name}.{column.name}")
+
+    _migrate_profile_data()
+
+    # Индексы создаются после переноса данных, чтобы уникальность email проверялась один раз
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def _migrate_profile_data(batch_size: int = 1000):
+    """Переносит JSON из vless_profile_data в отдельные колонки пакетами по id"""
+    migrated = skipped = 0
+    last_id = 0
+    with Session() as session:
+        emails = set(session.scalars(select(User.email).where(User.email.isnot(None))))
+        while True:
+            rows = session.execute(
+                select(User.id, User.vless_profile_data)
+                .where(User.id > last_id, User.vless_profile_data.isnot(None), User.client_id.is_(None))
+                .order_by(User.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            updates = []
+            for row in rows:
+                try:
+                    profile = json.loads(row.vless_profile_data)
+                    client_id, email = profile["client_id"], profile["email"]
+                except Exception:
+                    profile = email = None
+                if email is None or email in emails:
+                    # Непереносимый профиль очищается, чтобы не разбирать его при каждом старте;
+                    # исходное значение остается в логе
+                    reason = "Duplicate profile email" if email else "Invalid profile data"
+                    logger.warning(f"⚠️ {reason} for user row {row.id}, cleared: {row.vless_profile_data}")
+                    updates.append({"id": row.id, "vless_profile_data": None})
+                    skipped += 1
+                    continue
+                emails.add(email)
+                updates.append({
+                    "id": row.id,
+                    "client_id": client_id,
+                    "email": email,
+                    "port": profile.get("port"),
+                    "inbound_id": profile.get("inbound_id", config.INBOUND_ID),
+                    "remark": profile.get("remark"),
+                    "vless_profile_data": None
+                })
+            if updates:
+                session.execute(update(User), updates)
+                session.commit()
+                migrated += len(updates)
+
+    if migrated:
+        logger.info(f"✅ Migrated {migrated - skipped} profiles from vless_profile_data to columns, {skipped} cleared")
+
 async def get_user(telegram_id: int):
     with Session() as session:
-        return session.query(User).filter_by(telegram_id=telegram_id).first()
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if user is None:
+            # Вернувшийся пользователь прозрачно восстанавливается из архива
+            user = _restore_archived_user(session, telegram_id)
+        return user
+
+def _restore_archived_user(session, telegram_id: int):
+    archived = session.query(ArchivedUser).filter_by(telegram_id=telegram_id).first()
+    if archived is None:
+        return None
+    user = User(**{column: getattr(archived, column) for column in ARCHIVE_COLUMNS})
+    session.add(user)
+    session.delete(archived)
+    session.commit()
+    session.refresh(user)
+    logger.info(f"✅ User restored from archive: {telegram_id}")
+    return user
+
+def restore_archived_users(session, telegram_ids: list) -> int:
+    """Пакетно возвращает пользователей из архива в users, возвращает их число.
+    Вызывается перед любым upsert в users в обход get_user, иначе в архиве
+    остается устаревший двойник пользователя"""
+    condition = ArchivedUser.telegram_id.in_(telegram_ids)
+    restored = session.execute(
+        insert(User).from_select(
+            ARCHIVE_COLUMNS, select(*[getattr(ArchivedUser, column) for column in ARCHIVE_COLUMNS]).where(condition)
+        )
+    ).rowcount
+    if restored:
+        session.execute(delete(ArchivedUser).where(condition))
+    return restored
+
+def archive_expired_users(older_than: timedelta, batch_size: int = 1000) -> int:
+    """Переносит пользователей, истекших раньше older_than и без клиента в панели, в archived_users"""
+    cutoff = datetime.utcnow() - older_than
+    archived = 0
+    while True:
+        with Session() as session:
+            ids = session.scalars(
+                select(User.id)
+                .where(
+                    User.subscription_end < cutoff,
+                    User.client_id.is_(None),
+                    or_(User.is_admin.is_(None), User.is_admin == False)
+                )
+                .order_by(User.id)
+                .limit(batch_size)
+            ).all()
+            if not ids:
+                break
+            # Двойник в архиве (пользователь был создан заново в обход get_user) устарел:
+            # строка users новее, она и архивируется
+            session.execute(delete(ArchivedUser).where(
+                ArchivedUser.telegram_id.in_(select(User.telegram_id).where(User.id.in_(ids)))
+            ))
+            session.execute(
+                insert(ArchivedUser).from_select(
+                    ARCHIVE_COLUMNS + ("archived_at",),
+                    select(*[getattr(User, column) for column in ARCHIVE_COLUMNS], literal(datetime.utcnow(), DateTime))
+                    .where(User.id.in_(ids))
+                )
+            )
+            session.execute(delete(User).where(User.id.in_(ids)))
+            session.commit()
+            archived += len(ids)
+    if archived:
+        logger.info(f"✅ Archived {archived} expired users")
+    return archived
+
+async def get_user_by_email(email: str):
+    """Поиск владельца клиента панели по email (индексированный запрос)"""
+    with Session() as session:
+        return session.query(User).filter_by(email=email).first()
+
+async def get_user_by_client_id(client_id: str):
+    """Поиск владельца клиента панели по UUID клиента (индексированный запрос)"""
+    with Session() as session:
+        return session.query(User).filter_by(client_id=client_id).first()
+
+async def get_user_by_sub_id(sub_id: str):
+    """Данные для ссылки-подписки по sub_id (индексированный запрос)"""
+    with Session() as session:
+        return session.execute(
+            select(
+                User.client_id, User.email, User.port, User.inbound_id, User.remark,
+                User.subscription_end, User.traffic_quota
+            ).where(User.sub_id == sub_id)
+        ).first()
+
+def new_sub_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+async def assign_sub_id(telegram_id: int):
+    """Выдает sub_id пользователю, у которого его еще нет, и возвращает актуальный.
+    Существующему клиенту панели новый subId передается через outbox"""
+    with Session() as session:
+        assigned = session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.sub_id.is_(None))
+            .values(sub_id=new_sub_id())
+        ).rowcount
+        if assigned and session.scalar(select(User.client_id).where(User.telegram_id == telegram_id)):
+            _enqueue(session, "set_sub_id", telegram_id, f"sub_id:{telegram_id}")
+        session.commit()
+        return session.scalar(select(User.sub_id).where(User.telegram_id == telegram_id))
+
+async def request_profile(telegram_id: int):
+    """Резервирует client_id/email и ставит создание клиента в outbox одной транзакцией.
+    Возвращает id операции создания (новой или уже ожидающей) либо None"""
+    with Session() as session:
+        client_id = str(uuid.uuid4())
+        email = f"user_{telegram_id}_{random.randint(1000,9999)}"
+        reserved = session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.client_id.is_(None))
+            .values(
+                client_id=client_id, email=email, inbound_id=config.INBOUND_ID,
+                sub_id=func.coalesce(User.sub_id, new_sub_id())
+            )
+        ).rowcount
+        if not reserved:
+            # Профиль уже создается (или создан): возвращаем ожидающую операцию
+            return session.scalar(
+                select(PanelOutbox.id)
+                .where(
+                    PanelOutbox.telegram_id == telegram_id,
+                    PanelOutbox.operation == "create_client",
+                    PanelOutbox.status == "pending"
+                )
+                .order_by(PanelOutbox.id.desc())
+            )
+        operation = PanelOutbox(
+            operation="create_client",
+            telegram_id=telegram_id,
+            payload=json.dumps({"client_id": client_id, "email": email}),
+            idempotency_key=f"create:{client_id}"
+        )
+        session.add(operation)
+        session.commit()
+        return operation.id
+
+def _enqueue_client_deletion(session, telegram_id, client_id, email):
+    _enqueue(session, "delete_client", telegram_id, f"delete:{client_id or email}",
+             {"client_id": client_id, "email": email})
+
+async def expire_profile(telegram_id: int):
+    """Очищает профиль пользователя и ставит удаление клиента в outbox одной транзакцией"""
+    with Session() as session:
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if not user or not user.email:
+            return False
+        _enqueue_client_deletion(session, telegram_id, user.client_id, user.email)
+        for column in PROFILE_COLUMNS:
+            setattr(user, column, None)
+        user.notified = False
+        session.commit()
+        return True
+
+async def save_qr_file_id(telegram_id: int, client_id: str, file_id: str, qr_key: str):
+    """Запоминает file_id QR-кода и хэш его ссылки, если профиль за время загрузки не сменился"""
+    with Session() as session:
+        session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.client_id == client_id)
+            .values(qr_file_id=file_id, qr_key=qr_key)
+        )
+        session.commit()
+
+def _shift_datetime(column, seconds: int):
+    """Сдвиг даты на seconds средствами SQL текущего диалекта"""
+    name = engine.dialect.name
+    if name == "sqlite":
+        return func.datetime(column, f"{seconds:+d} seconds")
+    if name in ("mysql", "mariadb"):
+        return func.timestampadd(text("SECOND"), seconds, column)
+    return column + timedelta(seconds=seconds)
+
+def _bulk_target_filter(target: str, now: datetime, expired_days: int = None, telegram_ids: list = None):
+    if target == "active":
+        return User.subscription_end > now
+    if target == "expired":
+        return (User.subscription_end <= now) & (User.subscription_end > now - timedelta(days=expired_days))
+    if target == "list":
+        return User.telegram_id.in_(telegram_ids)
+    raise ValueError(f"Unknown bulk target: {target}")
+
+async def bulk_adjust_subscriptions(target: str, seconds: int, expired_days: int = None,
+                                    telegram_ids: list = None, chunk_size: int = 5000):
+    """Массово сдвигает subscription_end одним UPDATE (для списков — по chunk_size id).
+    Логика как у одиночного изменения: начисление к активной подписке добавляется к сроку,
+    к истекшей — от текущего момента; списание не уводит срок в прошлое.
+    Обновление expiryTime в панели ставится в outbox той же транзакцией.
+    Пользователи списка из архива при начислении восстанавливаются, при списании
+    не меняются (срок у них уже истек).
+    Возвращает (изменено пользователей, поставлено обновлений панели, найдено в архиве)"""
+    now = datetime.utcnow()
+    shifted = _shift_datetime(User.subscription_end, seconds)
+    if seconds >= 0:
+        new_end = case((User.subscription_end > now, shifted), else_=_shift_datetime(literal(now, DateTime), seconds))
+    else:
+        new_end = case((shifted < now, literal(now, DateTime)), else_=shifted)
+    
+    chunks = [telegram_ids[i:i + chunk_size] for i in range(0, len(telegram_ids), chunk_size)] if target == "list" else [None]
+    updated = queued = archived = 0
+    with Session() as session:
+        for chunk in chunks:
+            if chunk:
+                if seconds > 0:
+                    archived += restore_archived_users(session, chunk)
+                else:
+                    archived += session.scalar(
+                        select(func.count(ArchivedUser.id)).where(ArchivedUser.telegram_id.in_(chunk))
+                    )
+            condition = _bulk_target_filter(target, now, expired_days, chunk)
+            # Сначала outbox: после UPDATE фильтр по сроку уже может не совпасть
+            key = literal("expiry:") + cast(User.telegram_id, String)
+            targets = select(literal("update_expiry"), User.telegram_id, key, literal(now, DateTime)).where(
+                condition, User.client_id.isnot(None)
+            )
+            stmt = _dialect_insert(PanelOutbox)
+            if stmt is None:
+                stmt = insert(PanelOutbox)
+                targets = targets.where(~select(PanelOutbox.id).where(PanelOutbox.idempotency_key == key).exists())
+            else:
+                stmt = _outbox_merge(stmt)
+            queued += session.execute(
+                stmt.from_select(["operation", "telegram_id", "idempotency_key", "requested_at"], targets)
+            ).rowcount
+            updated += session.execute(
+                update(User)
+                .where(condition, User.subscription_end.isnot(None))
+                .values(subscription_end=new_end, notified=False)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        session.commit()
+    logger.info(f"✅ Bulk subscription change {seconds:+d}s for {target}: {updated} users, {queued} panel updates queued, "
+                f"{archived} archived")
+    return updated, queued, archived
+
+async def get_users_to_notify():
+    """telegram_id пользователей, у которых подписка истекает в ближайшие 24 часа и еще не уведомленных"""
+    now = datetime.utcnow()
+    with Session() as session:
+        return session.scalars(select(User.telegram_id).where(
+            User.subscription_end > now,
+            User.subscription_end < now + timedelta(days=1),
+            or_(User.notified.is_(None), User.notified == False)
+        )).all()
+
+async def mark_notified(telegram_id: int):
+    with Session() as session:
+        session.query(User).filter_by(telegram_id=telegram_id).update({User.notified: True})
+        session.commit()
+
+async def get_expired_profiles():
+    """telegram_id пользователей с истекшей подпиской, у которых еще остался клиент в панели"""
+    with Session() as session:
+        return session.scalars(select(User.telegram_id).where(
+            User.subscription_end <= datetime.utcnow(),
+            User.email.isnot(None)
+        )).all()
 
 async def create_user(telegram_id: int, full_name: str, username: str = None, is_admin: bool = False):
     with Session() as session:
@@ -52,60 +684,489 @@ async def create_user(telegram_id: int, full_name: str, username: str = None, is
         logger.info(f"✅ New user created: {telegram_id}")
         return user
 
-async def delete_user_profile(telegram_id: int):
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        if user:
-            user.vless_profile_data = None
-            user.notified = False
-            session.commit()
-            logger.info(f"✅ User profile deleted: {telegram_id}")
+def _extend_subscription(session, user: User, months: int):
+    now = datetime.utcnow()
+    # Если подписка активна, добавляем к текущей дате окончания
+    if user.subscription_end > now:
+        user.subscription_end += timedelta(days=months * 30)
+    else:
+        # Если подписка истекла, начинаем с текущей даты
+        user.subscription_end = now + timedelta(days=months * 30)
+    
+    # Сбрасываем флаг уведомления
+    user.notified = False
+    
+    # Новый период начинается с лимитом тарифа и обнуленным счетчиком трафика
+    quota = config.traffic_quota(months)
+    if user.client_id and (quota or user.traffic_quota):
+        _enqueue(session, "set_quota", user.telegram_id, f"quota:{user.telegram_id}")
+    user.traffic_quota = quota
+    user.quota_level = 0
 
 async def update_subscription(telegram_id: int, months: int):
     """Обновляет подписку с учетом текущего состояния"""
     with Session() as session:
         user = session.query(User).filter_by(telegram_id=telegram_id).first()
         if user:
-            now = datetime.utcnow()
-            # Если подписка активна, добавляем к текущей дате окончания
-            if user.subscription_end > now:
-                user.subscription_end += timedelta(days=months * 30)
-            else:
-                # Если подписка истекла, начинаем с текущей даты
-                user.subscription_end = now + timedelta(days=months * 30)
-            
-            # Сбрасываем флаг уведомления
-            user.notified = False
+            _extend_subscription(session, user, months)
             session.commit()
             logger.info(f"✅ Subscription updated for {telegram_id}: +{months} months")
             return True
         return False
 
-async def get_all_users(with_subscription: bool = None):
+async def record_payment(telegram_id: int, months: int, charge_id: str, provider_charge_id: str,
+                         amount: int, currency: str):
+    """Записывает платеж, продлевает подписку и пополняет агрегаты выручки одной транзакцией.
+    Возвращает 'credited', 'duplicate' (charge id уже учтен) или None (пользователь не найден)"""
     with Session() as session:
-        query = session.query(User)
-        if with_subscription is not None:
-            if with_subscription:
-                query = query.filter(User.subscription_end > datetime.utcnow())
-            else:
-                query = query.filter(User.subscription_end <= datetime.utcnow())
-        return query.all()
+        if session.scalar(select(Payment.id).where(Payment.charge_id == charge_id)):
+            return "duplicate"
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if not user:
+            return None
+        
+        now = datetime.utcnow()
+        try:
+            session.add(Payment(
+                charge_id=charge_id, provider_charge_id=provider_charge_id, telegram_id=telegram_id,
+                months=months, amount=amount, currency=currency, created_at=now
+            ))
+            # Платеж вставляется первым: дубликат charge_id отсекается до продления и агрегатов
+            session.flush()
+            _extend_subscription(session, user, months)
+            upsert(session, RevenueRollup, [
+                {"period": "day", "period_start": now.date(), "currency": currency, "payments": 1, "amount": amount},
+                {"period": "month", "period_start": now.date().replace(day=1), "currency": currency, "payments": 1, "amount": amount},
+            ], index_elements=["period", "period_start", "currency"], update_columns=[], increment_columns=["payments", "amount"])
+            session.commit()
+        except IntegrityError:
+            # Параллельная доставка того же платежа успела раньше
+            session.rollback()
+            return "duplicate"
+    logger.info(f"✅ Payment {charge_id} credited for {telegram_id}: +{months} months, {amount / 100:.2f} {currency}")
+    return "credited"
+
+async def get_revenue(period: str, since):
+    """Выручка из агрегатов: [(period_start, currency, payments, amount)] по возрастанию даты"""
+    with Session() as session:
+        return session.execute(
+            select(RevenueRollup.period_start, RevenueRollup.currency, RevenueRollup.payments, RevenueRollup.amount)
+            .where(RevenueRollup.period == period, RevenueRollup.period_start >= since)
+            .order_by(RevenueRollup.period_start)
+        ).all()
+
+def _subscription_filter(query, with_subscription: bool = None):
+    if with_subscription is None:
+        return query
+    if with_subscription:
+        return query.where(User.subscription_end > datetime.utcnow())
+    return query.where(User.subscription_end <= datetime.utcnow())
+
+async def get_user_ids(with_subscription: bool = None, include_archived: bool = False) -> list:
+    """telegram_id пользователей (цели рассылки) без загрузки ORM-объектов.
+    include_archived добавляет архивных (их подписка всегда истекла) ко всем и к без подписки"""
+    with Session() as session:
+        telegram_ids = session.scalars(_subscription_filter(select(User.telegram_id), with_subscription)).all()
+        if include_archived and with_subscription is not True:
+            telegram_ids += session.scalars(select(ArchivedUser.telegram_id)).all()
+        return telegram_ids
 
-async def create_static_profile(name: str, vless_url: str):
+def iter_user_rows(with_subscription: bool = None, batch_size: int = 5000):
+    """Потоково отдает строки для списков пользователей (telegram_id, full_name, username, subscription_end)"""
     with Session() as session:
-        profile = StaticProfile(name=name, vless_url=vless_url)
-        session.add(profile)
+        result = session.execute(
+            _subscription_filter(
+                select(User.telegram_id, User.full_name, User.username, User.subscription_end),
+                with_subscription
+            ).execution_options(yield_per=batch_size)
+        )
+        for row in result:
+            yield row
+
+async def create_static_profiles(profiles: list) -> list:
+    """Сохраняет статические профили [(name, vless_url)] одной транзакцией, возвращает их id"""
+    with Session() as session:
+        ids = insert_returning_ids(session, StaticProfile, [
+            {"name": name, "vless_url": vless_url} for name, vless_url in profiles
+        ])
         session.commit()
-        logger.info(f"✅ Static profile created: {name}")
-        return profile
+    logger.info(f"✅ Static profiles created: {', '.join(name for name, _ in profiles)}")
+    return ids
 
 async def get_static_profiles():
     with Session() as session:
         return session.query(StaticProfile).all()
 
+async def find_static_profile_names(names: list) -> set:
+    """Имена из списка, уже занятые статическими профилями"""
+    with Session() as session:
+        return set(session.scalars(select(StaticProfile.name).where(StaticProfile.name.in_(names))))
+
+async def delete_static_profiles(profile_ids: list) -> int:
+    """Удаляет статические профили и ставит удаление их клиентов в outbox одной транзакцией.
+    Outbox удалит всех клиентов одним обновлением инбаунда. Возвращает число удаленных"""
+    with Session() as session:
+        names = session.scalars(select(StaticProfile.name).where(StaticProfile.id.in_(profile_ids))).all()
+        session.execute(delete(StaticProfile).where(StaticProfile.id.in_(profile_ids)))
+        for name in names:
+            _enqueue_client_deletion(session, None, None, name)
+        session.commit()
+        return len(names)
+
+USER_SORT_COLUMNS = {
+    "registration_date": User.registration_date,
+    "subscription_end": User.subscription_end,
+    "telegram_id": User.telegram_id,
+    "full_name": User.full_name,
+}
+
+def get_users_page(search: str = "", status: str = "all", admins_only: bool = False,
+                   sort: str = "registration_date", descending: bool = True,
+                   limit: int = 50, offset: int = 0):
+    """Страница пользователей для админ-панели: фильтры, сортировка и пагинация в SQL.
+    Возвращает (список словарей, общее число подходящих строк)"""
+    now = datetime.utcnow()
+    filters = []
+    if search:
+        pattern = f"%{search.strip().lstrip('@')}%"
+        condition = or_(User.full_name.ilike(pattern), User.username.ilike(pattern), User.email.ilike(pattern))
+        if search.strip().isdigit():
+            condition = or_(condition, User.telegram_id == int(search.strip()))
+        filters.append(condition)
+    if status == "active":
+        filters.append(User.subscription_end > now)
+    elif status == "expired":
+        filters.append(or_(User.subscription_end <= now, User.subscription_end.is_(None)))
+    if admins_only:
+        filters.append(User.is_admin == True)
+
+    order = USER_SORT_COLUMNS.get(sort, User.registration_date)
+    with Session() as session:
+        total = session.scalar(select(func.count(User.id)).where(*filters))
+        rows = session.execute(
+            select(
+                User.id, User.telegram_id, User.full_name, User.username,
+                User.registration_date, User.subscription_end, User.is_admin, User.email
+            )
+            .where(*filters)
+            .order_by(order.desc() if descending else order.asc(), User.id)
+            .limit(limit)
+            .offset(offset)
+        ).mappings().all()
+        return [dict(row) for row in rows], total
+
+def update_users(changes: dict):
+    """Применяет правки админ-панели {id: {колонка: значение}} через ORM (с outbox сроков)"""
+    editable = {"full_name", "username", "subscription_end", "is_admin"}
+    with Session() as session:
+        for user in session.query(User).filter(User.id.in_(list(changes))):
+            for column, value in changes[user.id].items():
+                if column in editable:
+                    setattr(user, column, value)
+        session.commit()
+
+def set_admin_flag(ids: list, is_admin: bool):
+    with Session() as session:
+        session.query(User).filter(User.id.in_(ids)).update({User.is_admin: is_admin}, synchronize_session=False)
+        session.commit()
+
+def delete_users(ids: list):
+    """Удаляет пользователей; их клиенты удаляются из панели через outbox в той же транзакции"""
+    with Session() as session:
+        for user in session.query(User).filter(User.id.in_(ids)):
+            if user.email:
+                _enqueue_client_deletion(session, user.telegram_id, user.client_id, user.email)
+            session.delete(user)
+        session.commit()
+
+def iter_profiles(batch_size: int = 5000):
+    """Потоково отдает профили пользователей (telegram_id, client_id, email, port, subscription_end,
+    traffic_quota, quota_level, sub_id)"""
+    with Session() as session:
+        result = session.execute(
+            select(
+                User.telegram_id, User.client_id, User.email, User.port, User.subscription_end,
+                User.traffic_quota, User.quota_level, User.sub_id
+            )
+            .where(User.email.isnot(None))
+            .execution_options(yield_per=batch_size)
+        )
+        for row in result:
+            yield row
+
+IMPORT_UPDATE_COLUMNS = ["client_id", "email", "port", "inbound_id", "remark", "subscription_end", "traffic_quota", "sub_id"]
+
+def import_users_batch(rows: list) -> tuple:
+    """Upsert пакета клиентов панели в users одной транзакцией.
+    Пользователь, у которого уже есть другой профиль, и email, занятый другим
+    пользователем (в БД или раньше в этом же пакете), не перезаписываются.
+    subId клиента из панели сохраняется (иначе сверка subId при старте сломала бы
+    выданные панелью ссылки-подписки); новый выдается, только если subId пуст
+    или уже принадлежит другому пользователю. Возвращает (импортировано, конфликтов)"""
+    with Session() as session:
+        telegram_ids = [row["telegram_id"] for row in rows]
+        emails = [row["email"] for row in rows]
+        restore_archived_users(session, telegram_ids)
+        profiles = {
+            telegram_id: (client_id, sub_id)
+            for telegram_id, client_id, sub_id in session.execute(
+                select(User.telegram_id, User.client_id, User.sub_id).where(User.telegram_id.in_(telegram_ids))
+            )
+        }
+        email_owners = dict(session.execute(
+            select(User.email, User.telegram_id).where(User.email.in_(emails))
+        ).all())
+        sub_owners = dict(session.execute(
+            select(User.sub_id, User.telegram_id).where(User.sub_id.in_([row["sub_id"] for row in rows if row.get("sub_id")]))
+        ).all())
+
+        accepted, seen, seen_emails, seen_sub_ids, conflicts, new_sub_ids = [], set(), set(), set(), 0, 0
+        for row in rows:
+            telegram_id = row["telegram_id"]
+            current, current_sub_id = profiles.get(telegram_id, (None, None))
+            if (
+                telegram_id in seen
+                or row["email"] in seen_emails
+                or current not in (None, row["client_id"])
+                or email_owners.get(row["email"], telegram_id) != telegram_id
+            ):
+                conflicts += 1
+                continue
+            seen.add(telegram_id)
+            seen_emails.add(row["email"])
+            sub_id = row.get("sub_id")
+            if sub_id and (sub_id in seen_sub_ids or sub_owners.get(sub_id, telegram_id) != telegram_id):
+                # Общий subId нескольких клиентов панели: в БД он уникален
+                new_sub_ids += 1
+                sub_id = None
+            sub_id = sub_id or current_sub_id or new_sub_id()
+            seen_sub_ids.add(sub_id)
+            accepted.append({
+                **row,
+                "full_name": row["email"],
+                "registration_date": datetime.utcnow(),
+                "is_admin": False,
+                "notified": False,
+                "quota_level": 0,
+                "sub_id": sub_id,
+            })
+
+        if new_sub_ids:
+            logger.warning(f"⚠️ {new_sub_ids} imported clients share a subId with another user and get a new one")
+        upsert(session, User, accepted, ["telegram_id"], IMPORT_UPDATE_COLUMNS)
+        session.commit()
+        return len(accepted), conflicts
+
 async def get_user_stats():
     with Session() as session:
         total = session.query(func.count(User.id)).scalar()
         with_sub = session.query(func.count(User.id)).filter(User.subscription_end > datetime.utcnow()).scalar()
         without_sub = total - with_sub
-        return total, with_sub, without_sub
\ No newline at end of file
+        return total, with_sub, without_sub
+async def get_outbox_batch(limit: int, after_id: int = 0):
+    """Ожидающие операции outbox в порядке записи, начиная после after_id"""
+    with Session() as session:
+        return session.query(PanelOutbox).filter(
+            PanelOutbox.status == "pending", PanelOutbox.id > after_id
+        ).order_by(PanelOutbox.id).limit(limit).all()
+
+def count_pending_outbox():
+    with Session() as session:
+        return session.scalar(select(func.count(PanelOutbox.id)).where(PanelOutbox.status == "pending"))
+
+async def complete_outbox(ids: list, started_at: datetime = None):
+    """Закрывает выполненные операции. Операция, запрошенная повторно после started_at
+    (начала выполнения), остается в очереди и выполнится еще раз"""
+    with Session() as session:
+        query = session.query(PanelOutbox).filter(PanelOutbox.id.in_(ids))
+        if started_at is not None:
+            query = query.filter(or_(PanelOutbox.requested_at.is_(None), PanelOutbox.requested_at <= started_at))
+        query.update(
+            {PanelOutbox.status: "done", PanelOutbox.processed_at: datetime.utcnow(), PanelOutbox.idempotency_key: None},
+            synchronize_session=False
+        )
+        session.commit()
+
+async def retry_outbox(ids: list, error: str, max_attempts: int):
+    """Откладывает повтор операций с экспоненциальной задержкой, возвращает id окончательно неудачных"""
+    failed = []
+    now = datetime.utcnow()
+    with Session() as session:
+        for operation in session.query(PanelOutbox).filter(PanelOutbox.id.in_(ids)):
+            operation.attempts = (operation.attempts or 0) + 1
+            operation.last_error = error
+            if operation.attempts >= max_attempts:
+                operation.status = "failed"
+                operation.processed_at = now
+                operation.idempotency_key = None
+                failed.append(operation.id)
+            else:
+                operation.next_attempt_at = now + timedelta(seconds=min(5 * 2 ** operation.attempts, 3600))
+        session.commit()
+    return failed
+
+async def prune_outbox(older_than: timedelta):
+    """Удаляет выполненные операции старше указанного срока"""
+    with Session() as session:
+        deleted = session.query(PanelOutbox).filter(
+            PanelOutbox.status == "done",
+            PanelOutbox.processed_at < datetime.utcnow() - older_than
+        ).delete(synchronize_session=False)
+        session.commit()
+        return deleted
+
+async def get_profiles_for_create(telegram_ids: list):
+    with Session() as session:
+        return session.execute(
+            select(User.telegram_id, User.client_id, User.email, User.subscription_end, User.traffic_quota, User.sub_id)
+            .where(User.telegram_id.in_(telegram_ids), User.client_id.isnot(None))
+        ).all()
+
+async def activate_profiles(client_ids: list, port: int, remark: str):
+    """Завершает создание профилей: заполняет параметры инбаунда"""
+    with Session() as session:
+        session.query(User).filter(User.client_id.in_(client_ids)).update(
+            {User.port: port, User.remark: remark},
+            synchronize_session=False
+        )
+        session.commit()
+
+async def release_profiles(client_ids: list):
+    """Снимает резерв профилей, которые не удалось создать в панели"""
+    with Session() as session:
+        session.query(User).filter(User.client_id.in_(client_ids)).update(
+            {getattr(User, column): None for column in PROFILE_COLUMNS},
+            synchronize_session=False
+        )
+        session.commit()
+
+async def get_expiry_targets(telegram_ids: list):
+    """Актуальные сроки клиентов для пакетного обновления expiryTime"""
+    with Session() as session:
+        return session.execute(
+            select(User.email, User.subscription_end)
+            .where(User.telegram_id.in_(telegram_ids), User.email.isnot(None), User.subscription_end.isnot(None))
+        ).all()
+
+async def get_sub_id_targets(telegram_ids=None):
+    """subId клиентов для сверки с панелью {email: sub_id} (всех, если telegram_ids не задан)"""
+    query = select(User.email, User.sub_id).where(User.email.isnot(None), User.sub_id.isnot(None))
+    if telegram_ids is not None:
+        query = query.where(User.telegram_id.in_(telegram_ids))
+    with Session() as session:
+        return dict(session.execute(query).all())
+
+async def get_quota_targets(telegram_ids: list):
+    """Текущие лимиты трафика клиентов для операции set_quota"""
+    with Session() as session:
+        return session.execute(
+            select(User.telegram_id, User.email, User.traffic_quota, User.subscription_end)
+            .where(User.telegram_id.in_(telegram_ids), User.email.isnot(None))
+        ).all()
+
+async def get_quota_snapshot():
+    """Клиенты с лимитом трафика, еще не достигшие 100%: колонки (id, telegram_id, email, quota, level)"""
+    with Session() as session:
+        rows = session.execute(
+            select(User.id, User.telegram_id, User.email, User.traffic_quota, User.quota_level)
+            .where(
+                User.traffic_quota > 0, User.email.isnot(None),
+                User.subscription_end > datetime.utcnow(), User.quota_level < 100
+            )
+        ).all()
+    return tuple(map(list, zip(*rows))) if rows else ([], [], [], [], [])
+
+async def set_quota_levels(levels: list, disable: list):
+    """Сохраняет пройденные пороги [{id, quota_level}] и ставит отключение
+    исчерпавших лимит клиентов [(telegram_id, email)] в outbox одной транзакцией"""
+    with Session() as session:
+        if levels:
+            session.execute(update(User), levels)
+        for telegram_id, email in disable:
+            _enqueue(session, "disable_client", telegram_id, f"disable:{telegram_id}", {"email": email})
+        session.commit()
+
+def collect_user_counts():
+    """Счетчики пользователей для снимка метрик (диапазонные запросы по индексу subscription_end)"""
+    now = datetime.utcnow()
+    active_in = lambda delta: select(func.count(User.id)).where(
+        User.subscription_end > now, User.subscription_end <= now + delta
+    )
+    with Session() as session:
+        total = session.scalar(select(func.count(User.id)))
+        active = session.scalar(select(func.count(User.id)).where(User.subscription_end > now))
+        return {
+            "total_users": total,
+            "active_users": active,
+            "expired_users": total - active,
+            "expiring_24h": session.scalar(active_in(timedelta(days=1))),
+            "expiring_7d": session.scalar(active_in(timedelta(days=7))),
+        }
+
+def _as_date(value):
+    # func.date в SQLite возвращает строку
+    return datetime.strptime(value, "%Y-%m-%d").date() if isinstance(value, str) else value
+
+def _backfill_revenue(session):
+    """Строит агрегаты выручки по всем платежам (если агрегатов еще нет)"""
+    day = func.date(Payment.created_at)
+    rows = session.execute(
+        select(day, Payment.currency, func.count(Payment.id), func.sum(Payment.amount)).group_by(day, Payment.currency)
+    ).all()
+    rollups = {}
+    for d, currency, payments, amount in rows:
+        d = _as_date(d)
+        for period, start in (("day", d), ("month", d.replace(day=1))):
+            entry = rollups.setdefault((period, start, currency), [0, 0])
+            entry[0] += payments
+            entry[1] += amount or 0
+    upsert(session, RevenueRollup, [
+        {"period": period, "period_start": start, "currency": currency, "payments": payments, "amount": amount}
+        for (period, start, currency), (payments, amount) in rollups.items()
+    ], index_elements=["period", "period_start", "currency"], update_columns=["payments", "amount"])
+    return len(rows)
+
+def record_metrics(snapshot: dict, rollup_days: int = 2):
+    """Сохраняет снимок и пересчитывает регистрации за последние дни.
+    Пока агрегаты пусты (первый запуск), они строятся по всей истории"""
+    day = func.date(User.registration_date)
+    with Session() as session:
+        session.add(MetricsSnapshot(**snapshot))
+        query = select(day, func.count(User.id)).group_by(day)
+        backfill = session.scalar(select(func.count()).select_from(DailyStats)) == 0
+        if not backfill:
+            since = datetime.utcnow().date() - timedelta(days=rollup_days - 1)
+            query = query.where(User.registration_date >= datetime.combine(since, datetime.min.time()))
+        signups = session.execute(query).all()
+        upsert(session, DailyStats, [
+            {"day": _as_date(d), "signups": count} for d, count in signups if d is not None
+        ], index_elements=["day"], update_columns=["signups"])
+        if backfill:
+            logger.info(f"✅ Daily signups backfilled for {len(signups)} days")
+        if not session.scalar(select(func.count()).select_from(RevenueRollup)):
+            if _backfill_revenue(session):
+                logger.info("✅ Revenue rollups backfilled from payments")
+        session.commit()
+
+def get_metrics(since: datetime, max_points: int = 1000):
+    """Снимки метрик за окно, прореженные в SQL до max_points строк"""
+    with Session() as session:
+        query = select(MetricsSnapshot).where(MetricsSnapshot.created_at >= since)
+        count = session.scalar(select(func.count(MetricsSnapshot.id)).where(MetricsSnapshot.created_at >= since))
+        step = max(1, count // max_points)
+        if step > 1:
+            query = query.where(MetricsSnapshot.id % step == 0)
+        return session.scalars(query.order_by(MetricsSnapshot.created_at)).all()
+
+def get_daily_signups(since):
+    with Session() as session:
+        return session.execute(
+            select(DailyStats.day, DailyStats.signups).where(DailyStats.day >= since).order_by(DailyStats.day)
+        ).all()
+
+def prune_metrics(older_than: timedelta):
+    with Session() as session:
+        session.query(MetricsSnapshot).filter(
+            MetricsSnapshot.created_at < datetime.utcnow() - older_than
+        ).delete(synchronize_session=False)
+        session.commit()
@@ -1,14 +1,158 @@
 import aiohttp
-import uuid
+import asyncio
 import json
+import re
+import time
+import uuid
 import logging
-import random
 from config import config
+from datetime import datetime, timezone
 from urllib.parse import urljoin
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 
 logger = logging.getLogger(__name__)
 
+# Список возможных префиксов API в разных версиях панелей
+API_PREFIXES = ["/api/inbounds", "/panel/api/inbounds", "/xui/API/inbounds"]
+# POST-запросы, которые только читают данные и безопасны для повтора
+IDEMPOTENT_POSTS = {"/onlines"}
+
+class PanelUnavailable(Exception):
+    """Circuit breaker открыт: запрос к панели не выполняется"""
+
+class PanelServerError(Exception):
+    """Панель ответила 5xx"""
+
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, PanelServerError)
+
+class CircuitBreaker:
+    """closed -> (N ошибок подряд) -> open -> (reset_timeout) -> half_open -> пробный запрос:
+    успех закрывает, ошибка снова открывает"""
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == "open"
+
+    def retry_after(self) -> float:
+        """Сколько секунд до пробного запроса (0, если breaker не открыт)"""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("✅ Panel is reachable again, circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"⚠️ Panel unavailable after {self.failures} failures, circuit opened")
+            self.opened_at = time.monotonic()
+
+panel_breaker = CircuitBreaker(config.PANEL_BREAKER_FAILURES, config.PANEL_BREAKER_RESET)
+
+def to_panel_time(dt: datetime) -> int:
+    """Переводит naive UTC datetime из БД в expiryTime панели (мс)"""
+    return int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def build_client(client_id: str, email: str, telegram_id, expiry: datetime, traffic_quota: int = 0,
+                 sub_id: str = None, enable: bool = True) -> dict:
+    """Описание клиента VLESS Reality для API панели (enable=False — исчерпавший лимит)"""
+    return {
+        "id": client_id,
+        "flow": "",
+        "email": email,
+        "limitIp": 0,
+        # Несмотря на название, панель хранит лимит в байтах и сама отключает превысивших
+        "totalGB": traffic_quota or 0,
+        # Срок клиента в панели совпадает с subscription_end в БД бота
+        "expiryTime": to_panel_time(expiry) if expiry else 0,
+        "enable": enable,
+        "tgId": str(telegram_id or ""),
+        "subId": sub_id or "",
+        "reset": 0,
+        "fingerprint": config.REALITY_FINGERPRINT,
+        "publicKey": config.REALITY_PUBLIC_KEY,
+        "shortId": config.REALITY_SHORT_ID.split(',')[0],
+        "spiderX": config.REALITY_SPIDER_X
+    }
+
+def client_usage(inbound: dict) -> dict:
+    """Израсходованный трафик клиентов инбаунда {email: байты} из clientStats"""
+    return {
+        stat["email"]: stat.get("up", 0) + stat.get("down", 0)
+        for stat in inbound.get("clientStats") or []
+    }
+
+# Последний прочитанный из панели трафик {email: (up, down)} для заголовка подписки
+_traffic_snapshot = {}
+
+def client_traffic(email: str) -> tuple:
+    """(отдано, получено) клиента по последнему проходу контроля трафика"""
+    return _traffic_snapshot.get(email, (0, 0))
+
+_CLIENTS_START = re.compile(r'"clients"\s*:\s*\[')
+_CLIENTS_SEPARATOR = re.compile(r'[\s,]*')
+
+def iter_clients(settings: str):
+    """Клиенты из JSON settings инбаунда по одному, без построения всего списка"""
+    match = _CLIENTS_START.search(settings)
+    if not match:
+        return
+    decoder = json.JSONDecoder()
+    pos = match.end()
+    while True:
+        pos = _CLIENTS_SEPARATOR.match(settings, pos).end()
+        if pos >= len(settings) or settings[pos] == "]":
+            return
+        client, pos = decoder.raw_decode(settings, pos)
+        yield client
+
+def build_inbound_update(inbound: dict, settings: dict) -> dict:
+    """Тело запроса /update для инбаунда с новыми settings"""
+    return {
+        "up": inbound["up"], "down": inbound["down"], "total": inbound["total"],
+        "remark": inbound["remark"], "enable": inbound["enable"], "expiryTime": inbound["expiryTime"],
+        "listen": inbound["listen"], "port": inbound["port"], "protocol": inbound["protocol"],
+        "settings": json.dumps(settings, indent=2),
+        "streamSettings": inbound["streamSettings"],
+        "sniffing": inbound["sniffing"]
+    }
+
 class XUIAPI:
+    # Рабочий префикс API, подтвержденный успешным ответом (общий для экземпляров)
+    api_prefix = None
+    # Чтение-изменение-запись инбаунда (общая для экземпляров, см. _mutate_clients)
+    _inbound_lock = asyncio.Lock()
+
     def __init__(self):
         self.session = None
         self.cookie_jar = aiohttp.CookieJar(unsafe=True)
@@ -22,13 +166,49 @@ class XUIAPI:
         else:
             self.full_base_url = self.api_url
 
+    async def _call(self, method: str, url: str, read: bool, **kwargs):
+        """Один HTTP-запрос через circuit breaker с таймаутом операции.
+        Идемпотентные запросы повторяются с джиттером. Возвращает (статус, текст)"""
+        timeout = aiohttp.ClientTimeout(total=config.PANEL_READ_TIMEOUT if read else config.PANEL_WRITE_TIMEOUT)
+        
+        async def attempt():
+            if not panel_breaker.allow():
+                raise PanelUnavailable()
+            try:
+                async with self.session.request(method, url, ssl=False, timeout=timeout, **kwargs) as resp:
+                    if resp.status >= 500:
+                        raise PanelServerError(f"HTTP {resp.status}")
+                    result = resp.status, await resp.text()
+            except RETRYABLE_ERRORS:
+                panel_breaker.record_failure()
+                raise
+            except BaseException:
+                # Отмена и прочие ошибки не говорят о здоровье панели, но освобождают пробу
+                panel_breaker.probe_in_flight = False
+                raise
+            panel_breaker.record_success()
+            return result
+        
+        if not read:
+            return await attempt()
+        async for retry in AsyncRetrying(
+            stop=stop_after_attempt(config.PANEL_READ_RETRIES),
+            wait=wait_random_exponential(multiplier=0.2, max=2),
+            retry=retry_if_exception_type(RETRYABLE_ERRORS),
+            reraise=True
+        ):
+            with retry:
+                return await attempt()
+
     async def login(self):
         """Аутентификация в 3x-UI API"""
         try:
-            self.session = aiohttp.ClientSession(
-                cookie_jar=self.cookie_jar,
-                trust_env=True
-            )
+            # Повторный вход в рамках одного экземпляра переиспользует сессию
+            if self.session is None or self.session.closed:
+                self.session = aiohttp.ClientSession(
+                    cookie_jar=self.cookie_jar,
+                    trust_env=True
+                )
             
             auth_data = {
                 "username": config.XUI_USERNAME,
@@ -38,121 +218,235 @@ class XUIAPI:
             login_url = f"{self.full_base_url.rstrip('/')}/login"
             logger.info(f"ℹ️ Trying login to {login_url} with user: {config.XUI_USERNAME}")
             
-            async with self.session.post(login_url, data=auth_data, ssl=False) as resp:
-                if resp.status != 200:
-                    logger.error(f"🛑 Login failed with status: {resp.status}")
-                    return False
-                
-                try:
-                    response = await resp.json()
-                    if response.get("success"):
-                        logger.info("✅ Login successful")
-                        return True
-                    else:
-                        logger.error(f"🛑 Login failed: {response.get('msg')}")
-                        return False
-                except:
-                    text = await resp.text()
-                    if "success" in text.lower():
-                        logger.info("✅ Login successful (text response)")
-                        return True
+            status, text = await self._call("POST", login_url, read=True, data=auth_data)
+            if status != 200:
+                logger.error(f"🛑 Login failed with status: {status}")
+                return False
+            
+            try:
+                response = json.loads(text)
+                if response.get("success"):
+                    logger.info("✅ Login successful")
+                    return True
+                else:
+                    logger.error(f"🛑 Login failed: {response.get('msg')}")
                     return False
+            except ValueError:
+                if "success" in text.lower():
+                    logger.info("✅ Login successful (text response)")
+                    return True
+                return False
+        except PanelUnavailable:
+            return False
         except Exception as e:
-            logger.exception(f"🛑 Login error: {e}")
+            logger.error(f"🛑 Login error: {e!r}")
             return False
 
     async def _request(self, method, path, **kwargs):
-        """Универсальный метод запроса с перебором путей API"""
-        # Список возможных префиксов API в разных версиях панелей
-        prefixes = ["/api/inbounds", "/panel/api/inbounds", "/xui/API/inbounds"]
+        """Запрос к API панели. Пути API перебираются только до первого найденного,
+        сетевая ошибка или таймаут сразу завершают запрос (и учитываются breaker'ом).
+        Префикс запоминается только по успешному ответу API; если запомненный
+        префикс начал отвечать 404 (панель обновили), он сбрасывается и перебор
+        начинается заново"""
+        read = method == "GET" or path in IDEMPOTENT_POSTS
+        cached = XUIAPI.api_prefix
+        prefixes = [cached] + [p for p in API_PREFIXES if p != cached] if cached else API_PREFIXES
         
         for prefix in prefixes:
             url = f"{self.full_base_url.rstrip('/')}{prefix}{path}"
             try:
-                if method == "GET":
-                    async with self.session.get(url, ssl=False, **kwargs) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            if data.get("success"):
-                                return data.get("obj")
-                elif method == "POST":
-                    async with self.session.post(url, ssl=False, **kwargs) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            if data.get("success"):
-                                return data.get("obj") if "get" in path else True
-            except Exception:
+                status, text = await self._call(method, url, read, **kwargs)
+            except PanelUnavailable:
+                return None
+            except Exception as e:
+                logger.warning(f"⚠️ Panel request {method} {path} failed: {e!r}")
+                return None
+            
+            if status == 404:
+                if prefix == XUIAPI.api_prefix:
+                    logger.warning(f"⚠️ Panel API prefix {prefix!r} returned 404, probing again")
+                    XUIAPI.api_prefix = None
                 continue
+            try:
+                data = json.loads(text) if status == 200 else None
+            except ValueError:
+                data = None
+            # 401/403, страница логина или success=false не подтверждают, что путь верный
+            if isinstance(data, dict) and data.get("success"):
+                XUIAPI.api_prefix = prefix
+                return data.get("obj") if read else True
+            return None
         return None
 
     async def get_inbound(self, inbound_id: int):
         """Получение данных инбаунда"""
         return await self._request("GET", f"/get/{inbound_id}")
 
+    async def get_clients(self):
+        """Все клиенты инбаунда бота (None при ошибке)"""
+        if not await self.login():
+            return None
+        inbound = await self.get_inbound(config.INBOUND_ID)
+        if not inbound:
+            return None
+        return json.loads(inbound["settings"]).get("clients", [])
+
     async def update_inbound(self, inbound_id: int, data: dict):
         """Обновление инбаунда"""
         return await self._request("POST", f"/update/{inbound_id}", json=data)
 
-    async def create_vless_profile(self, telegram_id: int):
+    async def _mutate_clients(self, action: str, mutate):
+        """Общий шаг изменения клиентов инбаунда: чтение инбаунда, mutate(inbound, settings)
+        -> (изменены ли settings, результат) и запись /update, если settings изменены.
+        Все изменения инбаунда процесса идут под одной блокировкой: иначе запрос,
+        попавший между чтением и /update другого изменения, был бы молча затерт.
+        Возвращает результат mutate или None при ошибке"""
+        async with XUIAPI._inbound_lock:
+            if not await self.login():
+                return None
+            
+            inbound = await self.get_inbound(config.INBOUND_ID)
+            if not inbound: return None
+            
+            try:
+                settings = json.loads(inbound["settings"])
+                changed, result = await mutate(inbound, settings)
+                if changed and not await self.update_inbound(config.INBOUND_ID, build_inbound_update(inbound, settings)):
+                    return None
+                return result
+            except Exception as e:
+                logger.exception(f"🛑 {action} error: {e}")
+                return None
+
+    async def _add_clients_request(self, clients: list) -> bool:
+        payload = {"id": config.INBOUND_ID, "settings": json.dumps({"clients": clients})}
+        return bool(await self._request("POST", "/addClient", json=payload))
+
+    async def add_clients(self, clients: list):
+        """Добавляет клиентов одним вызовом addClient. Клиенты, уже существующие в панели
+        (повтор после потерянного ответа), пропускаются. Возвращает данные инбаунда"""
+        async def mutate(inbound, settings):
+            existing = {client.get("id") for client in settings.get("clients", [])}
+            new_clients = [client for client in clients if client["id"] not in existing]
+            if new_clients and not await self._add_clients_request(new_clients):
+                return False, None
+            return False, inbound
+        return await self._mutate_clients("Add clients", mutate)
+
+    async def create_static_clients(self, names: list):
+        """Создает общих клиентов без срока и лимита (email = имя профиля) одним вызовом addClient.
+        Возвращает данные профилей для generate_vless_url; None при ошибке или занятом имени"""
+        async def mutate(inbound, settings):
+            taken = {client.get("email") for client in settings.get("clients", [])}.intersection(names)
+            if taken:
+                logger.warning(f"⚠️ Clients already exist in panel: {', '.join(sorted(taken))}")
+                return False, None
+            clients = [build_client(str(uuid.uuid4()), name, None, None) for name in names]
+            if not await self._add_clients_request(clients):
+                return False, None
+            return False, [
+                {"client_id": client["id"], "email": client["email"], "port": inbound["port"], "remark": inbound["remark"]}
+                for client in clients
+            ]
+        return await self._mutate_clients("Create static clients", mutate)
+
+    async def delete_clients(self, client_ids=(), emails=()):
+        """Удаляет клиентов по UUID или email одним обновлением инбаунда.
+        Отсутствующие в панели клиенты считаются уже удаленными"""
+        client_ids, emails = set(client_ids), set(emails)
+        async def mutate(inbound, settings):
+            clients = settings.get("clients", [])
+            remaining = [c for c in clients if c.get("id") not in client_ids and c.get("email") not in emails]
+            settings["clients"] = remaining
+            return len(remaining) != len(clients), True
+        return await self._mutate_clients("Delete clients", mutate)
+
+    async def update_clients_expiry(self, expiries: dict):
+        """Пакетно выставляет expiryTime клиентам {email: мс} одним обновлением инбаунда.
+        Возвращает множество email, найденных в панели и обновленных"""
+        async def mutate(inbound, settings):
+            now_ms = to_panel_time(datetime.utcnow())
+            usage = client_usage(inbound)
+            updated = set()
+            for client in settings.get("clients", []):
+                expiry_time = expiries.get(client.get("email"))
+                if expiry_time is not None:
+                    updated.add(client["email"])
+                    if client.get("expiryTime") != expiry_time:
+                        client["expiryTime"] = expiry_time
+                        # Продленный клиент мог быть отключен панелью по старому сроку,
+                        # но не включаем исчерпавшего лимит трафика
+                        quota = client.get("totalGB") or 0
+                        if expiry_time > now_ms and (not quota or usage.get(client["email"], 0) < quota):
+                            client["enable"] = True
+            return bool(updated), updated
+        return await self._mutate_clients("Update expiry", mutate)
+
+    async def set_clients_sub_id(self, sub_ids: dict):
+        """Выставляет subId клиентам {email: sub_id} одним обновлением инбаунда (только отличающиеся).
+        Возвращает число обновленных клиентов или None при ошибке"""
+        async def mutate(inbound, settings):
+            changed = 0
+            for client in settings.get("clients", []):
+                sub_id = sub_ids.get(client.get("email"))
+                if sub_id and client.get("subId") != sub_id:
+                    client["subId"] = sub_id
+                    changed += 1
+            return bool(changed), changed
+        return await self._mutate_clients("Set subId", mutate)
+
+    async def get_client_traffic(self):
+        """Расход трафика всех клиентов инбаунда одним запросом {email: байты} (None при ошибке)"""
         if not await self.login():
             return None
-        
         inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound: return None
-        
-        try:
-            import time
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            client_id = str(uuid.uuid4())
-            email = f"user_{telegram_id}_{random.randint(1000,9999)}"
-            
-            # Установка срока: текущее время + 3 дня в миллисекундах
-            # 3 дня = 3 * 24 * 60 * 60 * 1000 = 259,200,000 мс
-            expire_at = int((time.time() + (3 * 24 * 60 * 60)) * 1000)
-            
-            new_client = {
-                "id": client_id,
-                "flow": "",
-                "email": email,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": expire_at, # Теперь не 0, а +3 дня
-                "enable": True,
-                "tgId": str(telegram_id),
-                "subId": "",
-                "reset": 0,
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID.split(',')[0],
-                "spiderX": config.REALITY_SPIDER_X
-            }
-            
-            clients.append(new_client)
-            settings["clients"] = clients
-            
-            update_data = {
-                "up": inbound["up"], "down": inbound["down"], "total": inbound["total"],
-                "remark": inbound["remark"], "enable": inbound["enable"], "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"], "port": inbound["port"], "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"]
-            }
-            
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": email,
-                    "port": inbound["port"],
-                    "security": "reality",
-                    "remark": inbound["remark"]
-                }
+        if not inbound:
             return None
-        except Exception as e:
-            logger.exception(f"🛑 Create profile error: {e}")
+        global _traffic_snapshot
+        _traffic_snapshot = {
+            stat["email"]: (stat.get("up", 0), stat.get("down", 0))
+            for stat in inbound.get("clientStats") or []
+        }
+        return client_usage(inbound)
+
+    async def set_clients_quota(self, quotas: dict):
+        """Выставляет лимиты {email: (байты, включить)} одним обновлением инбаунда
+        и обнуляет счетчики трафика этих клиентов. Обнуление не идемпотентно, поэтому
+        выполняется для всех клиентов даже после ошибки одного. Возвращает множество
+        email, для которых обнуление не удалось (пустое при успехе), или None, если
+        не удалось обновить инбаунд"""
+        async def mutate(inbound, settings):
+            updated = set()
+            for client in settings.get("clients", []):
+                if client.get("email") in quotas:
+                    client["totalGB"], client["enable"] = quotas[client["email"]]
+                    updated.add(client["email"])
+            return bool(updated), updated
+        updated = await self._mutate_clients("Set quota", mutate)
+        if updated is None:
             return None
+        
+        failed = set()
+        for email in updated:
+            try:
+                if not await self._request("POST", f"/{config.INBOUND_ID}/resetClientTraffic/{email}"):
+                    failed.add(email)
+            except Exception as e:
+                logger.error(f"🛑 Reset traffic error for {email}: {e}")
+                failed.add(email)
+        return failed
+
+    async def disable_clients(self, emails):
+        """Отключает клиентов по email одним обновлением инбаунда"""
+        emails = set(emails)
+        async def mutate(inbound, settings):
+            changed = False
+            for client in settings.get("clients", []):
+                if client.get("email") in emails and client.get("enable", True):
+                    client["enable"] = False
+                    changed = True
+            return changed, True
+        return await self._mutate_clients("Disable clients", mutate)
 
     async def get_user_stats(self, email: str):
         if not await self.login(): return {"upload": 0, "download": 0}
@@ -161,6 +455,14 @@ class XUIAPI:
             return {"upload": res.get("up", 0), "download": res.get("down", 0)}
         return {"upload": 0, "download": 0}
 
+    async def get_global_stats(self, inbound_id: int):
+        """Суммарный трафик инбаунда"""
+        if not await self.login(): return {"upload": 0, "download": 0}
+        inbound = await self.get_inbound(inbound_id)
+        if inbound:
+            return {"upload": inbound.get("up", 0), "download": inbound.get("down", 0)}
+        return {"upload": 0, "download": 0}
+
     async def get_online_users(self):
         if not await self.login(): return 0
         res = await self._request("POST", "/onlines")
@@ -174,19 +476,49 @@ class XUIAPI:
 
 # Функции-обертки
 # Исправленные обертки для вызова функций из handlers.py
-async def create_vless_profile(telegram_id: int):
+async def add_clients(clients: list):
+    api = XUIAPI()
+    try: return await api.add_clients(clients)
+    finally: await api.close()
+
+async def delete_clients(client_ids=(), emails=()):
+    api = XUIAPI()
+    try: return await api.delete_clients(client_ids, emails)
+    finally: await api.close()
+
+async def update_clients_expiry(expiries: dict):
+    api = XUIAPI()
+    try: return await api.update_clients_expiry(expiries)
+    finally: await api.close()
+
+async def set_clients_sub_id(sub_ids: dict):
+    api = XUIAPI()
+    try: return await api.set_clients_sub_id(sub_ids)
+    finally: await api.close()
+
+async def get_client_traffic():
+    api = XUIAPI()
+    try: return await api.get_client_traffic()
+    finally: await api.close()
+
+async def set_clients_quota(quotas: dict):
+    api = XUIAPI()
+    try: return await api.set_clients_quota(quotas)
+    finally: await api.close()
+
+async def disable_clients(emails):
     api = XUIAPI()
-    try: return await api.create_vless_profile(telegram_id)
+    try: return await api.disable_clients(emails)
     finally: await api.close()
 
-async def create_static_client(profile_name: str):
+async def create_static_clients(names: list):
     api = XUIAPI()
-    try: return await api.create_static_client(profile_name)
+    try: return await api.create_static_clients(names)
     finally: await api.close()
 
 async def delete_client_by_email(email: str):
     api = XUIAPI()
-    try: return await api.delete_client(email)
+    try: return await api.delete_clients(emails=[email])
     finally: await api.close()
 
 async def get_global_stats():
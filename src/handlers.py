@@ -1,26 +1,44 @@
 import asyncio
 import logging
-import json
+import re
 from datetime import datetime, timedelta
 from aiogram import Dispatcher, Router, F, Bot
-from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
+from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery, FSInputFile
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from config import config
 from database import (
-    StaticProfile, get_user, create_user, update_subscription, 
-    get_all_users, create_static_profile, get_static_profiles, 
-    User, Session, get_user_stats as db_user_stats
+    get_user, create_user, 
+    get_user_ids, iter_user_rows, create_static_profiles, get_static_profiles, find_static_profile_names, 
+    User, Session, get_user_stats as db_user_stats, request_profile, delete_static_profiles,
+    bulk_adjust_subscriptions, save_qr_file_id, assign_sub_id, record_payment, get_revenue
+)
+from panel_sync import request_panel_sync, wait_for_operation
+from qr import get_qr_path, qr_key
+from subscription import subscription_url
+from middlewares import CallbackThrottleMiddleware, AdminOnlyMiddleware, in_flight
+from outgoing import send_priority, PRIORITY_NOTIFY, PRIORITY_BULK
+from screens import screens, MENU_TEXT, HELP_TEXT, CONNECT_TEXT
+from functions import (
+    generate_vless_url, get_user_stats, create_static_clients, delete_clients, get_global_stats, get_online_users, panel_breaker
 )
-from functions import create_vless_profile, delete_client_by_email, generate_vless_url, get_user_stats, create_static_client, get_global_stats, get_online_users
 
 logger = logging.getLogger(__name__)
 
 router = Router()
+# Обработчики админ-меню: права проверяются middleware до каждого шага
+admin_router = Router()
+admin_router.message.middleware(AdminOnlyMiddleware())
+admin_router.callback_query.middleware(AdminOnlyMiddleware())
 
 MAX_MESSAGE_LENGTH = 4096
+PROFILE_WAIT_TIMEOUT = 15
+PANEL_UNAVAILABLE_TEXT = "⚠️ Сервер временно недоступен, попробуйте через минуту"
+# Рассылка отправляется пачками параллельных запросов
+BROADCAST_CHUNK = 100
 
 class AdminStates(StatesGroup):
     ADD_TIME = State()
@@ -32,6 +50,9 @@ class AdminStates(StatesGroup):
     ADD_TIME_AMOUNT = State()
     REMOVE_TIME_AMOUNT = State()
     SEND_MESSAGE_TARGET = State()
+    BULK_TIME_DAYS = State()
+    BULK_TIME_IDS = State()
+    BULK_TIME_AMOUNT = State()
 
 def split_text(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     """Разбивает текст на части указанной максимальной длины"""
@@ -57,26 +78,15 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
     if not user:
         return
     
-    status = "Активна" if user.subscription_end > datetime.utcnow() else "Истекла"
-    expire_date = user.subscription_end.strftime("%d-%m-%Y %H:%M") if status == "Активна" else status
+    active = user.subscription_end > datetime.utcnow()
+    status = "Активна" if active else "Истекла"
+    expire_date = user.subscription_end.strftime("%d-%m-%Y %H:%M") if active else status
     
-    text = (
-        f"**Имя профиля**: `{user.full_name}`\n"
-        f"**Id**: `{user.telegram_id}`\n"
-        f"**Подписка**: `{status}`\n"
-        f"**Дата окончания подписки**: `{expire_date}`"
+    text = MENU_TEXT.format(
+        full_name=user.full_name, telegram_id=user.telegram_id, status=status, expire_date=expire_date
     )
-    
-    builder = InlineKeyboardBuilder()
-    builder.button(text="💵 Продлить" if status=="Активна" else "💵 Оплатить", callback_data="renew_sub")
-    builder.button(text="✅ Подключить", callback_data="connect")
-    builder.button(text="📊 Статистика", callback_data="stats")
-    builder.button(text="ℹ️ Помощь", callback_data="help")
-    
-    if user.is_admin:
-        builder.button(text="⚠️ Админ. меню", callback_data="admin_menu")
-    
-    builder.adjust(2, 2, 1)
+    # Клавиатура меню строится заранее для каждой пары (подписка активна, админ)
+    keyboard = screens.main_menu[(active, bool(user.is_admin))]
     
     if message_id:
         # Редактируем существующее сообщение
@@ -84,7 +94,7 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
             chat_id=chat_id,
             message_id=message_id,
             text=text,
-            reply_markup=builder.as_markup(),
+            reply_markup=keyboard,
             parse_mode='Markdown'
         )
     else:
@@ -92,7 +102,7 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
         await bot.send_message(
             chat_id=chat_id,
             text=text,
-            reply_markup=builder.as_markup(),
+            reply_markup=keyboard,
             parse_mode='Markdown'
         )
 
@@ -158,38 +168,14 @@ async def menu_cmd(message: Message, bot: Bot):
 @router.callback_query(F.data == "help")
 async def help_msg(callback: CallbackQuery):
     await callback.answer()
-    builder = InlineKeyboardBuilder()
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    text = (
-        f"О боте:\n"
-        "<b>Разработчик:</b>\n"
-        "@Redulum\n"
-        "<a href=''>Официальный чат проекта появится позже</a>"
-    )
-    await callback.message.answer(text, parse_mode='HTML', reply_markup=builder.as_markup())
+    await callback.message.answer(HELP_TEXT, parse_mode='HTML', reply_markup=screens.back_to_menu)
 
 @router.callback_query(F.data == "renew_sub")
 async def renew_subscription(callback: CallbackQuery):
-    builder = InlineKeyboardBuilder()
-    
-    # Добавляем кнопки для каждого варианта подписки
-    for months in sorted(config.PRICES.keys()):
-        price_info = config.PRICES[months]
-        final_price = config.calculate_price(months)
-        
-        discount_text = ""
-        if price_info["discount_percent"] > 0:
-            discount_text = f" (-{price_info['discount_percent']}%)"
-            
-        button_text = f"{months} мес. - {final_price} руб.{discount_text}"
-        builder.button(text=button_text, callback_data=f"pay_{months}")
-    
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    builder.adjust(1)
-    
+    # Таблица тарифов с ценами считается один раз в screens
     await callback.message.edit_text(
         "💵 **Выберите период подписки:**",
-        reply_markup=builder.as_markup(),
+        reply_markup=screens.prices,
         parse_mode='Markdown'
     )
 
@@ -249,8 +235,20 @@ async def process_successful_payment(message: Message, bot: Bot):
             now = datetime.utcnow()
             action_type = "продлена" if user.subscription_end > now else "куплена"
             
-            # Обновляем подписку
-            success = await update_subscription(message.from_user.id, months)
+            # Платеж, продление и выручка фиксируются одной транзакцией по charge id
+            payment = message.successful_payment
+            result = await record_payment(
+                message.from_user.id, months,
+                charge_id=payment.telegram_payment_charge_id,
+                provider_charge_id=payment.provider_payment_charge_id,
+                amount=payment.total_amount,
+                currency=payment.currency
+            )
+            if result == "duplicate":
+                await message.answer("✅ Этот платеж уже учтен, подписка продлена ранее.")
+                return
+            success = result == "credited"
+            request_panel_sync()
             suffix = "месяц" if months == 1 else "месяца" if months in (2,3,4) else "месяцев"
             if success:
                 await message.answer(
@@ -267,7 +265,8 @@ async def process_successful_payment(message: Message, bot: Bot):
                 
                 for admin_id in config.ADMINS:
                     try:
-                        await bot.send_message(admin_id, admin_message, parse_mode='Markdown')
+                        with send_priority(PRIORITY_NOTIFY):
+                            await bot.send_message(admin_id, admin_message, parse_mode='Markdown')
                     except Exception as e:
                         logger.error(f"🛑 Failed to send notification to admin {admin_id}: {e}")
             else:
@@ -276,42 +275,37 @@ async def process_successful_payment(message: Message, bot: Bot):
         logger.error(f"🛑 Successful payment processing error: {e}")
         await message.answer("❌ Ошибка при обработке платежа")
 
-@router.callback_query(F.data == "admin_menu")
+@admin_router.callback_query(F.data == "admin_menu")
 async def admin_menu(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    if not user or not user.is_admin:
-        await callback.answer("🛑 Доступ запрещен!")
-        return
-    
     total, with_sub, without_sub = await db_user_stats()
     online_count = await get_online_users()
     
+    state = panel_breaker.state
+    if state == "open":
+        panel_status = f"🔴 недоступна (проверка через {panel_breaker.retry_after():.0f} с)"
+    elif state == "half_open":
+        panel_status = "🟡 проверка доступности"
+    else:
+        panel_status = "🟢 доступна"
+    
     text = (
         "**Административное меню**\n\n"
         f"**Всего пользователей**: `{total}`\n"
         f"**С подпиской/Без подписки**: `{with_sub}`/`{without_sub}`\n"
-        f"**Онлайн**: `{online_count}` | **Офлайн**: `{with_sub - online_count}`"
+        f"**Онлайн**: `{online_count}` | **Офлайн**: `{with_sub - online_count}`\n"
+        f"**Панель 3X-UI**: {panel_status}"
     )
     
-    builder = InlineKeyboardBuilder()
-    builder.button(text="+ время", callback_data="admin_add_time")
-    builder.button(text="- время", callback_data="admin_remove_time")
-    builder.button(text="📋 Список пользователей", callback_data="admin_user_list")
-    builder.button(text="📊 Статистика исп. сети", callback_data="admin_network_stats")
-    builder.button(text="📢 Рассылка", callback_data="admin_send_message")
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    builder.adjust(2, 1, 1, 1, 1)
-    
-    await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='Markdown')
+    await callback.message.edit_text(text, reply_markup=screens.admin_menu, parse_mode='Markdown')
 
 # Обработчики для управления временем подписки
-@router.callback_query(F.data == "admin_add_time")
+@admin_router.callback_query(F.data == "admin_add_time")
 async def admin_add_time_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()  # Снимаем анимацию
     await callback.message.answer("Введите Telegram ID пользователя:")
     await state.set_state(AdminStates.ADD_TIME_USER)
 
-@router.message(AdminStates.ADD_TIME_USER)
+@admin_router.message(AdminStates.ADD_TIME_USER)
 async def admin_add_time_user(message: Message, state: FSMContext):
     try:
         user_id = int(message.text)
@@ -321,7 +315,7 @@ async def admin_add_time_user(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("Ошибка: ID должен быть числом")
 
-@router.message(AdminStates.ADD_TIME_AMOUNT)
+@admin_router.message(AdminStates.ADD_TIME_AMOUNT)
 async def admin_add_time_amount(message: Message, state: FSMContext):
     data = await state.get_data()
     user_id = data['user_id']
@@ -340,6 +334,8 @@ async def admin_add_time_amount(message: Message, state: FSMContext):
             minutes * 60
         )
         
+        # Пользователь из архива восстанавливается перед изменением срока
+        await get_user(user_id)
         with Session() as session:
             user = session.query(User).filter_by(telegram_id=user_id).first()
             if user:
@@ -348,6 +344,7 @@ async def admin_add_time_amount(message: Message, state: FSMContext):
                 else:
                     user.subscription_end = datetime.utcnow() + timedelta(seconds=total_seconds)
                 session.commit()
+                request_panel_sync()
                 await message.answer(f"✅ Добавлено время пользователю {user_id}")
             else:
                 await message.answer("❌ Пользователь не найден")
@@ -356,13 +353,13 @@ async def admin_add_time_amount(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-@router.callback_query(F.data == "admin_remove_time")
+@admin_router.callback_query(F.data == "admin_remove_time")
 async def admin_remove_time_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()  # Снимаем анимацию
     await callback.message.answer("Введите Telegram ID пользователя:")
     await state.set_state(AdminStates.REMOVE_TIME_USER)
 
-@router.message(AdminStates.REMOVE_TIME_USER)
+@admin_router.message(AdminStates.REMOVE_TIME_USER)
 async def admin_remove_time_user(message: Message, state: FSMContext):
     try:
         user_id = int(message.text)
@@ -372,7 +369,7 @@ async def admin_remove_time_user(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("Ошибка: ID должен быть числом")
 
-@router.message(AdminStates.REMOVE_TIME_AMOUNT)
+@admin_router.message(AdminStates.REMOVE_TIME_AMOUNT)
 async def admin_remove_time_amount(message: Message, state: FSMContext):
     data = await state.get_data()
     user_id = data['user_id']
@@ -400,6 +397,7 @@ async def admin_remove_time_amount(message: Message, state: FSMContext):
                     new_end = datetime.utcnow()
                 user.subscription_end = new_end
                 session.commit()
+                request_panel_sync()
                 await message.answer(f"✅ Удалено время у пользователя {user_id}")
             else:
                 await message.answer("❌ Пользователь не найден")
@@ -408,66 +406,225 @@ async def admin_remove_time_amount(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-# Обработчики для вывода списка пользователей
-@router.callback_query(F.data == "admin_user_list")
-async def admin_user_list(callback: CallbackQuery):
+# Выручка из агрегатов revenue_rollups (объем чтения не зависит от числа платежей)
+@admin_router.callback_query(F.data == "admin_revenue")
+async def admin_revenue(callback: CallbackQuery):
+    await callback.answer()
+    today = datetime.utcnow().date()
+    days = await get_revenue("day", today - timedelta(days=6))
+    months = await get_revenue("month", (today.replace(day=1) - timedelta(days=150)).replace(day=1))
+    
+    def format_rows(rows, date_format):
+        if not rows:
+            return "`нет платежей`\n"
+        return "".join(
+            f"`{start.strftime(date_format)}`: {amount / 100:,.0f} {currency} ({payments} шт.)\n"
+            for start, currency, payments, amount in rows
+        )
+    
+    text = (
+        "💰 **Выручка**\n\n"
+        "**За 7 дней:**\n" + format_rows(days, "%d.%m") +
+        "\n**По месяцам:**\n" + format_rows(months, "%m.%Y")
+    )
+    await callback.message.edit_text(text, reply_markup=screens.back_to_admin, parse_mode='Markdown')
+
+# Массовое изменение времени подписки
+BULK_TARGET_NAMES = {
+    "active": "все активные",
+    "expired": "истекшие за {days} дн.",
+    "list": "список из {count} ID",
+}
+
+async def ask_bulk_direction(message: Message, state: FSMContext):
+    data = await state.get_data()
+    target = BULK_TARGET_NAMES[data['bulk_target']].format(
+        days=data.get('expired_days'), count=len(data.get('telegram_ids', []))
+    )
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ С подпиской", callback_data="user_list_active")
-    builder.button(text="🛑 Без подписки", callback_data="user_list_inactive")
-    builder.button(text="⏱️ Статические профили", callback_data="static_profiles_menu")
+    builder.button(text="+ время", callback_data="bulk_dir_add")
+    builder.button(text="- время", callback_data="bulk_dir_remove")
+    builder.button(text="⬅️ Отмена", callback_data="admin_menu")
+    builder.adjust(2, 1)
+    await message.answer(f"Пользователи: {target}\nВыберите действие:", reply_markup=builder.as_markup())
+
+@admin_router.callback_query(F.data == "admin_bulk_time")
+async def admin_bulk_time_start(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ Все активные", callback_data="bulk_target_active")
+    builder.button(text="⌛ Истекшие за N дней", callback_data="bulk_target_expired")
+    builder.button(text="📋 Список ID", callback_data="bulk_target_list")
     builder.button(text="⬅️ Назад", callback_data="admin_menu")
-    builder.adjust(1, 1, 1)
-    await callback.message.edit_text("**Выберите фильтр**", reply_markup=builder.as_markup(), parse_mode='Markdown')
+    builder.adjust(1)
+    await callback.message.edit_text(
+        "**Массовое изменение времени**\n\nВыберите пользователей:",
+        reply_markup=builder.as_markup(), parse_mode='Markdown'
+    )
 
-@router.callback_query(F.data == "user_list_active")
-async def handle_user_list_active(callback: CallbackQuery):
-    users = await get_all_users(with_subscription=True)
+@admin_router.callback_query(F.data.startswith("bulk_target_"))
+async def admin_bulk_time_target(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    if not users:
-        await callback.answer("Нет пользователей с активной подпиской")
+    target = callback.data.removeprefix("bulk_target_")
+    await state.update_data(bulk_target=target)
+    
+    if target == "expired":
+        await callback.message.answer("Введите количество дней (подписка истекла не раньше):")
+        await state.set_state(AdminStates.BULK_TIME_DAYS)
+    elif target == "list":
+        await callback.message.answer("Отправьте Telegram ID через пробел/с новой строки или .txt файлом:")
+        await state.set_state(AdminStates.BULK_TIME_IDS)
+    else:
+        await ask_bulk_direction(callback.message, state)
+
+@admin_router.message(AdminStates.BULK_TIME_DAYS)
+async def admin_bulk_time_days(message: Message, state: FSMContext):
+    try:
+        days = int(message.text)
+        if days <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        await message.answer("Ошибка: количество дней должно быть положительным числом")
         return
     
-    text = "👤 <b>Пользователи с активной подпиской:</b>\n\n"
-    for user in users:
-        expire_date = user.subscription_end.strftime("%d.%m.%Y %H:%M")
-        username = f"@{user.username}" if user.username else "none"
-        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>) - до <code>{expire_date}</code>\n"
-        
-        # Если текст становится слишком длинным, отправляем текущую часть и начинаем новую
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Пользователи с активной подпиской (продолжение):</b>\n\n"
-        
-        text += user_line
+    await state.update_data(expired_days=days)
+    await state.set_state(None)
+    await ask_bulk_direction(message, state)
+
+@admin_router.message(AdminStates.BULK_TIME_IDS)
+async def admin_bulk_time_ids(message: Message, state: FSMContext, bot: Bot):
+    if message.document:
+        document = message.document
+        is_text = (document.mime_type or "").startswith("text/") or (document.file_name or "").lower().endswith((".txt", ".csv"))
+        if not is_text or (document.file_size or 0) > config.BULK_IDS_MAX_FILE_SIZE:
+            await message.answer(
+                f"Ошибка: нужен текстовый файл .txt не больше {config.BULK_IDS_MAX_FILE_SIZE // 1024} КБ"
+            )
+            return
+        file = await bot.download(document)
+        text = file.read().decode("utf-8", errors="ignore")
+    else:
+        text = message.text or ""
+    
+    telegram_ids = sorted({int(value) for value in re.findall(r"\d+", text)})
+    if not telegram_ids:
+        await message.answer("Ошибка: не найдено ни одного ID")
+        return
     
-    # Отправляем оставшуюся часть текста
-    await callback.message.answer(text, parse_mode="HTML")
+    await state.update_data(telegram_ids=telegram_ids)
+    await state.set_state(None)
+    await ask_bulk_direction(message, state)
 
-@router.callback_query(F.data == "user_list_inactive")
-async def handle_user_list_inactive(callback: CallbackQuery):
+@admin_router.callback_query(F.data.startswith("bulk_dir_"))
+async def admin_bulk_time_direction(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    users = await get_all_users(with_subscription=False)
-    if not users:
-        await callback.answer("Нет пользователей без подписки")
+    if not (await state.get_data()).get('bulk_target'):
+        await callback.message.answer("❌ Сначала выберите пользователей")
+        return
+    
+    await state.update_data(bulk_sign=1 if callback.data == "bulk_dir_add" else -1)
+    await callback.message.answer("Введите количество времени в формате:\nМесяцы Дни Часы Минуты\nПример: 1 0 0 0")
+    await state.set_state(AdminStates.BULK_TIME_AMOUNT)
+
+@admin_router.message(AdminStates.BULK_TIME_AMOUNT)
+async def admin_bulk_time_amount(message: Message, state: FSMContext):
+    data = await state.get_data()
+    parts = (message.text or "").split()
+    
+    if len(parts) != 4:
+        await message.answer("Ошибка: нужно ввести 4 числа")
         return
     
-    text = "👤 <b>Пользователи без подписки:</b>\n\n"
-    for user in users:
+    try:
+        months, days, hours, minutes = map(int, parts)
+        total_seconds = (
+            months * 30 * 24 * 60 * 60 +
+            days * 24 * 60 * 60 +
+            hours * 60 * 60 +
+            minutes * 60
+        )
+        
+        # Один UPDATE по всему набору вместо цикла по пользователям
+        updated, queued, archived = await bulk_adjust_subscriptions(
+            data['bulk_target'], data['bulk_sign'] * total_seconds,
+            expired_days=data.get('expired_days'), telegram_ids=data.get('telegram_ids')
+        )
+        if queued:
+            request_panel_sync()
+        
+        text = (
+            f"✅ {'Добавлено' if data['bulk_sign'] > 0 else 'Удалено'} время: {updated} пользователей\n"
+            f"🔄 Обновлений панели в очереди: {queued}"
+        )
+        if data['bulk_target'] == "list":
+            if data['bulk_sign'] > 0:
+                # Восстановленные из архива уже входят в число измененных
+                text += f"\n📦 Восстановлено из архива: {archived}"
+                not_found = len(data['telegram_ids']) - updated
+            else:
+                text += f"\n📦 В архиве (подписка уже истекла): {archived}"
+                not_found = len(data['telegram_ids']) - updated - archived
+            text += f"\n❌ Не найдено: {not_found}"
+        await message.answer(text)
+    except Exception as e:
+        await message.answer(f"Ошибка: {str(e)}")
+    finally:
+        await state.clear()
+
+# Обработчики для вывода списка пользователей
+@admin_router.callback_query(F.data == "admin_user_list")
+async def admin_user_list(callback: CallbackQuery):
+    await callback.message.edit_text("**Выберите фильтр**", reply_markup=screens.admin_user_list, parse_mode='Markdown')
+
+def _user_list_pages(with_subscription: bool, title: str) -> list:
+    """Страницы списка пользователей не длиннее сообщения Telegram.
+    Строки читаются из БД потоком, и сессия закрывается до отправки"""
+    pages = []
+    text = f"👤 <b>{title}:</b>\n\n"
+    found = False
+    for user in iter_user_rows(with_subscription):
+        found = True
         username = f"@{user.username}" if user.username else "none"
-        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>)\n"
+        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>)"
+        if with_subscription:
+            user_line += f" - до <code>{user.subscription_end.strftime('%d.%m.%Y %H:%M')}</code>"
+        user_line += "\n"
         
-        # Если текст становится слишком длинным, отправляем текущую часть и начинаем новую
+        # Если текст становится слишком длинным, начинаем новую страницу
         if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Пользователи без подписки (продолжение):</b>\n\n"
+            pages.append(text)
+            text = f"👤 <b>{title} (продолжение):</b>\n\n"
         
         text += user_line
     
-    # Отправляем оставшуюся часть текста
-    await callback.message.answer(text, parse_mode="HTML")
+    if found:
+        pages.append(text)
+    return pages
+
+@admin_router.callback_query(F.data == "user_list_active")
+async def handle_user_list_active(callback: CallbackQuery):
+    pages = await asyncio.to_thread(_user_list_pages, True, "Пользователи с активной подпиской")
+    if not pages:
+        await callback.answer("Нет пользователей с активной подпиской")
+        return
+    await callback.answer()
+    
+    for page in pages:
+        await callback.message.answer(page, parse_mode="HTML")
+
+@admin_router.callback_query(F.data == "user_list_inactive")
+async def handle_user_list_inactive(callback: CallbackQuery):
+    pages = await asyncio.to_thread(_user_list_pages, False, "Пользователи без подписки")
+    if not pages:
+        await callback.answer("Нет пользователей без подписки")
+        return
+    await callback.answer()
+    
+    for page in pages:
+        await callback.message.answer(page, parse_mode="HTML")
 
 # Обработчики для рассылки сообщений
-@router.callback_query(F.data == "admin_send_message")
+@admin_router.callback_query(F.data == "admin_send_message")
 async def admin_send_message_start(callback: CallbackQuery, state: FSMContext):
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ С подпиской", callback_data="target_active")
@@ -481,7 +638,7 @@ async def admin_send_message_start(callback: CallbackQuery, state: FSMContext):
         reply_markup=builder.as_markup()
     )
 
-@router.callback_query(F.data.startswith("target_"))
+@admin_router.callback_query(F.data.startswith("target_"))
 async def admin_send_message_target(callback: CallbackQuery, state: FSMContext):
     await callback.answer()  # Снимаем анимацию
     target = callback.data.split("_")[1]
@@ -489,41 +646,43 @@ async def admin_send_message_target(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer("Введите сообщение для рассылки:")
     await state.set_state(AdminStates.SEND_MESSAGE)
 
-@router.message(AdminStates.SEND_MESSAGE)
+@admin_router.message(AdminStates.SEND_MESSAGE)
 async def admin_send_message(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     target = data['target']
     text = message.text
     
-    users = []
-    if target == "active":
-        users = await get_all_users(with_subscription=True)
-    elif target == "inactive":
-        users = await get_all_users(with_subscription=False)
-    else:  # all
-        users = await get_all_users()
+    with_subscription = {"active": True, "inactive": False}.get(target)  # all -> None
+    # Давно истекшие пользователи лежат в архиве, но рассылка «всем» и «без подписки» их охватывает
+    telegram_ids = await get_user_ids(with_subscription, include_archived=True)
     
-    success = 0
-    failed = 0
-    
-    for user in users:
+    async def send(telegram_id: int) -> bool:
         try:
-            await bot.send_message(user.telegram_id, text)
-            success += 1
+            await bot.send_message(telegram_id, text)
+            return True
         except Exception as e:
-            logger.error(f"🛑 Ошибка отправки сообщения {user.telegram_id}: {e}")
-            failed += 1
+            logger.error(f"🛑 Ошибка отправки сообщения {telegram_id}: {e}")
+            return False
+    
+    # Темп рассылки задает планировщик исходящих сообщений; ответы другим
+    # пользователям получают токены раньше рассылки
+    success = 0
+    with send_priority(PRIORITY_BULK):
+        for start in range(0, len(telegram_ids), BROADCAST_CHUNK):
+            chunk = telegram_ids[start:start + BROADCAST_CHUNK]
+            success += sum(await asyncio.gather(*(send(telegram_id) for telegram_id in chunk)))
+    failed = len(telegram_ids) - success
     
     await message.answer(
         f"📨 Результаты рассылки:\n\n"
         f"• Успешно: {success}\n"
         f"• Не удалось: {failed}\n"
-        f"• Всего: {len(users)}"
+        f"• Всего: {len(telegram_ids)}"
     )
     await state.clear()
 
 # Остальные обработчики остаются без изменений
-@router.callback_query(F.data == "static_profiles_menu")
+@admin_router.callback_query(F.data == "static_profiles_menu")
 async def static_profiles_menu(callback: CallbackQuery):
     builder = InlineKeyboardBuilder()
     builder.button(text="🆕 Добавить статический профиль", callback_data="static_profile_add")
@@ -532,64 +691,89 @@ async def static_profiles_menu(callback: CallbackQuery):
     builder.adjust(1)
     await callback.message.edit_text("**Выберите действие**", reply_markup=builder.as_markup(), parse_mode='Markdown')
 
-@router.callback_query(F.data == "static_profile_add")
+@admin_router.callback_query(F.data == "static_profile_add")
 async def static_profile_add(callback: CallbackQuery, state: FSMContext):
     await callback.answer()  # Снимаем анимацию
-    await callback.message.answer("Введите имя для статического профиля:")
+    await callback.message.answer("Введите имя для статического профиля (для нескольких — по одному в строке):")
     await state.set_state(AdminStates.CREATE_STATIC_PROFILE)
 
-@router.message(AdminStates.CREATE_STATIC_PROFILE)
+def _static_profile_keyboard(profile_id: int):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🗑️ Удалить", callback_data=f"delete_static_{profile_id}")
+    return builder.as_markup()
+
+@admin_router.message(AdminStates.CREATE_STATIC_PROFILE)
 async def process_static_profile_name(message: Message, state: FSMContext):
-    profile_name = message.text
-    profile_data = await create_static_client(profile_name)
-    
-    if profile_data:
-        vless_url = generate_vless_url(profile_data)
-        await create_static_profile(profile_name, vless_url)
-        profiles = await get_static_profiles()
-        for profile in profiles:
-            if profile.name == profile_name:
-                id = profile.id
-        builder = InlineKeyboardBuilder()
-        builder.button(text="🗑️ Удалить", callback_data=f"delete_static_{id}")
-        await message.answer(f"Профиль создан!\n\n`{vless_url}`", reply_markup=builder.as_markup(), parse_mode='Markdown')
-    else:
+    names = list(dict.fromkeys(line.strip() for line in (message.text or "").splitlines() if line.strip()))
+    await state.clear()
+    if not names:
         await message.answer("Ошибка при создании профиля")
+        return
     
-    await state.clear()
+    taken = await find_static_profile_names(names)
+    if taken:
+        await message.answer(f"⚠️ Профили с такими именами уже есть: {', '.join(sorted(taken))}")
+        return
+    
+    # Все клиенты создаются в панели одним вызовом addClient
+    profiles = await create_static_clients(names)
+    if not profiles:
+        await message.answer("Ошибка при создании профиля")
+        return
+    
+    vless_urls = [generate_vless_url(profile) for profile in profiles]
+    try:
+        profile_ids = await create_static_profiles(list(zip(names, vless_urls)))
+    except Exception as e:
+        logger.error(f"🛑 Failed to save static profiles, removing clients from panel: {e}")
+        await delete_clients(emails=names)
+        await message.answer("Ошибка при создании профиля")
+        return
+    
+    for name, vless_url, profile_id in zip(names, vless_urls, profile_ids):
+        await message.answer(
+            f"Профиль **{name}** создан!\n\n`{vless_url}`",
+            reply_markup=_static_profile_keyboard(profile_id), parse_mode='Markdown'
+        )
 
-@router.callback_query(F.data == "static_profile_list")
+@admin_router.callback_query(F.data == "static_profile_list")
 async def static_profile_list(callback: CallbackQuery):
     profiles = await get_static_profiles()
     if not profiles:
         await callback.answer("Нет статических профилей")
         return
+    await callback.answer()
     
     for profile in profiles:
-        builder = InlineKeyboardBuilder()
-        builder.button(text="🗑️ Удалить", callback_data=f"delete_static_{profile.id}")
         await callback.message.answer(
             f"**{profile.name}**\n`{profile.vless_url}`", 
-            reply_markup=builder.as_markup(), parse_mode='Markdown'
+            reply_markup=_static_profile_keyboard(profile.id), parse_mode='Markdown'
         )
+    
+    if len(profiles) > 1:
+        builder = InlineKeyboardBuilder()
+        builder.button(text=f"🗑️ Удалить все ({len(profiles)})", callback_data="static_profile_delete_all")
+        await callback.message.answer("Удалить все статические профили?", reply_markup=builder.as_markup())
+
+@admin_router.callback_query(F.data == "static_profile_delete_all")
+async def handle_delete_all_static_profiles(callback: CallbackQuery):
+    # Клиенты удаляются из инбаунда в фоне через outbox одним обновлением
+    deleted = await delete_static_profiles([profile.id for profile in await get_static_profiles()])
+    if deleted:
+        request_panel_sync()
+    await callback.answer(f"✅ Удалено профилей: {deleted}")
+    await callback.message.delete()
 
-@router.callback_query(F.data.startswith("delete_static_"))
+@admin_router.callback_query(F.data.startswith("delete_static_"))
 async def handle_delete_static_profile(callback: CallbackQuery):
     try:
         profile_id = int(callback.data.split("_")[-1])
         
-        with Session() as session:
-            profile = session.query(StaticProfile).filter_by(id=profile_id).first()
-            if not profile:
-                await callback.answer("⚠️ Профиль не найден")
-                return
-            
-            success = await delete_client_by_email(profile.name)
-            if not success:
-                logger.error(f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
-            
-            session.delete(profile)
-            session.commit()
+        # Клиент удаляется из инбаунда в фоне через outbox
+        if not await delete_static_profiles([profile_id]):
+            await callback.answer("⚠️ Профиль не найден")
+            return
+        request_panel_sync()
         
         await callback.answer("✅ Профиль удален!")
         await callback.message.delete()
@@ -608,55 +792,68 @@ async def connect_profile(callback: CallbackQuery):
         await callback.answer("⚠️ Подписка истекла! Продлите подписку.")
         return
     
-    if not user.vless_profile_data:
+    await callback.answer()
+    if not user.port:
+        # Создание клиента в панели выполняет outbox, ждем его не дольше PROFILE_WAIT_TIMEOUT
+        operation_id = await request_profile(user.telegram_id)
         await callback.message.edit_text("⚙️ Создаем ваш VPN профиль...")
-        profile_data = await create_vless_profile(user.telegram_id)
+        status = None
+        # Пока панель недоступна, ждать создания бессмысленно: outbox создаст профиль позже
+        if operation_id and not panel_breaker.is_open:
+            request_panel_sync()
+            status = await wait_for_operation(operation_id, PROFILE_WAIT_TIMEOUT)
         
-        if profile_data:
-            with Session() as session:
-                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                if db_user:
-                    db_user.vless_profile_data = json.dumps(profile_data)
-                    session.commit()
-            user = await get_user(user.telegram_id)
-        else:
+        if status == "failed":
             await callback.message.answer("🛑 Ошибка при создании профиля. Попробуйте позже.")
             return
+        user = await get_user(user.telegram_id)
+        if not user.port:
+            await callback.message.answer("⏳ Профиль еще создается. Нажмите «Подключить» через минуту.")
+            return
     
-    profile_data = safe_json_loads(user.vless_profile_data, default={})
-    if not profile_data:
-        await callback.message.answer("⚠️ У вас пока нет созданного профиля.")
-        return
+    profile_data = user.profile
     vless_url = generate_vless_url(profile_data)
-    text = (
-        "🎉 **Ваш VPN профиль готов!**\n\n"
-        "ℹ️ **Инструкция по подключению:**\n"
-        "1. Скачайте приложение для вашей платформы\n"
-        "2. Скопируйте эту ссылку и импортируйте в приложение:\n\n"
-        f"`{vless_url}`\n\n"
-        "3. Активируйте соединение в приложении."
-    )
+    text = CONNECT_TEXT.format(vless_url=vless_url)
+    sub_url = subscription_url(user.sub_id or await assign_sub_id(user.telegram_id))
+    if sub_url:
+        text += (
+            "\n\n🔄 Или добавьте в приложение ссылку-подписку — "
+            f"настройки будут обновляться автоматически:\n`{sub_url}`"
+        )
 
-    builder = InlineKeyboardBuilder()
-    builder.button(text='🖥️ Windows [V2RayN]', url='https://github.com/2dust/v2rayN/releases/download/7.13.8/v2rayN-windows-64-desktop.zip')
-    builder.button(text='🐧 Linux [NekoBox]', url='https://github.com/MatsuriDayo/nekoray/releases/download/4.0.1/nekoray-4.0.1-2024-12-12-debian-x64.deb')
-    builder.button(text='🍎 Mac [V2RayU]', url='https://github.com/yanue/V2rayU/releases/download/v4.2.6/V2rayU-64.dmg ')
-    builder.button(text='🍏 iOS [V2RayTun]', url='https://apps.apple.com/ru/app/v2raytun/id6476628951')
-    builder.button(text='🤖 Android [V2RayNG]', url='https://github.com/2dust/v2rayNG/releases/download/1.10.16/v2rayNG_1.10.16_arm64-v8a.apk')
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    builder.adjust(2, 2, 1, 1)
+    await callback.message.edit_text(text, reply_markup=screens.download_apps, parse_mode='Markdown')
+    await send_profile_qr(callback.message, user, vless_url)
 
-    await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='Markdown')
+async def send_profile_qr(message: Message, user: User, vless_url: str):
+    """QR-код ссылки: по сохраненному file_id, иначе загрузка PNG из кэша"""
+    caption = "📷 Отсканируйте QR-код в приложении"
+    key = qr_key(vless_url)
+    # file_id годится, только если QR-код кодирует текущую ссылку
+    if user.qr_file_id and user.qr_key == key:
+        try:
+            await message.answer_photo(user.qr_file_id, caption=caption)
+            return
+        except TelegramBadRequest:
+            logger.warning(f"⚠️ Stored QR file_id for {user.telegram_id} rejected, uploading again")
+    
+    try:
+        path = await asyncio.to_thread(get_qr_path, vless_url)
+        sent = await message.answer_photo(FSInputFile(path), caption=caption)
+        await save_qr_file_id(user.telegram_id, user.client_id, sent.photo[-1].file_id, key)
+    except Exception as e:
+        logger.error(f"🛑 Failed to send QR code to {user.telegram_id}: {e}")
 
 @router.callback_query(F.data == "stats")
 async def user_stats(callback: CallbackQuery):
     user = await get_user(callback.from_user.id)
-    if not user or not user.vless_profile_data:
+    if not user or not user.port:
         await callback.answer("⚠️ Профиль не создан")
         return
+    if panel_breaker.is_open:
+        await callback.answer(PANEL_UNAVAILABLE_TEXT, show_alert=True)
+        return
     await callback.message.edit_text("⚙️ Загружаем вашу статистику...")
-    profile_data = safe_json_loads(user.vless_profile_data, default={})
-    stats = await get_user_stats(profile_data["email"])
+    stats = await get_user_stats(user.email)
 
     logger.debug(stats)
     upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
@@ -675,10 +872,16 @@ async def user_stats(callback: CallbackQuery):
         f"🔼 Загружено: `{upload} {upload_size}`\n"
         f"🔽 Скачано: `{download} {download_size}`\n"
     )
+    if user.traffic_quota:
+        used = (stats.get('upload', 0) + stats.get('download', 0)) / 1024 ** 3
+        text += f"📦 Лимит: `{used:.2f} из {user.traffic_quota / 1024 ** 3:.0f} GB`\n"
     await callback.message.answer(text, parse_mode='Markdown')
 
-@router.callback_query(F.data == "admin_network_stats")
+@admin_router.callback_query(F.data == "admin_network_stats")
 async def network_stats(callback: CallbackQuery):
+    if panel_breaker.is_open:
+        await callback.answer(PANEL_UNAVAILABLE_TEXT, show_alert=True)
+        return
     stats = await get_global_stats()
 
     upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
@@ -704,13 +907,10 @@ async def back_to_menu(callback: CallbackQuery, bot: Bot):
     await show_menu(bot, callback.from_user.id, callback.message.message_id)
 
 def setup_handlers(dp: Dispatcher):
+    # Выполняющиеся апдейты учитываются для корректной остановки
+    dp.update.outer_middleware(in_flight)
+    # Повторные нажатия отсекаются до обработчиков, пока первое еще выполняется
+    dp.callback_query.middleware(CallbackThrottleMiddleware())
     dp.include_router(router)
+    dp.include_router(admin_router)
     logger.info("✅ Handlers setup completed")
-
-def safe_json_loads(data, default=None):
-    if not data:
-        return default
-    try:
-        return json.loads(data)
-    except Exception:
-        return default
@@ -0,0 +1,145 @@
+"""Импорт существующих клиентов панели 3X-UI в БД бота.
+
+Клиенты инбаунда разбираются из settings по одному и записываются в users
+пакетами по --batch-size в отдельных транзакциях, без списка всех клиентов.
+API панели не умеет отдавать клиентов постранично: инбаунд приходит одним
+JSON-ответом, который разбирается целиком, поэтому пиковая память импорта —
+O(размер инбаунда) (ответ и строка settings), пакет лишь ограничивает размер
+транзакций. После каждого пакета позиция сохраняется в файл состояния, и
+прерванный импорт продолжается с --resume; после успешного завершения файл
+удаляется. Клиенты без числового tgId пропускаются: без него бот не свяжет
+профиль с пользователем.
+
+Пример:
+    python3 src/import_panel.py                 # импорт инбаунда INBOUND_ID
+    python3 src/import_panel.py --resume        # продолжить прерванный импорт
+"""
+import os
+import json
+import asyncio
+import argparse
+import logging
+import time
+import coloredlogs
+from datetime import datetime, timedelta
+from config import config
+from database import import_users_batch
+from functions import XUIAPI, iter_clients
+from monitoring import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# expiryTime = 0 в панели означает бессрочного клиента
+UNLIMITED_EXPIRY = datetime(2099, 12, 31)
+
+def panel_expiry(expiry_ms: int) -> datetime:
+    """Переводит expiryTime панели в subscription_end"""
+    if not expiry_ms:
+        return UNLIMITED_EXPIRY
+    if expiry_ms < 0:
+        # Отрицательное значение — срок, отсчитываемый с первого подключения
+        return datetime.utcnow() + timedelta(milliseconds=-expiry_ms)
+    return datetime.utcfromtimestamp(expiry_ms / 1000)
+
+def client_row(client: dict, inbound: dict):
+    """Строка users для клиента панели или None, если клиента нельзя привязать"""
+    telegram_id = str(client.get("tgId") or "").strip()
+    if not telegram_id.isdigit() or not client.get("id") or not client.get("email"):
+        return None
+    return {
+        "telegram_id": int(telegram_id),
+        "client_id": client["id"],
+        "email": client["email"],
+        "port": inbound["port"],
+        "inbound_id": inbound["id"],
+        "remark": inbound["remark"],
+        "subscription_end": panel_expiry(client.get("expiryTime") or 0),
+        "traffic_quota": client.get("totalGB") or 0,
+        # Выданные панелью ссылки-подписки продолжают работать
+        "sub_id": client.get("subId") or None,
+    }
+
+def load_state(path: str, inbound_id: int) -> dict:
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("inbound_id") == inbound_id else None
+
+async def import_panel(inbound_id: int, batch_size: int = 1000, state_file: str = "import_state.json",
+                       resume: bool = False) -> dict:
+    """Импортирует клиентов инбаунда в users, возвращает итоговую статистику"""
+    started = time.monotonic()
+    api = XUIAPI()
+    try:
+        if not await api.login():
+            raise RuntimeError("не удалось авторизоваться в панели")
+        inbound = await api.get_inbound(inbound_id)
+        if not inbound:
+            raise RuntimeError(f"инбаунд {inbound_id} не найден")
+    finally:
+        await api.close()
+
+    settings = inbound.pop("settings")
+    # clientStats не нужны импорту, а на больших инбаундах занимают основную часть памяти
+    total = len(inbound.pop("clientStats", None) or []) or None
+
+    stats = {"inbound_id": inbound_id, "processed": 0, "imported": 0, "conflicts": 0, "skipped": 0}
+    if resume:
+        previous = load_state(state_file, inbound_id)
+        if previous:
+            stats.update(previous)
+            logger.info(f"ℹ️ Resuming import from client #{stats['processed']}")
+        else:
+            logger.warning("⚠️ No saved import state for this inbound, starting from scratch")
+
+    def flush(batch: list, seen: int):
+        if batch:
+            imported, conflicts = import_users_batch(batch)
+            stats["imported"] += imported
+            stats["conflicts"] += conflicts
+            stats["skipped"] += seen - len(batch)
+        else:
+            stats["skipped"] += seen
+        stats["processed"] += seen
+        write_json_atomic(state_file, stats)
+        progress = f"{stats['processed']}/{total} ({stats['processed'] / total:.0%})" if total else stats["processed"]
+        logger.info(f"ℹ️ Processed {progress}: imported {stats['imported']}, "
+                    f"conflicts {stats['conflicts']}, skipped {stats['skipped']}")
+
+    skip = stats["processed"]
+    batch, seen = [], 0
+    for position, client in enumerate(iter_clients(settings)):
+        if position < skip:
+            continue
+        seen += 1
+        row = client_row(client, inbound)
+        if row:
+            batch.append(row)
+        if seen >= batch_size:
+            flush(batch, seen)
+            batch, seen = [], 0
+    if seen:
+        flush(batch, seen)
+
+    # Импорт завершен: позиция больше не нужна, а --resume не должен пропускать клиентов
+    try:
+        os.remove(state_file)
+    except OSError:
+        pass
+    stats["elapsed"] = round(time.monotonic() - started, 2)
+    logger.info(f"✅ Import finished: {stats}")
+    if stats["conflicts"]:
+        logger.warning("⚠️ Conflicting clients (user already has another profile or email is taken) were left unchanged")
+    return stats
+
+if __name__ == "__main__":
+    coloredlogs.install(level='info')
+    parser = argparse.ArgumentParser(description="Импорт клиентов 3X-UI в БД бота")
+    parser.add_argument("--inbound", type=int, default=config.INBOUND_ID)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--state-file", default="import_state.json")
+    parser.add_argument("--resume", action="store_true", help="Продолжить с позиции последнего сохраненного пакета")
+    args = parser.parse_args()
+    asyncio.run(import_panel(args.inbound, args.batch_size, args.state_file, args.resume))
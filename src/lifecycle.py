@@ -0,0 +1,121 @@
+"""Корректная остановка и теплый перезапуск бота.
+
+По SIGTERM aiogram прекращает polling, после чего shutdown-обработчик дожидается
+выполняющихся апдейтов и текущих итераций фоновых циклов (не дольше
+SHUTDOWN_TIMEOUT), отменяет остальное и сохраняет теплое состояние в компактный
+JSON: время последних запусков периодических задач, расписание обслуживания,
+найденный путь API панели. При старте состояние загружается и файл удаляется,
+и циклы продолжают расписание вместо полного прохода сразу после деплоя. Теплым
+считается только старт после корректной остановки: после падения файла нет,
+и накопившиеся апдейты сбрасываются.
+"""
+import os
+import time
+import json
+import asyncio
+import logging
+from config import config
+from monitoring import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+shutdown_event = asyncio.Event()
+
+# Фоновые задачи: drain=True — дождаться текущей итерации, иначе просто отменить
+_tasks = []
+# Имя -> (функция сохранения, функция загрузки) частей теплого состояния
+_state_handlers = {}
+# Время последнего запуска периодических циклов (epoch)
+_last_runs = {}
+
+def start_task(coro, name: str, drain: bool = False) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _tasks.append((task, drain))
+    return task
+
+async def sleep_or_shutdown(seconds: float) -> bool:
+    """Пауза между итерациями цикла; True, если пора завершаться"""
+    try:
+        await asyncio.wait_for(shutdown_event.wait(), timeout=max(seconds, 0))
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+def mark_run(name: str):
+    _last_runs[name] = time.time()
+
+def initial_delay(name: str, interval: float) -> float:
+    """Сколько ждать до первого запуска, чтобы продолжить расписание прошлого процесса"""
+    last_run = _last_runs.get(name)
+    if last_run is None:
+        return 0
+    return max(0.0, min(interval, last_run + interval - time.time()))
+
+def register_state(name: str, dump, load):
+    """Добавляет часть теплого состояния: dump() -> JSON-совместимое значение, load(value)"""
+    _state_handlers[name] = (dump, load)
+
+register_state("schedule", lambda: dict(_last_runs), _last_runs.update)
+
+def load_warm_state() -> bool:
+    """Загружает сохраненное состояние, False при холодном старте"""
+    try:
+        with open(config.WARM_STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+    finally:
+        # Состояние одноразовое: после падения процесса (без нового сохранения)
+        # следующий старт будет холодным, а не повторит пропущенные апдейты
+        try:
+            os.remove(config.WARM_STATE_FILE)
+        except OSError:
+            pass
+    # Состояние старше лимита (долгий простой) уже не отражает действительность
+    if time.time() - state.get("saved_at", 0) > config.WARM_STATE_MAX_AGE:
+        logger.info("ℹ️ Warm state is too old, cold start")
+        return False
+
+    for name, (_, load) in _state_handlers.items():
+        if name in state:
+            try:
+                load(state[name])
+            except Exception as e:
+                logger.error(f"🛑 Failed to restore warm state {name}: {e}")
+    logger.info(f"✅ Warm state restored ({time.time() - state['saved_at']:.0f} s old)")
+    return True
+
+def save_warm_state():
+    state = {"saved_at": time.time()}
+    for name, (dump, _) in _state_handlers.items():
+        try:
+            state[name] = dump()
+        except Exception as e:
+            logger.error(f"🛑 Failed to save warm state {name}: {e}")
+    os.makedirs(os.path.dirname(os.path.abspath(config.WARM_STATE_FILE)), exist_ok=True)
+    write_json_atomic(config.WARM_STATE_FILE, state)
+
+async def graceful_shutdown(in_flight, wakeups=()):
+    """Дожидается апдейтов и фоновых задач, затем сохраняет теплое состояние.
+    wakeups будят циклы, которые ждут не shutdown_event, а свое событие"""
+    started = time.monotonic()
+    shutdown_event.set()
+
+    pending_updates = await in_flight.drain(config.SHUTDOWN_TIMEOUT)
+    if pending_updates:
+        logger.warning(f"⚠️ {pending_updates} updates still running at shutdown")
+    for wakeup in wakeups:
+        wakeup()
+
+    draining = [task for task, drain in _tasks if drain and not task.done()]
+    remaining = max(0.0, config.SHUTDOWN_TIMEOUT - (time.monotonic() - started))
+    if draining:
+        _, not_finished = await asyncio.wait(draining, timeout=remaining)
+        for task in not_finished:
+            logger.warning(f"⚠️ Task {task.get_name()} did not finish in time, cancelling")
+    for task, _ in _tasks:
+        task.cancel()
+    await asyncio.gather(*(task for task, _ in _tasks), return_exceptions=True)
+
+    save_warm_state()
+    logger.info(f"✅ Graceful shutdown completed in {time.monotonic() - started:.1f} s")
@@ -0,0 +1,100 @@
+"""Чтение хвоста лог-файла без загрузки его целиком.
+
+Используется админ-панелью: стоимость просмотра логов зависит только от числа
+показываемых строк, а не от размера файла.
+"""
+import os
+import re
+import shutil
+from collections import deque
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+_LEVEL_RE = re.compile(r"\b(DEBUG|INFO|WARNING|ERROR|CRITICAL)\b")
+
+def tail_lines(path: str, count: int, block_size: int = 8192):
+    """Последние count строк файла и размер файла (смещение для режима follow)"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = position = f.tell()
+        data = b""
+        # Читаем блоками с конца, пока не наберем count переводов строки
+        while position > 0 and data.count(b"\n") <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    return lines[-count:], end
+
+def read_new_lines(path: str, offset: int, max_bytes: int = 1024 * 1024):
+    """Строки, дописанные после offset, и новое смещение.
+    Если файл стал меньше offset (ротация), чтение начинается заново"""
+    size = os.path.getsize(path)
+    if size < offset:
+        offset = 0
+    if size == offset:
+        return [], offset
+    with open(path, "rb") as f:
+        # При большом приросте берем только последние max_bytes
+        start = max(offset, size - max_bytes)
+        f.seek(start)
+        data = f.read(size - start)
+    # Незавершенную последнюю строку дочитаем при следующем обновлении
+    cut = data.rfind(b"\n") + 1
+    lines = data[:cut].decode("utf-8", errors="replace").splitlines()
+    if start > offset and lines:
+        lines = lines[1:]
+    return lines, start + cut
+
+def filter_lines(lines, levels=None, keyword: str = ""):
+    """Фильтр по уровням и подстроке. Строки без уровня (traceback) наследуют уровень предыдущей"""
+    levels = set(levels or LEVELS)
+    keyword = keyword.lower()
+    result = []
+    current = None
+    for line in lines:
+        match = _LEVEL_RE.search(line)
+        if match:
+            current = match.group(1)
+        if current is not None and current not in levels:
+            continue
+        if keyword and keyword not in line.lower():
+            continue
+        result.append(line)
+    return result
+
+class LogFollower:
+    """Буфер последних строк с запоминанием смещения между обновлениями страницы"""
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.lines = deque(maxlen=count)
+        lines, self.offset = tail_lines(path, count) if os.path.exists(path) else ([], 0)
+        self.lines.extend(lines)
+
+    def poll(self):
+        if not os.path.exists(self.path):
+            return list(self.lines)
+        if os.path.getsize(self.path) < self.offset:
+            # Файл ротирован: начинаем с хвоста нового файла
+            lines, self.offset = tail_lines(self.path, self.lines.maxlen)
+            self.lines.clear()
+            self.lines.extend(lines)
+        else:
+            lines, self.offset = read_new_lines(self.path, self.offset)
+            self.lines.extend(lines)
+        return list(self.lines)
+
+def rotate_file(path: str, max_bytes: int, backup_count: int = 3):
+    """Ротация по размеру: path -> path.1 -> ... -> path.N (старейший удаляется).
+    Файл копируется и обрезается на месте (copytruncate): запущенный бот пишет в него
+    в режиме добавления и продолжает писать в начало обрезанного файла"""
+    if not os.path.exists(path) or os.path.getsize(path) < max_bytes:
+        return False
+    for index in range(backup_count - 1, 0, -1):
+        source = f"{path}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{path}.{index + 1}")
+    shutil.copyfile(path, f"{path}.1")
+    with open(path, "r+b") as f:
+        f.truncate(0)
+    return True
@@ -0,0 +1,123 @@
+"""Неблокирующее логирование бота.
+
+Вызовы logger.* в обработчиках и фоновых циклах только кладут запись в очередь.
+Форматирование и запись выполняет отдельный поток QueueListener: цветной вывод
+в консоль и компактные JSON-строки в файл с ротацией по размеру и по времени.
+Если задан LOG_FILE, а stderr не терминал, в stderr пишутся только WARNING и выше.
+При переполнении очереди (массовые ошибки, например при недоступной панели)
+записи отбрасываются, а не тормозят event loop.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import coloredlogs
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from config import config
+
+class JSONFormatter(logging.Formatter):
+    """Одна запись — одна компактная JSON-строка"""
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        exc = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc:
+            data["exc"] = exc
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    """Ротация при превышении размера или по истечении интервала (архивы .1 … .N)"""
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, interval_seconds: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval = interval_seconds
+        self.rollover_at = time.time() + interval_seconds
+
+    def shouldRollover(self, record) -> bool:
+        if self.interval and time.time() >= self.rollover_at:
+            if self.stream is not None and self.stream.tell() > 0:
+                return True
+            self.rollover_at = time.time() + self.interval
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class DroppingQueueHandler(QueueHandler):
+    """Не блокирует вызывающий код: при полной очереди запись отбрасывается"""
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Сообщение собирается здесь (аргументы могут измениться), остальное — в потоке записи
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_listener = None
+_queue = None
+
+def log_queue_depth() -> int:
+    """Записи, ожидающие потока записи (для heartbeat)"""
+    return _queue.qsize() if _queue is not None else 0
+
+def dropped_records() -> int:
+    return DroppingQueueHandler.dropped
+
+def setup_logging():
+    """Настраивает корневой логгер на очередь и запускает поток записи"""
+    global _listener, _queue
+    if _listener is not None:
+        return
+    
+    console = logging.StreamHandler(sys.stderr)
+    # Цвета только для терминала: в перенаправленный в файл stderr пишем без ANSI-кодов
+    if coloredlogs.terminal_supports_colors(sys.stderr):
+        console.setFormatter(coloredlogs.ColoredFormatter(coloredlogs.DEFAULT_LOG_FORMAT, coloredlogs.DEFAULT_DATE_FORMAT))
+    else:
+        console.setFormatter(logging.Formatter(coloredlogs.DEFAULT_LOG_FORMAT, coloredlogs.DEFAULT_DATE_FORMAT))
+    # Поля %(hostname)s и %(programname)s формата coloredlogs
+    console.addFilter(coloredlogs.HostNameFilter())
+    console.addFilter(coloredlogs.ProgramNameFilter())
+    # Без терминала stderr обычно перенаправлен в файл без ротации (bot_error.log панели):
+    # полный журнал пишется в LOG_FILE, а туда идут только предупреждения и ошибки
+    if config.LOG_FILE and not sys.stderr.isatty():
+        console.setLevel(logging.WARNING)
+    handlers = [console]
+    
+    if config.LOG_FILE:
+        os.makedirs(os.path.dirname(config.LOG_FILE) or ".", exist_ok=True)
+        file_handler = SizeAndTimeRotatingFileHandler(
+            config.LOG_FILE,
+            max_bytes=config.LOG_MAX_BYTES,
+            backup_count=config.LOG_BACKUP_COUNT,
+            interval_seconds=config.LOG_ROTATE_HOURS * 3600
+        )
+        file_handler.setFormatter(JSONFormatter())
+        handlers.append(file_handler)
+    
+    _queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(DroppingQueueHandler(_queue))
+    root.setLevel(config.LOG_LEVEL.upper())
+    
+    _listener = QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
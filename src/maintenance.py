@@ -0,0 +1,147 @@
+"""Плановое обслуживание БД внутри бота.
+
+Для SQLite: онлайн-бэкапы через backup API небольшими порциями страниц (между
+порциями соединение отпускает БД, запись не блокируется надолго), хранение
+BACKUP_KEEP последних копий, периодический WAL checkpoint, а в ночное окно
+MAINTENANCE_HOUR — ANALYZE, PRAGMA optimize и checkpoint с усечением WAL.
+Для любой БД в то же окно давно истекшие пользователи переносятся в архив.
+Все операции выполняются в отдельном потоке и логируют свою длительность.
+"""
+import os
+import glob
+import time
+import asyncio
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from config import config
+from database import engine, IS_SQLITE, archive_expired_users
+from lifecycle import register_state, sleep_or_shutdown
+
+logger = logging.getLogger(__name__)
+
+# После стольких перезапусков копирования (источник изменился) копируем за один шаг
+MAX_BACKUP_RESTARTS = 3
+
+class _BackupRestarted(Exception):
+    pass
+
+def _timed(name):
+    """Логирует длительность операции обслуживания"""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            result = func(*args, **kwargs)
+            logger.info(f"✅ Maintenance {name} done in {time.monotonic() - started:.2f}s")
+            return result
+        return wrapper
+    return decorator
+
+def _copy(source, target, pages: int):
+    remaining_seen = []
+    
+    def progress(status, remaining, total):
+        # Рост remaining означает, что SQLite начал копирование заново после записи в источник
+        if remaining_seen and remaining > remaining_seen[-1]:
+            remaining_seen.append(remaining)
+            if len(remaining_seen) > MAX_BACKUP_RESTARTS:
+                raise _BackupRestarted()
+        remaining_seen.append(remaining)
+    
+    source.backup(target, pages=pages, progress=progress, sleep=config.BACKUP_STEP_SLEEP)
+
+@_timed("backup")
+def backup_database():
+    """Онлайн-копия users.db в BACKUP_DIR с ротацией старых копий"""
+    os.makedirs(config.BACKUP_DIR, exist_ok=True)
+    name = os.path.splitext(os.path.basename(engine.url.database))[0]
+    path = os.path.join(config.BACKUP_DIR, f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.db")
+    tmp_path = f"{path}.tmp"
+    
+    source = sqlite3.connect(engine.url.database, timeout=config.DB_BUSY_TIMEOUT)
+    target = sqlite3.connect(tmp_path)
+    try:
+        try:
+            _copy(source, target, config.BACKUP_PAGES_PER_STEP)
+        except _BackupRestarted:
+            # Под постоянной записью копируем одним шагом: в WAL это не блокирует писателей
+            logger.warning("⚠️ Backup restarted too often, copying in one step")
+            _copy(source, target, -1)
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, path)
+    
+    backups = sorted(glob.glob(os.path.join(config.BACKUP_DIR, f"{name}-*.db")))
+    for old in backups[:-config.BACKUP_KEEP]:
+        os.remove(old)
+    return path
+
+@_timed("wal_checkpoint")
+def checkpoint(mode: str = "PASSIVE"):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+@_timed("analyze")
+def analyze():
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE")
+        conn.exec_driver_sql("PRAGMA optimize")
+
+class Job:
+    """Периодическая задача обслуживания"""
+    def __init__(self, name: str, func, interval: timedelta = None, hour: int = None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.hour = hour
+        self.last_run = None
+
+    def is_due(self, now: datetime) -> bool:
+        if self.hour is not None:
+            # Раз в сутки в заданный час
+            return now.hour == self.hour and (self.last_run is None or self.last_run.date() < now.date())
+        return self.last_run is None or now - self.last_run >= self.interval
+
+jobs = []
+
+def add_job(job: Job):
+    jobs.append(job)
+
+if IS_SQLITE:
+    add_job(Job("backup", backup_database, interval=timedelta(hours=config.BACKUP_INTERVAL_HOURS)))
+    add_job(Job("checkpoint", checkpoint, interval=timedelta(minutes=config.CHECKPOINT_INTERVAL_MINUTES)))
+    add_job(Job("analyze", analyze, hour=config.MAINTENANCE_HOUR))
+    add_job(Job("truncate_wal", lambda: checkpoint("TRUNCATE"), hour=config.MAINTENANCE_HOUR))
+
+@_timed("archive")
+def archive_users():
+    return archive_expired_users(timedelta(days=config.ARCHIVE_AFTER_DAYS), config.ARCHIVE_BATCH)
+
+add_job(Job("archive", archive_users, hour=config.MAINTENANCE_HOUR))
+
+def _dump_schedule():
+    return {job.name: job.last_run.isoformat() for job in jobs if job.last_run}
+
+def _load_schedule(state: dict):
+    for job in jobs:
+        if job.name in state:
+            job.last_run = datetime.fromisoformat(state[job.name])
+
+# После перезапуска бэкап и прочие задачи не запускаются заново раньше срока
+register_state("maintenance", _dump_schedule, _load_schedule)
+
+async def maintenance_loop():
+    """Фоновый планировщик обслуживания: задачи выполняются по очереди в отдельном потоке"""
+    while True:
+        now = datetime.utcnow()
+        for job in jobs:
+            if not job.is_due(now):
+                continue
+            job.last_run = now
+            try:
+                await asyncio.to_thread(job.func)
+            except Exception as e:
+                logger.error(f"🛑 Maintenance {job.name} failed: {e}")
+        if await sleep_or_shutdown(60):
+            break
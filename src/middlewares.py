@@ -0,0 +1,103 @@
+"""Middleware защиты от повторных нажатий.
+
+Одинаковый callback одного пользователя выполняется не более одного раза
+одновременно: повторное нажатие, пока первое обрабатывается, сразу получает
+всплывающее уведомление и не ставит в очередь новых запросов к панели.
+Для дорогих кнопок дополнительно задан минимальный интервал между нажатиями.
+Отдельный middleware учитывает все выполняющиеся апдейты для корректной остановки,
+еще один пропускает к обработчикам админ-роутера только администраторов.
+"""
+import math
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from database import get_user
+
+logger = logging.getLogger(__name__)
+
+# callback_data -> минимальный интервал между нажатиями одного пользователя (с)
+DEFAULT_RATE_LIMITS = {
+    "connect": 5,
+    "stats": 10,
+    "admin_network_stats": 10,
+}
+
+class CallbackThrottleMiddleware(BaseMiddleware):
+    def __init__(self, rate_limits: Dict[str, float] = None, max_tracked: int = 10000):
+        self.rate_limits = DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits
+        self.max_tracked = max_tracked
+        self.in_flight = set()
+        self.last_call = {}
+
+    def _prune(self, now: float):
+        horizon = max(self.rate_limits.values(), default=0)
+        self.last_call = {key: ts for key, ts in self.last_call.items() if now - ts < horizon}
+
+    async def __call__(
+        self,
+        handler: Callable[[CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        key = (event.from_user.id, event.data)
+        if key in self.in_flight:
+            await event.answer("⏳ Запрос уже в процессе...")
+            return None
+
+        now = time.monotonic()
+        interval = self.rate_limits.get(event.data)
+        if interval:
+            wait = interval - (now - self.last_call.get(key, float("-inf")))
+            if wait > 0:
+                await event.answer(f"⏳ Слишком часто, повторите через {math.ceil(wait)} с")
+                return None
+            if len(self.last_call) >= self.max_tracked:
+                self._prune(now)
+            self.last_call[key] = now
+
+        self.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(key)
+
+class InFlightMiddleware(BaseMiddleware):
+    """Учитывает выполняющиеся апдейты, чтобы при остановке дождаться их завершения"""
+    def __init__(self):
+        self.tasks = set()
+
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self.tasks.discard(task)
+
+    async def drain(self, timeout: float) -> int:
+        """Ждет завершения текущих апдейтов, возвращает число не успевших"""
+        current = asyncio.current_task()
+        tasks = [task for task in self.tasks if task is not current]
+        if not tasks:
+            return 0
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return len(pending)
+
+class AdminOnlyMiddleware(BaseMiddleware):
+    """Проверяет права администратора перед любым обработчиком роутера, включая шаги FSM"""
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        user = await get_user(event.from_user.id)
+        if user and user.is_admin:
+            return await handler(event, data)
+
+        logger.warning(f"⚠️ Admin action denied for {event.from_user.id}")
+        state = data.get("state")
+        if state:
+            await state.clear()
+        await event.answer("🛑 Доступ запрещен!")
+        return None
+
+in_flight = InFlightMiddleware()
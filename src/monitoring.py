@@ -0,0 +1,126 @@
+"""Метрики бота: задержка event loop, ресурсы процесса, состояние панели и БД.
+
+Бот периодически пишет снимок в таблицу metrics_snapshots, а страница
+«📊 Мониторинг» админ-панели читает только эти готовые данные. Кроме того,
+бот ведет PID-файл и heartbeat-файл, по которым админ-панель и супервизор
+за O(1) определяют, жив ли бот.
+"""
+import os
+import json
+import atexit
+import asyncio
+import logging
+import time
+import psutil
+from datetime import timedelta
+from config import config
+from database import collect_user_counts, record_metrics, prune_metrics, count_pending_outbox
+from functions import get_online_users
+
+logger = logging.getLogger(__name__)
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже запланированного просыпается корутина"""
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag_ms = max(0.0, (loop.time() - started - self.interval) * 1000)
+            self.max_lag_ms = max(self.max_lag_ms, self.lag_ms)
+
+    def take_max(self) -> float:
+        """Максимальная задержка с прошлого вызова"""
+        value, self.max_lag_ms = self.max_lag_ms, 0.0
+        return value
+
+loop_lag = LoopLagMonitor()
+
+async def collect_snapshot(process: psutil.Process) -> dict:
+    started = time.monotonic()
+    online = await get_online_users()
+    panel_latency_ms = (time.monotonic() - started) * 1000
+    
+    snapshot = collect_user_counts()
+    snapshot.update(
+        online_users=online,
+        panel_latency_ms=round(panel_latency_ms, 1),
+        loop_lag_ms=round(loop_lag.take_max(), 1),
+        cpu_percent=process.cpu_percent(None),
+        rss_mb=round(process.memory_info().rss / 1024 / 1024, 1)
+    )
+    return snapshot
+
+async def metrics_loop():
+    """Фоновая задача записи снимков метрик"""
+    process = psutil.Process()
+    process.cpu_percent(None)
+    while True:
+        await asyncio.sleep(config.METRICS_INTERVAL)
+        try:
+            record_metrics(await collect_snapshot(process))
+            prune_metrics(timedelta(days=config.METRICS_RETENTION_DAYS))
+        except Exception as e:
+            logger.error(f"🛑 Metrics snapshot error: {e}")
+
+# Имя очереди -> функция, возвращающая ее текущую длину (для heartbeat)
+_queues = {"panel_outbox": count_pending_outbox}
+
+def register_queue(name: str, depth):
+    """Добавляет очередь в heartbeat"""
+    _queues[name] = depth
+
+def write_json_atomic(path: str, data: dict):
+    """Запись через временный файл: читатель никогда не увидит половину JSON"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_heartbeat(path: str = None):
+    """Последний heartbeat бота или None"""
+    try:
+        with open(path or config.HEARTBEAT_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_pid_file():
+    with open(config.PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    atexit.register(_remove_pid_file)
+
+def _remove_pid_file():
+    for path in (config.PID_FILE, config.HEARTBEAT_FILE):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+async def heartbeat_loop():
+    """Фоновая задача записи heartbeat"""
+    started_at = time.time()
+    while True:
+        queues = {}
+        for name, depth in _queues.items():
+            try:
+                queues[name] = depth()
+            except Exception:
+                queues[name] = None
+        try:
+            write_json_atomic(config.HEARTBEAT_FILE, {
+                "pid": os.getpid(),
+                "ts": time.time(),
+                "started_at": started_at,
+                "version": config.BOT_VERSION,
+                "loop_lag_ms": round(loop_lag.lag_ms, 1),
+                "queues": queues
+            })
+        except Exception as e:
+            logger.error(f"🛑 Heartbeat write error: {e}")
+        await asyncio.sleep(config.HEARTBEAT_INTERVAL)
@@ -0,0 +1,154 @@
+"""Единый планировщик исходящих сообщений бота.
+
+Все запросы к Bot API, создающие или меняющие сообщения, проходят через
+middleware сессии бота: общий token bucket держит скорость ниже лимита
+Telegram, отдельный bucket на каждый чат не дает заспамить одного
+пользователя. Свободные токены в первую очередь получают ответы на действия
+пользователей, затем уведомления фоновых задач, затем рассылки — приоритет
+задается контекстом send_priority. При ответе 429 (RetryAfter) отправка
+приостанавливается на указанное Telegram время, и запрос повторяется.
+"""
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, SendInvoice, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup
+)
+from config import config
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_BULK = 2
+
+THROTTLED_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, SendInvoice, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup
+)
+
+_priority = ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def send_priority(level: int):
+    """Приоритет отправок внутри блока (по умолчанию — интерактивный)"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 — токен есть)"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutgoingGovernor(BaseRequestMiddleware):
+    def __init__(self, rate: float, chat_rate: float, chat_burst: int, max_retries: int, max_tracked: int = 10000):
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked = max_tracked
+        self.chats = {}
+        # Очередь ожидающих общий токен: (приоритет, порядковый номер, future)
+        self.queue = []
+        self.seq = itertools.count()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._pump_task = None
+
+    def depth(self) -> int:
+        """Число отправок, ожидающих своей очереди (для heartbeat)"""
+        return self.waiting
+
+    def _prune(self, now: float):
+        # Полный bucket ничем не отличается от нового, его можно забыть
+        for chat_id, bucket in list(self.chats.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.burst:
+                del self.chats[chat_id]
+
+    async def _chat_slot(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_tracked:
+                self._prune(time.monotonic())
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        while (delay := bucket.delay(time.monotonic())) > 0:
+            await asyncio.sleep(delay)
+        bucket.take()
+
+    async def _global_slot(self, priority: int):
+        now = time.monotonic()
+        if not self.queue and self.paused_until <= now and self.bucket.delay(now) == 0:
+            self.bucket.take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        """Выдает общие токены ожидающим по приоритету"""
+        while self.queue:
+            now = time.monotonic()
+            delay = max(self.paused_until - now, self.bucket.delay(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self.queue)
+            # Отмененный ожидающий (например, при остановке бота) токен не расходует
+            if not future.done():
+                self.bucket.take()
+                future.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, THROTTLED_METHODS):
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        chat_id = getattr(method, "chat_id", None)
+        self.waiting += 1
+        try:
+            if chat_id is not None:
+                await self._chat_slot(chat_id)
+            await self._global_slot(priority)
+        finally:
+            self.waiting -= 1
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"⚠️ Telegram flood limit, pausing sends for {e.retry_after} s")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                self.waiting += 1
+                try:
+                    await self._global_slot(priority)
+                finally:
+                    self.waiting -= 1
+
+governor = OutgoingGovernor(
+    config.SEND_RATE_GLOBAL, config.SEND_RATE_PER_CHAT, config.SEND_CHAT_BURST, config.SEND_MAX_RETRIES
+)
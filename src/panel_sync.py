@@ -0,0 +1,246 @@
+"""Outbox изменений в панели 3X-UI.
+
+Обработчики записывают операции над клиентами панели (create_client, delete_client,
+update_expiry, set_quota, disable_client, set_sub_id) в таблицу panel_outbox в той же транзакции, что и изменение пользователя,
+и сразу отвечают пользователю. Фоновый воркер выполняет операции по порядку записи,
+объединяя соседние операции одного типа в один запрос к панели, и повторяет
+неудачные с экспоненциальной задержкой. Порядок соблюдается внутри одного клиента:
+отложенная операция задерживает только следующие операции того же клиента. Все операции идемпотентны: создание пропускает
+уже существующих клиентов, удаление — отсутствующих, срок всегда берется актуальный из БД.
+Ожидающая работа имеет детерминированный ключ (expiry:<telegram_id> и т.п.), поэтому
+повторные изменения одного клиента не копят строки, а переисполняют ожидающую операцию.
+"""
+import asyncio
+import json
+import logging
+from itertools import groupby
+from datetime import datetime, timedelta
+from config import config
+from database import (
+    get_outbox_batch, complete_outbox, retry_outbox, prune_outbox,
+    get_profiles_for_create, activate_profiles, release_profiles, get_expiry_targets, get_quota_targets,
+    get_sub_id_targets
+)
+from lifecycle import shutdown_event
+from functions import (
+    add_clients, delete_clients, update_clients_expiry, set_clients_quota, disable_clients, set_clients_sub_id,
+    build_client, to_panel_time, panel_breaker
+)
+
+logger = logging.getLogger(__name__)
+
+_wakeup = asyncio.Event()
+# id операции -> [future, число ожидающих]
+_waiters = {}
+
+def request_panel_sync():
+    """Будит воркер outbox, не дожидаясь следующего интервала"""
+    _wakeup.set()
+
+async def wait_for_operation(operation_id: int, timeout: float):
+    """Ждет завершения операции outbox: 'done', 'failed' или None по таймауту"""
+    waiter = _waiters.get(operation_id)
+    if waiter is None:
+        waiter = _waiters[operation_id] = [asyncio.get_running_loop().create_future(), 0]
+    waiter[1] += 1
+    try:
+        return await asyncio.wait_for(asyncio.shield(waiter[0]), timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        waiter[1] -= 1
+        # Последний ожидающий по таймауту убирает future, чтобы _waiters не рос
+        if not waiter[1] and _waiters.get(operation_id) is waiter:
+            del _waiters[operation_id]
+
+def _resolve(ids, status: str):
+    for operation_id in ids:
+        waiter = _waiters.pop(operation_id, None)
+        if waiter and not waiter[0].done():
+            waiter[0].set_result(status)
+
+async def _create_clients(operations) -> bool:
+    expected = {json.loads(op.payload)["client_id"] for op in operations}
+    profiles = [
+        profile for profile in await get_profiles_for_create([op.telegram_id for op in operations])
+        if profile.client_id in expected
+    ]
+    if not profiles:
+        # Профили уже сняты (например, подписка истекла до создания)
+        return True
+    
+    inbound = await add_clients([
+        build_client(p.client_id, p.email, p.telegram_id, p.subscription_end, p.traffic_quota, p.sub_id)
+        for p in profiles
+    ])
+    if not inbound:
+        return False
+    await activate_profiles([p.client_id for p in profiles], inbound["port"], inbound["remark"])
+    return True
+
+async def _delete_clients(operations) -> bool:
+    payloads = [json.loads(op.payload) for op in operations]
+    return bool(await delete_clients(
+        client_ids=[p["client_id"] for p in payloads if p.get("client_id")],
+        emails=[p["email"] for p in payloads if p.get("email")]
+    ))
+
+async def _update_expiry(operations) -> bool:
+    # Несколько изменений срока одного пользователя схлопываются в одну запись
+    targets = await get_expiry_targets(list({op.telegram_id for op in operations}))
+    if not targets:
+        return True
+    updated = await update_clients_expiry({t.email: to_panel_time(t.subscription_end) for t in targets})
+    if updated is None:
+        return False
+    missing = len(targets) - len(updated)
+    if missing:
+        logger.warning(f"⚠️ {missing} clients not found in panel during expiry update")
+    return True
+
+async def _set_quota(operations):
+    targets = await get_quota_targets(list({op.telegram_id for op in operations}))
+    if not targets:
+        return True
+    now = datetime.utcnow()
+    failed = await set_clients_quota({
+        t.email: (t.traffic_quota or 0, bool(t.subscription_end and t.subscription_end > now)) for t in targets
+    })
+    if failed is None:
+        return False
+    # Повторяются только операции клиентов, чьи счетчики не удалось обнулить:
+    # повтор для остальных обнулил бы уже накопленный после продления трафик
+    failed_ids = {t.telegram_id for t in targets if t.email in failed}
+    return {op.id for op in operations if op.telegram_id in failed_ids} or True
+
+async def _disable_clients(operations) -> bool:
+    return bool(await disable_clients({json.loads(op.payload)["email"] for op in operations}))
+
+async def _set_sub_id(operations) -> bool:
+    # Операция без telegram_id — сверка всех клиентов после обновления бота
+    everyone = any(op.telegram_id is None for op in operations)
+    sub_ids = await get_sub_id_targets(None if everyone else list({op.telegram_id for op in operations}))
+    if not sub_ids:
+        return True
+    changed = await set_clients_sub_id(sub_ids)
+    if changed is None:
+        return False
+    if changed:
+        logger.info(f"✅ subId set for {changed} panel clients")
+    return True
+
+_HANDLERS = {
+    "create_client": _create_clients,
+    "delete_client": _delete_clients,
+    "update_expiry": _update_expiry,
+    "set_quota": _set_quota,
+    "disable_client": _disable_clients,
+    "set_sub_id": _set_sub_id,
+}
+
+async def _execute(operations) -> bool:
+    ids = [op.id for op in operations]
+    handler = _HANDLERS.get(operations[0].operation)
+    error = f"unknown operation {operations[0].operation}"
+    ok = False
+    # Повторно запрошенные во время выполнения операции останутся в очереди
+    started = datetime.utcnow()
+    if handler:
+        try:
+            ok = await handler(operations)
+            error = "panel request failed"
+        except Exception as e:
+            error = str(e)
+    
+    if ok is True:
+        await complete_outbox(ids, started)
+        _resolve(ids, "done")
+        return True
+    
+    if ok:
+        # Частичный успех: обработчик вернул id операций, которые нужно повторить
+        done = [operation_id for operation_id in ids if operation_id not in ok]
+        await complete_outbox(done, started)
+        _resolve(done, "done")
+        ids = [operation_id for operation_id in ids if operation_id in ok]
+    
+    failed = await retry_outbox(ids, error, config.OUTBOX_MAX_ATTEMPTS)
+    if failed:
+        logger.error(f"🛑 Outbox {operations[0].operation} failed permanently for operations {failed}: {error}")
+        if operations[0].operation == "create_client":
+            await release_profiles([json.loads(op.payload)["client_id"] for op in operations if op.id in failed])
+        _resolve(failed, "failed")
+    else:
+        logger.warning(f"⚠️ Outbox {operations[0].operation} x{len(ids)} failed, will retry: {error}")
+    return False
+
+def _order_key(op):
+    """Клиент, в пределах которого важен порядок операций"""
+    if op.telegram_id is not None:
+        return op.telegram_id
+    return json.loads(op.payload or "{}").get("email")
+
+async def drain_outbox() -> int:
+    """Выполняет готовые операции по порядку, возвращает число выполненных"""
+    processed = 0
+    # При открытом breaker операции не тратят попытки: дождемся пробного запроса
+    if panel_breaker.is_open:
+        return processed
+    # Клиенты с отложенной или неудачной операцией: их следующие операции ждут
+    blocked = set()
+    after_id = 0
+    while True:
+        operations = await get_outbox_batch(config.OUTBOX_BATCH, after_id)
+        if not operations:
+            break
+        after_id = operations[-1].id
+        now = datetime.utcnow()
+        ready = []
+        for op in operations:
+            key = _order_key(op)
+            if key in blocked:
+                continue
+            if op.next_attempt_at and op.next_attempt_at > now:
+                blocked.add(key)
+                continue
+            ready.append((key, op))
+        
+        for _, run in groupby(ready, key=lambda item: item[1].operation):
+            run = [(key, op) for key, op in run if key not in blocked]
+            if not run:
+                continue
+            if await _execute([op for _, op in run]):
+                processed += len(run)
+                continue
+            blocked.update(key for key, _ in run)
+            if panel_breaker.is_open:
+                return processed
+        
+        if len(operations) < config.OUTBOX_BATCH:
+            break
+    return processed
+
+async def outbox_loop():
+    """Фоновый воркер outbox"""
+    last_prune = datetime.min
+    while True:
+        try:
+            processed = await drain_outbox()
+            if processed:
+                logger.info(f"✅ Outbox: {processed} panel operations applied")
+            if datetime.utcnow() - last_prune > timedelta(hours=1):
+                await prune_outbox(timedelta(days=7))
+                last_prune = datetime.utcnow()
+        except Exception as e:
+            logger.error(f"🛑 Outbox worker error: {e}")
+        
+        # При остановке выполняется последний проход, чтобы не оставлять готовые операции
+        if shutdown_event.is_set():
+            break
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=config.OUTBOX_POLL_INTERVAL)
+            # Короткая пауза собирает одновременные изменения в один пакет
+            await asyncio.sleep(0.5)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
@@ -0,0 +1,59 @@
+"""QR-коды ссылок подключения.
+
+PNG рендерится один раз на ссылку и хранится в ограниченном кэше на диске под
+хэшем ссылки (при переполнении удаляются давно не использованные файлы). После
+первой загрузки в Telegram бот хранит file_id в users.qr_file_id вместе с хэшем
+ссылки и повторно отправляет картинку по нему, не рендеря и не загружая ее заново.
+Смена адреса, порта или ключей REALITY меняет ссылку, а с ней и хэш, поэтому
+устаревший QR-код не отправляется.
+"""
+import os
+import io
+import time
+import hashlib
+import logging
+import qrcode
+from config import config
+
+logger = logging.getLogger(__name__)
+
+def render_qr(data: str) -> bytes:
+    """PNG с QR-кодом строки"""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=8, border=2)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image().save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def _prune_cache():
+    files = [entry for entry in os.scandir(config.QR_CACHE_DIR) if entry.name.endswith(".png")]
+    excess = len(files) - config.QR_CACHE_MAX_FILES
+    if excess > 0:
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime)[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def qr_key(data: str) -> str:
+    """Ключ кэша QR-кода: хэш закодированной строки"""
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+def get_qr_path(data: str) -> str:
+    """Путь к PNG из кэша, при отсутствии рендерит и сохраняет (блокирующий вызов)"""
+    os.makedirs(config.QR_CACHE_DIR, exist_ok=True)
+    path = os.path.join(config.QR_CACHE_DIR, f"{qr_key(data)}.png")
+    if os.path.exists(path):
+        # mtime служит отметкой последнего использования для вытеснения
+        os.utime(path)
+        return path
+
+    started = time.monotonic()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(render_qr(data))
+    os.replace(tmp_path, path)
+    logger.debug(f"QR {os.path.basename(path)} rendered in {(time.monotonic() - started) * 1000:.0f} ms")
+    _prune_cache()
+    return path
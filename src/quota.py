@@ -0,0 +1,89 @@
+"""Контроль лимитов трафика тарифов.
+
+Проход берет расход всех клиентов одним запросом к панели (clientStats инбаунда)
+и лимиты из БД, после чего пороги для всех клиентов считаются векторно в NumPy.
+Дальше обрабатываются только клиенты, перешедшие новый порог: им отправляется
+предупреждение, а исчерпавшие лимит отключаются в панели через outbox.
+Сама 3X-UI тоже отключает клиента по totalGB; проход нужен для предупреждений
+и для клиентов, созданных до появления лимита. Прочитанный расход сохраняется
+и отдается в заголовке Subscription-Userinfo ссылок-подписок.
+"""
+import asyncio
+import logging
+import numpy as np
+from aiogram import Bot
+from config import config
+from database import get_quota_snapshot, set_quota_levels
+from functions import get_client_traffic
+from panel_sync import request_panel_sync
+from lifecycle import sleep_or_shutdown, initial_delay, mark_run
+from outgoing import send_priority, PRIORITY_NOTIFY
+
+logger = logging.getLogger(__name__)
+
+def evaluate_quotas(used, quotas, levels):
+    """Векторный расчет порогов по массивам расхода, лимитов и уже пройденных порогов.
+    Возвращает (индексы клиентов с новым порогом, новые пороги)"""
+    thresholds = np.array(config.QUOTA_WARN_PERCENTS + [100], dtype=np.int64)
+    percent = np.asarray(used, dtype=np.int64) * 100 // np.asarray(quotas, dtype=np.int64)
+    reached = np.searchsorted(thresholds, percent, side="right")
+    new_levels = np.where(reached > 0, thresholds[np.maximum(reached - 1, 0)], 0)
+    crossed = np.flatnonzero(new_levels > np.asarray(levels, dtype=np.int64))
+    return crossed, new_levels[crossed]
+
+async def enforce_quotas(bot: Bot) -> int:
+    """Один проход контроля лимитов, возвращает число клиентов с новым порогом"""
+    ids, telegram_ids, emails, quotas, levels = await get_quota_snapshot()
+    # Тот же запрос обновляет расход для заголовка Subscription-Userinfo
+    if not ids and not config.SUBSCRIPTION_PORT:
+        return 0
+    usage = await get_client_traffic()
+    if usage is None:
+        logger.warning("⚠️ Quota check skipped: panel unavailable")
+        return 0
+    if not ids:
+        return 0
+
+    used = np.fromiter((usage.get(email, 0) for email in emails), dtype=np.int64, count=len(emails))
+    crossed, new_levels = evaluate_quotas(used, quotas, levels)
+    if not len(crossed):
+        return 0
+
+    exceeded = [(telegram_ids[i], emails[i]) for i, level in zip(crossed, new_levels) if level >= 100]
+    await set_quota_levels(
+        [{"id": ids[i], "quota_level": int(level)} for i, level in zip(crossed, new_levels)], exceeded
+    )
+    if exceeded:
+        request_panel_sync()
+
+    for i, level in zip(crossed, new_levels):
+        quota_gb = quotas[i] / 1024 ** 3
+        used_gb = used[i] / 1024 ** 3
+        if level >= 100:
+            text = (
+                f"🛑 Лимит трафика исчерпан ({used_gb:.1f} из {quota_gb:.0f} GB), доступ к VPN приостановлен.\n"
+                "Продлите подписку, чтобы получить новый лимит."
+            )
+        else:
+            text = f"⚠️ Использовано {level}% трафика по тарифу: {used_gb:.1f} из {quota_gb:.0f} GB."
+        try:
+            with send_priority(PRIORITY_NOTIFY):
+                await bot.send_message(telegram_ids[i], text)
+        except Exception as e:
+            logger.error(f"🛑 Failed to send quota notification to {telegram_ids[i]}: {e}")
+
+    logger.info(f"✅ Quota check: {len(crossed)} thresholds crossed, {len(exceeded)} clients disabled")
+    return len(crossed)
+
+async def quota_loop(bot: Bot):
+    """Фоновая задача контроля лимитов трафика"""
+    if await sleep_or_shutdown(initial_delay("quota", config.QUOTA_CHECK_INTERVAL)):
+        return
+    while True:
+        mark_run("quota")
+        try:
+            await enforce_quotas(bot)
+        except Exception as e:
+            logger.error(f"🛑 Quota check error: {e}")
+        if await sleep_or_shutdown(config.QUOTA_CHECK_INTERVAL):
+            break
@@ -0,0 +1,101 @@
+"""Сверка клиентов панели 3X-UI с профилями в БД бота.
+
+Пример:
+    python3 src/reconcile.py            # только отчет
+    python3 src/reconcile.py --repair   # отчет и исправление расхождений
+"""
+import asyncio
+import argparse
+import logging
+import time
+import coloredlogs
+from datetime import datetime
+from database import iter_profiles, get_static_profiles
+from functions import XUIAPI, build_client, to_panel_time
+
+logger = logging.getLogger(__name__)
+
+# Допустимое расхождение expiryTime (мс): панель и БД хранят время с разной точностью
+EXPIRY_TOLERANCE_MS = 60 * 1000
+
+async def reconcile(repair: bool = False, batch_size: int = 5000) -> dict:
+    """Сравнивает панель и БД за один проход и при repair=True исправляет расхождения пакетами"""
+    started = time.monotonic()
+    api = XUIAPI()
+    try:
+        clients = await api.get_clients()
+        if clients is None:
+            raise RuntimeError("не удалось получить клиентов из панели")
+        
+        # email -> (UUID, expiryTime); в памяти остаются только нужные поля
+        panel = {c.get("email"): (c.get("id"), c.get("expiryTime") or 0) for c in clients}
+        panel_clients = len(panel)
+        del clients
+        static_names = {profile.name for profile in await get_static_profiles()}
+        
+        now_ms = to_panel_time(datetime.utcnow())
+        missing, expiry_mismatch = [], {}
+        db_profiles = 0
+        for profile in iter_profiles(batch_size):
+            db_profiles += 1
+            panel_client = panel.pop(profile.email, None)
+            expected_ms = to_panel_time(profile.subscription_end) if profile.subscription_end else 0
+            if panel_client is None:
+                # port=None — создание еще в outbox; истекшие профили снимет цикл подписок
+                if profile.port and expected_ms > now_ms:
+                    missing.append(profile)
+            elif abs((panel_client[1] or 0) - expected_ms) > EXPIRY_TOLERANCE_MS:
+                expiry_mismatch[profile.email] = expected_ms
+        
+        # Оставшиеся в панели клиенты бота без профиля в БД — сироты; ручные клиенты не трогаем
+        orphans = [
+            client_id for email, (client_id, _) in panel.items()
+            if email and email.startswith("user_") and email not in static_names
+        ]
+        
+        report = {
+            "panel_clients": panel_clients,
+            "db_profiles": db_profiles,
+            "orphans": len(orphans),
+            "missing": len(missing),
+            "expiry_mismatch": len(expiry_mismatch),
+            "diff_seconds": round(time.monotonic() - started, 2),
+        }
+        logger.info(f"ℹ️ Reconcile report: {report}")
+        if orphans:
+            logger.info(f"ℹ️ Orphan clients (sample): {orphans[:10]}")
+        if missing:
+            logger.info(f"ℹ️ Missing clients (sample): {[p.email for p in missing[:10]]}")
+        
+        if repair:
+            for i in range(0, len(orphans), batch_size):
+                if not await api.delete_clients(client_ids=orphans[i:i + batch_size]):
+                    raise RuntimeError("ошибка удаления клиентов-сирот")
+            for i in range(0, len(missing), batch_size):
+                batch = missing[i:i + batch_size]
+                # Лимит и subId те же, что в БД; исчерпавший лимит создается отключенным
+                if await api.add_clients([
+                    build_client(
+                        p.client_id, p.email, p.telegram_id, p.subscription_end, p.traffic_quota, p.sub_id,
+                        enable=(p.quota_level or 0) < 100
+                    )
+                    for p in batch
+                ]) is None:
+                    raise RuntimeError("ошибка повторного создания клиентов")
+            emails = list(expiry_mismatch)
+            for i in range(0, len(emails), batch_size):
+                if await api.update_clients_expiry({e: expiry_mismatch[e] for e in emails[i:i + batch_size]}) is None:
+                    raise RuntimeError("ошибка обновления expiryTime")
+            report["repaired"] = True
+            logger.info(f"✅ Reconcile repair completed in {time.monotonic() - started:.2f}s")
+        return report
+    finally:
+        await api.close()
+
+if __name__ == "__main__":
+    coloredlogs.install(level='info')
+    parser = argparse.ArgumentParser(description="Сверка клиентов 3X-UI с БД бота")
+    parser.add_argument("--repair", action="store_true", help="Удалить сирот, пересоздать недостающих, исправить сроки")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(reconcile(args.repair, args.batch_size))
@@ -0,0 +1,130 @@
+"""Заранее построенные экраны бота.
+
+Статические клавиатуры и тексты (меню в вариантах по активности подписки
+и правам администратора, таблица тарифов, ссылки на приложения, админ-меню)
+строятся один раз при импорте, а обработчики подставляют только данные
+пользователя. Конфигурация читается при запуске, поэтому после ее изменения
+достаточно вызвать screens.rebuild() (или перезапустить бота).
+"""
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from config import config
+
+MENU_TEXT = (
+    "**Имя профиля**: `{full_name}`\n"
+    "**Id**: `{telegram_id}`\n"
+    "**Подписка**: `{status}`\n"
+    "**Дата окончания подписки**: `{expire_date}`"
+)
+
+HELP_TEXT = (
+    f"О боте:\n"
+    "<b>Разработчик:</b>\n"
+    "@Redulum\n"
+    "<a href=''>Официальный чат проекта появится позже</a>"
+)
+
+CONNECT_TEXT = (
+    "🎉 **Ваш VPN профиль готов!**\n\n"
+    "ℹ️ **Инструкция по подключению:**\n"
+    "1. Скачайте приложение для вашей платформы\n"
+    "2. Скопируйте эту ссылку и импортируйте в приложение:\n\n"
+    "`{vless_url}`\n\n"
+    "3. Активируйте соединение в приложении."
+)
+
+DOWNLOAD_APPS = [
+    ('🖥️ Windows [V2RayN]', 'https://github.com/2dust/v2rayN/releases/download/7.13.8/v2rayN-windows-64-desktop.zip'),
+    ('🐧 Linux [NekoBox]', 'https://github.com/MatsuriDayo/nekoray/releases/download/4.0.1/nekoray-4.0.1-2024-12-12-debian-x64.deb'),
+    ('🍎 Mac [V2RayU]', 'https://github.com/yanue/V2rayU/releases/download/v4.2.6/V2rayU-64.dmg '),
+    ('🍏 iOS [V2RayTun]', 'https://apps.apple.com/ru/app/v2raytun/id6476628951'),
+    ('🤖 Android [V2RayNG]', 'https://github.com/2dust/v2rayNG/releases/download/1.10.16/v2rayNG_1.10.16_arm64-v8a.apk'),
+]
+
+def _back(callback_data: str) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data=callback_data)
+    return builder.as_markup()
+
+def _main_menu(active: bool, is_admin: bool) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="💵 Продлить" if active else "💵 Оплатить", callback_data="renew_sub")
+    builder.button(text="✅ Подключить", callback_data="connect")
+    builder.button(text="📊 Статистика", callback_data="stats")
+    builder.button(text="ℹ️ Помощь", callback_data="help")
+
+    if is_admin:
+        builder.button(text="⚠️ Админ. меню", callback_data="admin_menu")
+
+    builder.adjust(2, 2, 1)
+    return builder.as_markup()
+
+def _prices() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+
+    # Добавляем кнопки для каждого варианта подписки
+    for months in sorted(config.PRICES.keys()):
+        price_info = config.PRICES[months]
+        final_price = config.calculate_price(months)
+
+        discount_text = ""
+        if price_info["discount_percent"] > 0:
+            discount_text = f" (-{price_info['discount_percent']}%)"
+        if price_info.get("traffic_gb"):
+            discount_text += f", {price_info['traffic_gb']} GB"
+
+        button_text = f"{months} мес. - {final_price} руб.{discount_text}"
+        builder.button(text=button_text, callback_data=f"pay_{months}")
+
+    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+def _download_apps() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for text, url in DOWNLOAD_APPS:
+        builder.button(text=text, url=url)
+    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
+    builder.adjust(2, 2, 1, 1)
+    return builder.as_markup()
+
+def _admin_menu() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="+ время", callback_data="admin_add_time")
+    builder.button(text="- время", callback_data="admin_remove_time")
+    builder.button(text="⏱ Массово ± время", callback_data="admin_bulk_time")
+    builder.button(text="📋 Список пользователей", callback_data="admin_user_list")
+    builder.button(text="📊 Статистика исп. сети", callback_data="admin_network_stats")
+    builder.button(text="💰 Выручка", callback_data="admin_revenue")
+    builder.button(text="📢 Рассылка", callback_data="admin_send_message")
+    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
+    builder.adjust(2, 1, 1, 1, 1, 1, 1)
+    return builder.as_markup()
+
+def _admin_user_list() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ С подпиской", callback_data="user_list_active")
+    builder.button(text="🛑 Без подписки", callback_data="user_list_inactive")
+    builder.button(text="⏱️ Статические профили", callback_data="static_profiles_menu")
+    builder.button(text="⬅️ Назад", callback_data="admin_menu")
+    builder.adjust(1, 1, 1)
+    return builder.as_markup()
+
+class Screens:
+    """Реестр готовых клавиатур"""
+    def __init__(self):
+        self.rebuild()
+
+    def rebuild(self):
+        self.main_menu = {
+            (active, is_admin): _main_menu(active, is_admin)
+            for active in (True, False) for is_admin in (True, False)
+        }
+        self.prices = _prices()
+        self.download_apps = _download_apps()
+        self.admin_menu = _admin_menu()
+        self.admin_user_list = _admin_user_list()
+        self.back_to_menu = _back("back_to_menu")
+        self.back_to_admin = _back("admin_menu")
+
+screens = Screens()
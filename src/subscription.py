@@ -0,0 +1,104 @@
+"""HTTP-сервер ссылок-подписок.
+
+Клиентские приложения периодически запрашивают /sub/<sub_id> и получают
+base64-список ссылок пользователя, построенный generate_vless_url из текущих
+настроек. Ответ кэшируется в памяти на SUBSCRIPTION_CACHE_TTL секунд вместе
+с ETag, поэтому повторный опрос с If-None-Match обходится ответом 304 без
+обращения к БД. Смена узла, порта или ключей REALITY доходит до клиентов
+с очередным обновлением подписки.
+"""
+import base64
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from aiohttp import web
+from config import config
+from database import get_user_by_sub_id
+from functions import generate_vless_url, client_traffic
+
+logger = logging.getLogger(__name__)
+
+# sub_id -> (время истечения, ETag, тело, заголовки), вытеснение по LRU
+_cache = OrderedDict()
+
+def subscription_url(sub_id: str) -> str:
+    """Публичная ссылка-подписка (пустая строка, если сервер выключен)"""
+    if not config.SUBSCRIPTION_PORT or not sub_id:
+        return ""
+    base_url = config.SUBSCRIPTION_URL or f"http://{config.XUI_HOST}:{config.SUBSCRIPTION_PORT}"
+    return f"{base_url.rstrip('/')}/sub/{sub_id}"
+
+async def build_subscription(sub_id: str):
+    """Тело и заголовки подписки, None для неизвестного sub_id"""
+    user = await get_user_by_sub_id(sub_id)
+    if not user:
+        return None
+
+    links = []
+    expire = 0
+    if user.subscription_end:
+        expire = int(user.subscription_end.replace(tzinfo=timezone.utc).timestamp())
+    if user.port and user.subscription_end and user.subscription_end > datetime.utcnow():
+        links.append(generate_vless_url({
+            "client_id": user.client_id,
+            "email": user.email,
+            "port": user.port,
+            "remark": user.remark
+        }))
+
+    # Расход берется из последнего прохода контроля трафика, без запроса к панели
+    upload, download = client_traffic(user.email)
+    body = base64.b64encode("\n".join(links).encode()).decode()
+    headers = {
+        "Profile-Update-Interval": str(config.SUBSCRIPTION_UPDATE_HOURS),
+        "Subscription-Userinfo": f"upload={upload}; download={download}; total={user.traffic_quota or 0}; expire={expire}",
+    }
+    return body, headers
+
+async def _cached_subscription(sub_id: str):
+    entry = _cache.get(sub_id)
+    now = time.monotonic()
+    if entry and entry[0] > now:
+        _cache.move_to_end(sub_id)
+        return entry
+
+    result = await build_subscription(sub_id)
+    if result is None:
+        _cache.pop(sub_id, None)
+        return None
+    body, headers = result
+    etag = '"' + hashlib.sha1(body.encode() + repr(sorted(headers.items())).encode()).hexdigest()[:20] + '"'
+    entry = _cache[sub_id] = (now + config.SUBSCRIPTION_CACHE_TTL, etag, body, headers)
+    _cache.move_to_end(sub_id)
+    while len(_cache) > config.SUBSCRIPTION_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return entry
+
+async def handle_subscription(request: web.Request) -> web.Response:
+    try:
+        entry = await _cached_subscription(request.match_info["sub_id"])
+    except Exception as e:
+        logger.error(f"🛑 Subscription build error: {e}")
+        raise web.HTTPServiceUnavailable()
+    if entry is None:
+        raise web.HTTPNotFound()
+
+    _, etag, body, headers = entry
+    headers = {**headers, "ETag": etag, "Cache-Control": f"private, max-age={config.SUBSCRIPTION_CACHE_TTL}"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=body, content_type="text/plain", headers=headers)
+
+async def start_subscription_server():
+    """Запускает HTTP-сервер подписок в текущем event loop, возвращает runner (или None)"""
+    if not config.SUBSCRIPTION_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/sub/{sub_id}", handle_subscription)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.SUBSCRIPTION_HOST, config.SUBSCRIPTION_PORT).start()
+    logger.info(f"✅ Subscription server listening on {config.SUBSCRIPTION_HOST}:{config.SUBSCRIPTION_PORT}")
+    return runner
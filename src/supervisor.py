@@ -0,0 +1,99 @@
+"""Супервизор бота: запускает src/app.py и перезапускает его с нарастающей задержкой,
+если процесс завершился или его heartbeat устарел.
+
+Пример:
+    python3 src/supervisor.py
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+import coloredlogs
+from config import config
+from monitoring import read_heartbeat
+
+logger = logging.getLogger(__name__)
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+SUPERVISOR_PID_FILE = f"{config.PID_FILE}.supervisor"
+# Время на запуск бота до первой проверки heartbeat
+STARTUP_GRACE = 60
+# Работа дольше этого срока считается стабильной и сбрасывает задержку перезапуска
+STABLE_AFTER = 600
+MAX_BACKOFF = 300
+
+_stopping = False
+
+def _stop(signum, frame):
+    global _stopping
+    _stopping = True
+
+def _sleep(seconds: float, process: subprocess.Popen = None):
+    """Сон короткими шагами: быстрая реакция на SIGTERM и на завершение бота"""
+    deadline = time.time() + seconds
+    while not _stopping and time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            return
+        time.sleep(0.5)
+
+def _terminate(process: subprocess.Popen, timeout: int = 30):
+    """SIGTERM с ожиданием корректного завершения, затем SIGKILL"""
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        logger.warning("⚠️ Bot did not stop in time, killing")
+        process.kill()
+        process.wait()
+
+def _heartbeat_stale(process: subprocess.Popen, started: float) -> bool:
+    if time.time() - started < STARTUP_GRACE:
+        return False
+    heartbeat = read_heartbeat()
+    if not heartbeat or heartbeat.get("pid") != process.pid:
+        return True
+    return time.time() - heartbeat.get("ts", 0) > config.HEARTBEAT_STALE_AFTER
+
+def supervise():
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    with open(SUPERVISOR_PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    
+    backoff = 1
+    try:
+        while not _stopping:
+            started = time.time()
+            process = subprocess.Popen([sys.executable, APP_PATH])
+            logger.info(f"ℹ️ Bot started (PID: {process.pid})")
+            
+            while not _stopping and process.poll() is None:
+                if _heartbeat_stale(process, started):
+                    logger.error("🛑 Bot heartbeat is stale, restarting")
+                    _terminate(process)
+                    break
+                _sleep(config.HEARTBEAT_INTERVAL, process)
+            
+            if _stopping:
+                _terminate(process)
+                break
+            
+            if time.time() - started > STABLE_AFTER:
+                backoff = 1
+            logger.warning(f"⚠️ Bot exited with code {process.poll()}, restart in {backoff}s")
+            _sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+    finally:
+        try:
+            os.remove(SUPERVISOR_PID_FILE)
+        except OSError:
+            pass
+    logger.info("Supervisor stopped")
+
+if __name__ == "__main__":
+    coloredlogs.install(level='info')
+    supervise()